@@ -1,9 +1,12 @@
-from flask import Flask, render_template, request, redirect, url_for, session, jsonify, send_file, flash
+from flask import Flask, Response, render_template, stream_template, stream_with_context, request, redirect, url_for, session, jsonify, send_file, flash, g, has_app_context
 from flask_cors import CORS
 from markupsafe import Markup
 import sqlite3
 import os
+import sys
+import tempfile
 import random
+import secrets
 import string
 from datetime import datetime
 import qrcode
@@ -17,14 +20,20 @@ from io import BytesIO
 import json
 import re
 from docx.oxml import parse_xml
-from docx.oxml.ns import qn
+from docx.oxml.ns import qn, nsmap
 from docx.enum.table import WD_TABLE_ALIGNMENT
 from docx.enum.text import WD_ALIGN_PARAGRAPH
 import time
 import zipfile
+import zlib
+import hashlib
+import math
+from xml.sax.saxutils import escape as xml_escape
+import atexit
 from pathlib import Path
 import spotipy
 from spotipy.oauth2 import SpotifyOAuth
+from dotenv import load_dotenv
 
 from reportlab.lib.pagesizes import A4
 from reportlab.lib.units import cm
@@ -32,14 +41,25 @@ from reportlab.platypus import SimpleDocTemplate, Table, TableStyle, Paragraph,
 from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
 from reportlab.lib import colors
 from reportlab.lib.enums import TA_LEFT, TA_CENTER, TA_RIGHT
+from reportlab.pdfbase.pdfmetrics import stringWidth
+from reportlab.pdfgen import canvas as pdfcanvas
+try:
+    from pypdf import PdfReader, PdfWriter
+except ImportError:  # ohne pypdf werden Etiketten in einem Prozess erzeugt
+    PdfReader = PdfWriter = None
 from PIL import Image as PILImage
 import requests
 from meross_iot.http_api import MerossHttpClient
 from meross_iot.manager import MerossManager
 from meross_iot.controller.mixins.toggle import ToggleXMixin
 from meross_iot.model.enums import OnlineStatus
-from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
 import threading
+import multiprocessing
+from collections import namedtuple
+from itertools import groupby, chain, islice
+from functools import lru_cache, partial
 
 app = Flask(__name__)
 CORS(app, resources={r"/*": {"origins": "*"}}, supports_credentials=True)
@@ -297,6 +317,7 @@ def check_version():
         print(f"Fehler beim Überprüfen der Version: {e}")
 
 def init_user_db():
+    is_new = not os.path.exists('users.db')
     conn = sqlite3.connect('users.db')
     c = conn.cursor()
     c.execute('''CREATE TABLE IF NOT EXISTS users
@@ -311,11 +332,129 @@ def init_user_db():
     c.execute("INSERT OR IGNORE INTO users VALUES ('CKS-udzsfzewliuhd', 'Steffen Mascher')")
     conn.commit()
     conn.close()
+    if is_new:
+        apply_migrations('users.db', USERS_MIGRATIONS, backup=False)
 
 def create_warehouse_db(lager_id):
-    conn = sqlite3.connect(f'{lager_id}.db')
-    c = conn.cursor()
-    c.execute('''CREATE TABLE geraete
+    reopen_db_path(f'{lager_id}.db')
+    apply_migrations(f'{lager_id}.db', WAREHOUSE_MIGRATIONS, backup=False)
+
+import sqlite3
+import shutil
+from datetime import datetime
+import os
+
+def backup_database(db_path, operation="auto_migration"):
+    """Create a backup of the database before making changes"""
+    os.makedirs('backups', exist_ok=True)
+    timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+    backup_path = f'backups/{timestamp}_{operation}_{os.path.basename(db_path)}'
+    copy_database(db_path, backup_path)
+    print(f"Backup erstellt: {backup_path}")
+    return backup_path
+
+def get_table_columns(conn, table_name):
+    """Get all columns of a table"""
+    cursor = conn.cursor()
+    cursor.execute(f"PRAGMA table_info({table_name})")
+    return {row[1]: row[2] for row in cursor.fetchall()}  # {column_name: column_type}
+
+def add_missing_column(conn, table_name, column_name, column_type, default_value=None):
+    """Add a missing column to a table (committed by the calling migration step)"""
+    cursor = conn.cursor()
+    try:
+        sql = f"ALTER TABLE {table_name} ADD COLUMN {column_name} {column_type}"
+        if default_value is not None:
+            sql += f" DEFAULT {default_value}"
+        cursor.execute(sql)
+        print(f"Spalte hinzugefügt: {table_name}.{column_name} ({column_type})")
+        return True
+    except sqlite3.Error as e:
+        print(f"Fehler beim Hinzufügen der Spalte {column_name}: {e}")
+        return False
+
+def ensure_tables_and_columns(conn, expected_schema, create_statements):
+    """Create missing tables and add missing columns. Safe to run repeatedly."""
+    cursor = conn.cursor()
+    changes_made = False
+
+    for table_name, expected_columns in expected_schema.items():
+        cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name=?", (table_name,))
+        if not cursor.fetchone():
+            print(f"Tabelle {table_name} existiert nicht - wird erstellt")
+            cursor.execute(create_statements[table_name])
+            changes_made = True
+            continue
+
+        current_columns = get_table_columns(conn, table_name)
+
+        for column_name, column_type in expected_columns.items():
+            if column_name not in current_columns:
+                print(f"Fehlende Spalte erkannt: {table_name}.{column_name}")
+
+                # Extrahiere DEFAULT-Wert wenn vorhanden
+                default_value = None
+                if 'DEFAULT' in column_type:
+                    parts = column_type.split('DEFAULT')
+                    column_type = parts[0].strip()
+                    default_value = parts[1].strip().strip("'\"")
+                    if default_value.upper() != 'CURRENT_TIMESTAMP':
+                        default_value = f"'{default_value}'"
+
+                if add_missing_column(conn, table_name, column_name, column_type, default_value):
+                    changes_made = True
+
+    return changes_made
+
+# Erwartete Spalten und CREATE-Statements für jede Lager-Datenbank
+WAREHOUSE_SCHEMA = {
+    'geraete': {
+        'id': 'INTEGER PRIMARY KEY AUTOINCREMENT',
+        'name': 'TEXT NOT NULL',
+        'barcode': 'TEXT UNIQUE NOT NULL',
+        'lagerplatz': 'TEXT NOT NULL',
+        'status': 'TEXT DEFAULT "verfügbar"',
+        'beschreibung': 'TEXT',
+        'seriennummer': 'TEXT',
+        'modell': 'TEXT',
+        'instrumentenart': 'TEXT',
+        'inventarnummer': 'TEXT',
+        'kaufdatum': 'TEXT',
+        'preis': 'REAL',
+        'quantity': 'INTEGER DEFAULT 1',
+        'hersteller': 'TEXT'
+    },
+    'ausleihen': {
+        'id': 'INTEGER PRIMARY KEY AUTOINCREMENT',
+        'ausleih_id': 'TEXT NOT NULL',
+        'mitarbeiter_id': 'TEXT NOT NULL',
+        'mitarbeiter_name': 'TEXT NOT NULL',
+        'zielort': 'TEXT NOT NULL',
+        'datum': 'TEXT NOT NULL',
+        'rueckgabe_qr': 'TEXT NOT NULL',
+        'status': 'TEXT DEFAULT "ausgeliehen"',
+        'email': 'TEXT',
+        'klasse': 'TEXT'
+    },
+    'ausleih_details': {
+        'id': 'INTEGER PRIMARY KEY AUTOINCREMENT',
+        'ausleih_id': 'TEXT NOT NULL',
+        'geraet_id': 'INTEGER NOT NULL',
+        'geraet_barcode': 'TEXT NOT NULL',
+        'quantity': 'INTEGER DEFAULT 1'
+    },
+    'label_layouts': {
+        'id': 'INTEGER PRIMARY KEY AUTOINCREMENT',
+        'name': 'TEXT NOT NULL',
+        'layout_data': 'TEXT NOT NULL',
+        'is_default': 'INTEGER DEFAULT 0',
+        'created_at': 'TEXT DEFAULT CURRENT_TIMESTAMP',
+        'updated_at': 'TEXT DEFAULT CURRENT_TIMESTAMP'
+    }
+}
+
+WAREHOUSE_TABLES = {
+    'geraete': '''CREATE TABLE geraete
                  (id INTEGER PRIMARY KEY AUTOINCREMENT,
                    name TEXT NOT NULL,
                    barcode TEXT UNIQUE NOT NULL,
@@ -329,8 +468,8 @@ def create_warehouse_db(lager_id):
                    kaufdatum TEXT,
                    preis REAL,
                    quantity INTEGER DEFAULT 1,
-                   hersteller TEXT)''')
-    c.execute('''CREATE TABLE ausleihen
+                   hersteller TEXT)''',
+    'ausleihen': '''CREATE TABLE ausleihen
                  (id INTEGER PRIMARY KEY AUTOINCREMENT,
                    ausleih_id TEXT NOT NULL,
                    mitarbeiter_id TEXT NOT NULL,
@@ -340,287 +479,441 @@ def create_warehouse_db(lager_id):
                    rueckgabe_qr TEXT NOT NULL,
                    status TEXT DEFAULT 'ausgeliehen',
                    email TEXT,
-                   klasse TEXT)''')
-    c.execute('''CREATE TABLE ausleih_details
+                   klasse TEXT)''',
+    'ausleih_details': '''CREATE TABLE ausleih_details
                  (id INTEGER PRIMARY KEY AUTOINCREMENT,
                    ausleih_id TEXT NOT NULL,
                    geraet_id INTEGER NOT NULL,
                    geraet_barcode TEXT NOT NULL,
                    quantity INTEGER DEFAULT 1,
                    FOREIGN KEY(ausleih_id) REFERENCES ausleihen(ausleih_id),
-                   FOREIGN KEY(geraet_id) REFERENCES geraete(id))''')
-    c.execute('''CREATE TABLE label_layouts
+                   FOREIGN KEY(geraet_id) REFERENCES geraete(id))''',
+    'label_layouts': '''CREATE TABLE label_layouts
                  (id INTEGER PRIMARY KEY AUTOINCREMENT,
                    name TEXT NOT NULL,
                    layout_data TEXT NOT NULL,
                    is_default INTEGER DEFAULT 0,
                    created_at TEXT DEFAULT CURRENT_TIMESTAMP,
-                   updated_at TEXT DEFAULT CURRENT_TIMESTAMP)''')
-    conn.commit()
-    conn.close()
-
-import sqlite3
-import shutil
-from datetime import datetime
-import os
-
-def backup_database(db_path, operation="auto_migration"):
-    """Create a backup of the database before making changes"""
-    os.makedirs('backups', exist_ok=True)
-    timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-    backup_path = f'backups/{timestamp}_{operation}_{os.path.basename(db_path)}'
-    shutil.copy(db_path, backup_path)
-    print(f"Backup erstellt: {backup_path}")
-    return backup_path
-
-def get_table_columns(conn, table_name):
-    """Get all columns of a table"""
-    cursor = conn.cursor()
-    cursor.execute(f"PRAGMA table_info({table_name})")
-    return {row[1]: row[2] for row in cursor.fetchall()}  # {column_name: column_type}
+                   updated_at TEXT DEFAULT CURRENT_TIMESTAMP)'''
+}
+
+USERS_SCHEMA = {
+    'users': {
+        'id': 'TEXT PRIMARY KEY',
+        'name': 'TEXT NOT NULL'
+    },
+    'lager': {
+        'id': 'TEXT PRIMARY KEY',
+        'name': 'TEXT NOT NULL',
+        'created_by': 'TEXT',
+        'access_users': 'TEXT',
+        'system_type': 'TEXT DEFAULT "personal"'
+    }
+}
 
-def add_missing_column(conn, table_name, column_name, column_type, default_value=None):
-    """Add a missing column to a table"""
-    cursor = conn.cursor()
+USERS_TABLES = {
+    'users': '''CREATE TABLE IF NOT EXISTS users
+                 (id TEXT PRIMARY KEY, name TEXT NOT NULL)''',
+    'lager': '''CREATE TABLE IF NOT EXISTS lager
+                 (id TEXT PRIMARY KEY, name TEXT NOT NULL, created_by TEXT,
+                   access_users TEXT, system_type TEXT DEFAULT 'personal')'''
+}
+
+def _migrate_warehouse_base_schema(conn):
+    """Base schema: create all tables and columns"""
+    ensure_tables_and_columns(conn, WAREHOUSE_SCHEMA, WAREHOUSE_TABLES)
+
+# Indizes für die Ausleih-Joins (geraet_id, ausleih_id, status, rueckgabe_qr, mitarbeiter_id)
+WAREHOUSE_INDEXES = [
+    "CREATE INDEX IF NOT EXISTS idx_ausleih_details_geraet ON ausleih_details(geraet_id, ausleih_id, quantity)",
+    "CREATE INDEX IF NOT EXISTS idx_ausleih_details_ausleihe ON ausleih_details(ausleih_id, geraet_id)",
+    "CREATE INDEX IF NOT EXISTS idx_ausleihen_ausleih_id ON ausleihen(ausleih_id, status)",
+    # Partielle Indizes nur über aktive Ausleihen
+    "CREATE INDEX IF NOT EXISTS idx_ausleihen_aktiv ON ausleihen(ausleih_id, status, mitarbeiter_name, klasse, zielort, datum, email) WHERE status = 'ausgeliehen'",
+    "CREATE INDEX IF NOT EXISTS idx_ausleihen_aktiv_qr ON ausleihen(rueckgabe_qr) WHERE status = 'ausgeliehen'",
+    "CREATE INDEX IF NOT EXISTS idx_ausleihen_aktiv_mitarbeiter ON ausleihen(mitarbeiter_id, datum) WHERE status = 'ausgeliehen'",
+]
+
+def _migrate_warehouse_borrow_indexes(conn):
+    """Indexes for the borrow joins"""
+    for statement in WAREHOUSE_INDEXES:
+        conn.execute(statement)
+
+# Volltextindex (Trigram, damit auch Teilwörter gefunden werden) für das Suchfeld.
+# rowid ist geraete.id; ausleiher und klasse stammen aus den aktiven Ausleihen.
+FTS_COLUMNS = "name, barcode, lagerplatz, seriennummer, modell, instrumentenart, ausleiher, klasse"
+
+def _fts_insert_sql(device_ids):
+    """INSERT that indexes the devices matching the given geraete.id condition"""
+    return f"""
+        INSERT INTO geraete_fts(rowid, {FTS_COLUMNS})
+        SELECT g.id, g.name, g.barcode, g.lagerplatz, g.seriennummer, g.modell, g.instrumentenart,
+               (SELECT group_concat(a.mitarbeiter_name, ' ') FROM ausleih_details ad
+                JOIN ausleihen a ON ad.ausleih_id = a.ausleih_id AND a.status = 'ausgeliehen'
+                WHERE ad.geraet_id = g.id),
+               (SELECT group_concat(a.klasse, ' ') FROM ausleih_details ad
+                JOIN ausleihen a ON ad.ausleih_id = a.ausleih_id AND a.status = 'ausgeliehen'
+                WHERE ad.geraet_id = g.id)
+        FROM geraete g WHERE g.id {device_ids}"""
+
+def _fts_refresh_sql(device_ids):
+    """Trigger statements that rebuild the search index rows for the given geraete.id condition"""
+    return f"DELETE FROM geraete_fts WHERE rowid {device_ids}; {_fts_insert_sql(device_ids)};"
+
+FTS_TRIGGERS = {
+    'geraete_fts_ai': ("AFTER INSERT ON geraete", _fts_refresh_sql("= NEW.id")),
+    'geraete_fts_au': ("AFTER UPDATE OF name, barcode, lagerplatz, seriennummer, modell, instrumentenart ON geraete",
+                       "DELETE FROM geraete_fts WHERE rowid = OLD.id;" + _fts_refresh_sql("= NEW.id")),
+    'geraete_fts_ad': ("AFTER DELETE ON geraete", "DELETE FROM geraete_fts WHERE rowid = OLD.id;"),
+    'ausleih_details_fts_ai': ("AFTER INSERT ON ausleih_details", _fts_refresh_sql("= NEW.geraet_id")),
+    'ausleih_details_fts_ad': ("AFTER DELETE ON ausleih_details", _fts_refresh_sql("= OLD.geraet_id")),
+    'ausleih_details_fts_au': ("AFTER UPDATE OF geraet_id, ausleih_id ON ausleih_details",
+                               _fts_refresh_sql("= OLD.geraet_id") + _fts_refresh_sql("= NEW.geraet_id")),
+    'ausleihen_fts_au': ("AFTER UPDATE OF status, mitarbeiter_name, klasse ON ausleihen",
+                         _fts_refresh_sql("IN (SELECT geraet_id FROM ausleih_details WHERE ausleih_id = NEW.ausleih_id)")),
+    'ausleihen_fts_ad': ("AFTER DELETE ON ausleihen",
+                         _fts_refresh_sql("IN (SELECT geraet_id FROM ausleih_details WHERE ausleih_id = OLD.ausleih_id)")),
+}
+
+def _migrate_warehouse_search_index(conn):
+    """Full-text index (FTS5, trigram) for the device search"""
     try:
-        sql = f"ALTER TABLE {table_name} ADD COLUMN {column_name} {column_type}"
-        if default_value is not None:
-            sql += f" DEFAULT {default_value}"
-        cursor.execute(sql)
-        conn.commit()
-        print(f"Spalte hinzugefügt: {table_name}.{column_name} ({column_type})")
+        conn.execute(f"CREATE VIRTUAL TABLE IF NOT EXISTS geraete_fts USING fts5({FTS_COLUMNS}, tokenize = 'trigram')")
+    except sqlite3.OperationalError as e:
+        # SQLite ohne FTS5/Trigram (< 3.34): Suche bleibt bei LIKE
+        print(f"Volltextindex nicht verfügbar, Suche nutzt LIKE: {e}")
+        return
+    for trigger_name, (event, body) in FTS_TRIGGERS.items():
+        conn.execute(f"DROP TRIGGER IF EXISTS {trigger_name}")
+        conn.execute(f"CREATE TRIGGER {trigger_name} {event} BEGIN {body} END")
+    rebuild_search_index(conn)
+
+def rebuild_search_index(conn):
+    """Fill the search index from scratch"""
+    conn.execute("DELETE FROM geraete_fts")
+    conn.execute(_fts_insert_sql("IS NOT NULL"))
+
+# Materialisierte Ausleihzähler. Sie entsprechen genau den Aggregaten
+#   SUM(ad.quantity) ... JOIN ausleihen a ... WHERE a.status = 'ausgeliehen'
+# pro Gerät bzw. pro Gerät und Ausleiher und werden per Trigger gepflegt.
+COUNTER_TABLES = [
+    """CREATE TABLE IF NOT EXISTS geraete_bestand
+         (geraet_id INTEGER PRIMARY KEY,
+           borrowed_quantity INTEGER NOT NULL DEFAULT 0)""",
+    """CREATE TABLE IF NOT EXISTS geraete_ausleiher
+         (geraet_id INTEGER NOT NULL,
+           mitarbeiter_name TEXT NOT NULL,
+           quantity INTEGER NOT NULL DEFAULT 0,
+           PRIMARY KEY (geraet_id, mitarbeiter_name)) WITHOUT ROWID""",
+]
+
+def _counter_delta_sql(select_sql, sign):
+    """Trigger statements that add (sign '+') or subtract (sign '-') borrowed quantities.
+
+    select_sql must select the columns geraet_id, mitarbeiter_name and quantity
+    and end with a WHERE clause (required by the UPSERT syntax).
+    """
+    return f"""
+        INSERT INTO geraete_bestand(geraet_id, borrowed_quantity)
+        SELECT geraet_id, {sign}COALESCE(quantity, 0) FROM ({select_sql}) WHERE 1
+        ON CONFLICT(geraet_id) DO UPDATE SET borrowed_quantity = borrowed_quantity + excluded.borrowed_quantity;
+        INSERT INTO geraete_ausleiher(geraet_id, mitarbeiter_name, quantity)
+        SELECT geraet_id, mitarbeiter_name, {sign}COALESCE(quantity, 0) FROM ({select_sql}) WHERE 1
+        ON CONFLICT(geraet_id, mitarbeiter_name) DO UPDATE SET quantity = quantity + excluded.quantity;
+        DELETE FROM geraete_ausleiher WHERE quantity = 0 AND geraet_id IN (SELECT geraet_id FROM ({select_sql}));"""
+
+def _detail_counter_sql(row, sign):
+    # Eine Ausleih-Position zählt für jede aktive Ausleihe mit ihrer ausleih_id
+    return _counter_delta_sql(f"""SELECT {row}.geraet_id AS geraet_id, a.mitarbeiter_name AS mitarbeiter_name,
+                                         {row}.quantity AS quantity
+                                  FROM ausleihen a WHERE a.ausleih_id = {row}.ausleih_id AND a.status = 'ausgeliehen'""", sign)
+
+def _borrow_counter_sql(row, sign):
+    # Alle Positionen einer Ausleihe, sofern sie aktiv ist
+    return _counter_delta_sql(f"""SELECT ad.geraet_id AS geraet_id, {row}.mitarbeiter_name AS mitarbeiter_name,
+                                         ad.quantity AS quantity
+                                  FROM ausleih_details ad WHERE ad.ausleih_id = {row}.ausleih_id AND {row}.status = 'ausgeliehen'""", sign)
+
+COUNTER_TRIGGERS = {
+    'ausleih_details_counter_ai': ("AFTER INSERT ON ausleih_details", _detail_counter_sql('NEW', '+')),
+    'ausleih_details_counter_ad': ("AFTER DELETE ON ausleih_details", _detail_counter_sql('OLD', '-')),
+    'ausleih_details_counter_au': ("AFTER UPDATE OF geraet_id, ausleih_id, quantity ON ausleih_details",
+                                   _detail_counter_sql('OLD', '-') + _detail_counter_sql('NEW', '+')),
+    'ausleihen_counter_ai': ("AFTER INSERT ON ausleihen", _borrow_counter_sql('NEW', '+')),
+    'ausleihen_counter_ad': ("AFTER DELETE ON ausleihen", _borrow_counter_sql('OLD', '-')),
+    'ausleihen_counter_au': ("AFTER UPDATE OF ausleih_id, status, mitarbeiter_name ON ausleihen",
+                             _borrow_counter_sql('OLD', '-') + _borrow_counter_sql('NEW', '+')),
+}
+
+# Die Aggregate, aus denen die Zähler abgeleitet sind (nur noch für Prüfung und Neuaufbau)
+BORROWED_QUANTITY_AGGREGATE_SQL = """SELECT ad.geraet_id, SUM(ad.quantity)
+    FROM ausleih_details ad JOIN ausleihen a ON ad.ausleih_id = a.ausleih_id
+    WHERE a.status = 'ausgeliehen'
+    GROUP BY ad.geraet_id"""
+BORROWERS_AGGREGATE_SQL = """SELECT ad.geraet_id, a.mitarbeiter_name, SUM(ad.quantity)
+    FROM ausleih_details ad JOIN ausleihen a ON ad.ausleih_id = a.ausleih_id
+    WHERE a.status = 'ausgeliehen'
+    GROUP BY ad.geraet_id, a.mitarbeiter_name"""
+
+def _migrate_warehouse_availability_counters(conn):
+    """Borrow counters per device and borrower"""
+    for statement in COUNTER_TABLES:
+        conn.execute(statement)
+    for trigger_name, (event, body) in COUNTER_TRIGGERS.items():
+        conn.execute(f"DROP TRIGGER IF EXISTS {trigger_name}")
+        conn.execute(f"CREATE TRIGGER {trigger_name} {event} BEGIN {body} END")
+    rebuild_availability_counters(conn)
+
+def rebuild_availability_counters(conn):
+    """Recompute the borrow counters from ausleih_details and ausleihen"""
+    conn.execute("DELETE FROM geraete_bestand")
+    conn.execute("DELETE FROM geraete_ausleiher")
+    conn.execute(f"INSERT INTO geraete_bestand(geraet_id, borrowed_quantity) "
+                 f"SELECT geraet_id, total FROM ({BORROWED_QUANTITY_AGGREGATE_SQL.replace('SUM(ad.quantity)', 'COALESCE(SUM(ad.quantity), 0) AS total')})")
+    conn.execute(f"INSERT INTO geraete_ausleiher(geraet_id, mitarbeiter_name, quantity) "
+                 f"SELECT geraet_id, mitarbeiter_name, total FROM ({BORROWERS_AGGREGATE_SQL.replace('SUM(ad.quantity)', 'COALESCE(SUM(ad.quantity), 0) AS total')}) WHERE total != 0")
+
+def check_availability_counters(conn):
+    """Compare the counters with the aggregate queries. Returns a list of problems."""
+    problems = []
+
+    expected = {geraet_id: total or 0 for geraet_id, total in conn.execute(BORROWED_QUANTITY_AGGREGATE_SQL)}
+    actual = dict(conn.execute("SELECT geraet_id, borrowed_quantity FROM geraete_bestand"))
+    for geraet_id in set(expected) | set(actual):
+        if expected.get(geraet_id, 0) != actual.get(geraet_id, 0):
+            problems.append(f"Gerät {geraet_id}: Zähler {actual.get(geraet_id, 0)}, tatsächlich {expected.get(geraet_id, 0)} ausgeliehen")
+
+    expected = {(geraet_id, name): total or 0 for geraet_id, name, total in conn.execute(BORROWERS_AGGREGATE_SQL)}
+    actual = {(geraet_id, name): quantity for geraet_id, name, quantity in
+              conn.execute("SELECT geraet_id, mitarbeiter_name, quantity FROM geraete_ausleiher")}
+    for key in set(expected) | set(actual):
+        if expected.get(key, 0) != actual.get(key, 0):
+            problems.append(f"Gerät {key[0]}, {key[1]}: Zähler {actual.get(key, 0)}, tatsächlich {expected.get(key, 0)}")
+
+    return problems
+
+def _migrate_users_base_schema(conn):
+    """Base schema of users.db"""
+    ensure_tables_and_columns(conn, USERS_SCHEMA, USERS_TABLES)
+
+# Ausleihlisten (Warenkorb) pro Browser-Sitzung und Lager; die Sitzung hält nur cart_id
+BORROW_CART_TABLES = [
+    """CREATE TABLE IF NOT EXISTS borrow_carts
+         (cart_id TEXT NOT NULL,
+           lager_id TEXT NOT NULL,
+           user_id TEXT,
+           updated_at REAL NOT NULL,
+           PRIMARY KEY (cart_id, lager_id)) WITHOUT ROWID""",
+    """CREATE TABLE IF NOT EXISTS borrow_cart_items
+         (cart_id TEXT NOT NULL,
+           lager_id TEXT NOT NULL,
+           geraet_id INTEGER NOT NULL,
+           position INTEGER NOT NULL,
+           name TEXT,
+           barcode TEXT,
+           quantity INTEGER NOT NULL,
+           max_quantity INTEGER NOT NULL,
+           PRIMARY KEY (cart_id, lager_id, geraet_id)) WITHOUT ROWID""",
+    "CREATE INDEX IF NOT EXISTS idx_borrow_carts_user ON borrow_carts(user_id, lager_id, updated_at)",
+    "CREATE INDEX IF NOT EXISTS idx_borrow_carts_updated ON borrow_carts(updated_at)",
+]
+
+def _migrate_users_borrow_carts(conn):
+    """Borrow lists stored server-side instead of in the session cookie"""
+    for statement in BORROW_CART_TABLES:
+        conn.execute(statement)
+
+def _migrate_users_id_sequences(conn):
+    """ID sequence for warehouse IDs"""
+    _create_id_sequences(conn, ('lager_id',))
+
+# Ausdrucksindizes in der Sortierreihenfolge der Geräteliste (siehe DeviceListPage)
+DEVICE_SORT_INDEXES = [
+    "CREATE INDEX IF NOT EXISTS idx_geraete_sort_name ON geraete(COALESCE(name, ''), id)",
+    "CREATE INDEX IF NOT EXISTS idx_geraete_sort_modell ON geraete(COALESCE(modell, ''), COALESCE(name, ''), id)",
+    "CREATE INDEX IF NOT EXISTS idx_geraete_sort_instrumentenart ON geraete(COALESCE(instrumentenart, ''), COALESCE(name, ''), id)",
+    "CREATE INDEX IF NOT EXISTS idx_geraete_sort_lagerplatz ON geraete(COALESCE(lagerplatz, ''), COALESCE(name, ''), id)",
+    "CREATE INDEX IF NOT EXISTS idx_geraete_sort_status ON geraete(COALESCE(status, ''), COALESCE(name, ''), id)",
+]
+
+def _migrate_warehouse_sort_indexes(conn):
+    """Indexes for the paginated device list"""
+    for statement in DEVICE_SORT_INDEXES:
+        conn.execute(statement)
+
+def _migrate_warehouse_id_sequences(conn):
+    """ID sequences for barcodes and borrow IDs"""
+    _create_id_sequences(conn, ('barcode', 'ausleih_id'))
+
+# Geordnete Migrationsschritte (Version, Funktion). Jeder Schritt muss
+# idempotent sein; neue Schritte werden nur hinten angehängt.
+WAREHOUSE_MIGRATIONS = [
+    (1, _migrate_warehouse_base_schema),
+    (2, _migrate_warehouse_borrow_indexes),
+    (3, _migrate_warehouse_search_index),
+    (4, _migrate_warehouse_availability_counters),
+    (5, _migrate_warehouse_sort_indexes),
+    (6, _migrate_warehouse_id_sequences),
+]
+
+USERS_MIGRATIONS = [
+    (1, _migrate_users_base_schema),
+    (2, _migrate_users_borrow_carts),
+    (3, _migrate_users_id_sequences),
+]
+
+_migration_lock = threading.Lock()
+
+def apply_migrations(db_path, migrations, backup=True):
+    """Run all pending migration steps of a database in order.
+
+    The schema version is stored in PRAGMA user_version, so a database that
+    is already current costs a single integer read. The backup is only taken
+    when at least one step actually runs. Returns False if a step failed.
+    """
+    latest_version = migrations[-1][0]
+    conn = _get_pooled_connection(db_path)
+    try:
+        if conn.execute("PRAGMA user_version").fetchone()[0] >= latest_version:
+            return True
+
+        with _migration_lock:
+            current_version = conn.execute("PRAGMA user_version").fetchone()[0]
+            pending = [(version, step) for version, step in migrations if version > current_version]
+            if not pending:
+                return True
+
+            if backup and conn.execute("SELECT 1 FROM sqlite_master LIMIT 1").fetchone():
+                backup_database(db_path, "migration")
+
+            for version, step in pending:
+                conn.execute("BEGIN IMMEDIATE")
+                try:
+                    # Ein anderer Prozess könnte den Schritt inzwischen ausgeführt haben
+                    if conn.execute("PRAGMA user_version").fetchone()[0] >= version:
+                        conn.rollback()
+                        continue
+                    step(conn)
+                    conn.execute(f"PRAGMA user_version = {int(version)}")
+                    conn.commit()
+                except Exception:
+                    conn.rollback()
+                    raise
+                print(f"Migration {os.path.basename(db_path)}: Version {version} ({step.__doc__ or step.__name__})")
+            forget_warehouse_fts(db_path)
         return True
-    except sqlite3.Error as e:
-        print(f"Fehler beim Hinzufügen der Spalte {column_name}: {e}")
+
+    except Exception as e:
+        print(f"Fehler bei der Migration von {db_path}: {e}")
         return False
+    finally:
+        conn.close()
 
 def check_and_migrate_warehouse_db(lager_id):
-    """Check and migrate a warehouse database with all required columns"""
+    """Check and migrate a warehouse database to the latest schema version"""
     db_path = f'{lager_id}.db'
-    
+
     if not os.path.exists(db_path):
         print(f"Datenbank {db_path} existiert nicht")
         return False
-    
-    # Backup vor Migration
-    backup_database(db_path, "migration")
-    
-    conn = sqlite3.connect(db_path)
-    
+
+    return apply_migrations(db_path, WAREHOUSE_MIGRATIONS)
+
+# Hot-Path-Abfragen und die Indizes, die ihr Abfrageplan benutzen muss
+QUERY_PLAN_CHECKS = [
+    ("Barcodes beim Ausleihen",
+     """SELECT g.id, g.name, g.barcode, g.quantity, COALESCE(geraete_bestand.borrowed_quantity, 0)
+        FROM json_each(?) scanned
+        JOIN geraete g ON g.barcode = scanned.value
+        LEFT JOIN geraete_bestand ON geraete_bestand.geraet_id = g.id""",
+     ('sqlite_autoindex_geraete_1',)),
+    ("Ausleiher pro Gerät",
+     "SELECT mitarbeiter_name, quantity FROM geraete_ausleiher WHERE geraet_id = ? ORDER BY mitarbeiter_name",
+     ()),
+    ("Geräteliste ab Cursor",
+     """SELECT g.* FROM geraete g
+        WHERE COALESCE(g.lagerplatz, '') >= ? AND (COALESCE(g.lagerplatz, ''), COALESCE(g.name, ''), g.id) > (?, ?, ?)
+        ORDER BY COALESCE(g.lagerplatz, ''), COALESCE(g.name, ''), g.id LIMIT 201""",
+     ('idx_geraete_sort_lagerplatz',)),
+    ("Ausleih-Zähler (Trigger)",
+     """SELECT a.mitarbeiter_name FROM ausleihen a WHERE a.ausleih_id = ? AND a.status = 'ausgeliehen'""",
+     ('idx_ausleihen_aktiv|idx_ausleihen_ausleih_id',)),
+    ("Rückgabe per QR-Code",
+     """SELECT g.id, g.name, g.barcode, ad.ausleih_id FROM geraete g
+        JOIN ausleih_details ad ON g.id = ad.geraet_id JOIN ausleihen a ON ad.ausleih_id = a.ausleih_id
+        WHERE a.rueckgabe_qr = ? AND a.status = 'ausgeliehen'""",
+     ('idx_ausleihen_aktiv_qr', 'idx_ausleih_details_ausleihe')),
+    ("Rückgabe per Barcode",
+     """SELECT g.id, g.name, g.barcode, ad.ausleih_id FROM geraete g
+        JOIN ausleih_details ad ON g.id = ad.geraet_id JOIN ausleihen a ON ad.ausleih_id = a.ausleih_id
+        WHERE g.barcode = ? AND a.status = 'ausgeliehen'""",
+     ('idx_ausleih_details_geraet', 'idx_ausleihen_aktiv|idx_ausleihen_ausleih_id')),
+    ("Eigene Ausleihen",
+     """SELECT g.id, g.name, g.barcode, ad.ausleih_id, a.datum FROM geraete g
+        JOIN ausleih_details ad ON g.id = ad.geraet_id JOIN ausleihen a ON ad.ausleih_id = a.ausleih_id
+        WHERE a.mitarbeiter_id = ? AND a.status = 'ausgeliehen' ORDER BY a.datum DESC""",
+     ('idx_ausleihen_aktiv_mitarbeiter', 'idx_ausleih_details_ausleihe')),
+    ("Rückgabe abschließen",
+     "DELETE FROM ausleih_details WHERE ausleih_id = ? AND geraet_id = ?",
+     ('idx_ausleih_details_ausleihe',)),
+    ("Gerätestatus aktualisieren",
+     """UPDATE geraete SET status = COALESCE(
+            (SELECT group_concat(mitarbeiter_name || ' (' || quantity || ')', ', ')
+             FROM (SELECT mitarbeiter_name, quantity FROM geraete_ausleiher
+                   WHERE geraet_id = geraete.id ORDER BY mitarbeiter_name)),
+            'verfügbar')
+        WHERE id IN (SELECT value FROM json_each(?))""",
+     ()),
+    ("Ausleihe nach ID",
+     "SELECT * FROM ausleihen WHERE ausleih_id = ?",
+     ('idx_ausleihen_ausleih_id',)),
+    ("Geräteliste mit Ausleihen",
+     """SELECT g.*, a.mitarbeiter_name, a.zielort, a.datum, a.email, a.klasse FROM geraete g
+        LEFT JOIN ausleih_details ad ON g.id = ad.geraet_id
+        LEFT JOIN ausleihen a ON ad.ausleih_id = a.ausleih_id AND a.status = 'ausgeliehen'
+        WHERE a.klasse IN (?)""",
+     ('idx_ausleih_details_geraet', 'idx_ausleihen_aktiv')),
+]
+
+def verify_query_plans(conn):
+    """Check the hot-path queries with EXPLAIN QUERY PLAN.
+
+    Returns a list of problems. An empty list means every query uses its
+    expected indexes and none of them scans the borrow tables.
+    """
+    problems = []
+    for name, sql, expected_indexes in QUERY_PLAN_CHECKS:
+        plan = [row[3] for row in conn.execute(f"EXPLAIN QUERY PLAN {sql}", (None,) * sql.count('?'))]
+        for index_names in expected_indexes:
+            # 'a|b' bedeutet: einer der beiden Indizes genügt
+            pattern = '|'.join(rf'\b{index_name}\b' for index_name in index_names.split('|'))
+            if not any(re.search(pattern, step) for step in plan):
+                problems.append(f"{name}: Index {index_names} wird nicht benutzt ({'; '.join(plan)})")
+        for step in plan:
+            parts = step.split()
+            if parts[0] == 'SCAN' and parts[1] in ('a', 'ad', 'ausleihen', 'ausleih_details', 'geraete_bestand', 'geraete_ausleiher'):
+                problems.append(f"{name}: Full Table Scan ({step})")
+    return problems
+
+def check_warehouse_query_plans(lager_id):
+    """Print and return query plan problems of a warehouse database"""
+    conn = get_db_connection(lager_id)
     try:
-        # Definiere erwartete Spalten für jede Tabelle
-        expected_schema = {
-            'geraete': {
-                'id': 'INTEGER PRIMARY KEY AUTOINCREMENT',
-                'name': 'TEXT NOT NULL',
-                'barcode': 'TEXT UNIQUE NOT NULL',
-                'lagerplatz': 'TEXT NOT NULL',
-                'status': 'TEXT DEFAULT "verfügbar"',
-                'beschreibung': 'TEXT',
-                'seriennummer': 'TEXT',
-                'modell': 'TEXT',
-                'instrumentenart': 'TEXT',
-                'inventarnummer': 'TEXT',
-                'kaufdatum': 'TEXT',
-                'preis': 'REAL',
-                'quantity': 'INTEGER DEFAULT 1',
-                'hersteller': 'TEXT'
-            },
-            'ausleihen': {
-                'id': 'INTEGER PRIMARY KEY AUTOINCREMENT',
-                'ausleih_id': 'TEXT NOT NULL',
-                'mitarbeiter_id': 'TEXT NOT NULL',
-                'mitarbeiter_name': 'TEXT NOT NULL',
-                'zielort': 'TEXT NOT NULL',
-                'datum': 'TEXT NOT NULL',
-                'rueckgabe_qr': 'TEXT NOT NULL',
-                'status': 'TEXT DEFAULT "ausgeliehen"',
-                'email': 'TEXT',
-                'klasse': 'TEXT'
-            },
-            'ausleih_details': {
-                'id': 'INTEGER PRIMARY KEY AUTOINCREMENT',
-                'ausleih_id': 'TEXT NOT NULL',
-                'geraet_id': 'INTEGER NOT NULL',
-                'geraet_barcode': 'TEXT NOT NULL',
-                'quantity': 'INTEGER DEFAULT 1'
-            },
-            'label_layouts': {
-                'id': 'INTEGER PRIMARY KEY AUTOINCREMENT',
-                'name': 'TEXT NOT NULL',
-                'layout_data': 'TEXT NOT NULL',
-                'is_default': 'INTEGER DEFAULT 0',
-                'created_at': 'TEXT DEFAULT CURRENT_TIMESTAMP',
-                'updated_at': 'TEXT DEFAULT CURRENT_TIMESTAMP'
-            }
-        }
-        
-        changes_made = False
-        
-        # Prüfe jede Tabelle
-        for table_name, expected_columns in expected_schema.items():
-            # Prüfe ob Tabelle existiert
-            cursor = conn.cursor()
-            cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name=?", (table_name,))
-            
-            if not cursor.fetchone():
-                print(f"Tabelle {table_name} existiert nicht - wird erstellt")
-                # Tabelle erstellen (hier könntest du die CREATE TABLE Statements einfügen)
-                if table_name == 'geraete':
-                    cursor.execute('''CREATE TABLE geraete
-                                     (id INTEGER PRIMARY KEY AUTOINCREMENT,
-                                       name TEXT NOT NULL,
-                                       barcode TEXT UNIQUE NOT NULL,
-                                       lagerplatz TEXT NOT NULL,
-                                       status TEXT DEFAULT 'verfügbar',
-                                       beschreibung TEXT,
-                                       seriennummer TEXT,
-                                       modell TEXT,
-                                       instrumentenart TEXT,
-                                       inventarnummer TEXT,
-                                       kaufdatum TEXT,
-                                       preis REAL,
-                                       quantity INTEGER DEFAULT 1,
-                                       hersteller TEXT)''')
-                elif table_name == 'ausleihen':
-                    cursor.execute('''CREATE TABLE ausleihen
-                                     (id INTEGER PRIMARY KEY AUTOINCREMENT,
-                                       ausleih_id TEXT NOT NULL,
-                                       mitarbeiter_id TEXT NOT NULL,
-                                       mitarbeiter_name TEXT NOT NULL,
-                                       zielort TEXT NOT NULL,
-                                       datum TEXT NOT NULL,
-                                       rueckgabe_qr TEXT NOT NULL,
-                                       status TEXT DEFAULT 'ausgeliehen',
-                                       email TEXT,
-                                       klasse TEXT)''')
-                elif table_name == 'ausleih_details':
-                    cursor.execute('''CREATE TABLE ausleih_details
-                                     (id INTEGER PRIMARY KEY AUTOINCREMENT,
-                                       ausleih_id TEXT NOT NULL,
-                                       geraet_id INTEGER NOT NULL,
-                                       geraet_barcode TEXT NOT NULL,
-                                       quantity INTEGER DEFAULT 1,
-                                       FOREIGN KEY(ausleih_id) REFERENCES ausleihen(ausleih_id),
-                                       FOREIGN KEY(geraet_id) REFERENCES geraete(id))''')
-                elif table_name == 'label_layouts':
-                    cursor.execute('''CREATE TABLE label_layouts
-                                     (id INTEGER PRIMARY KEY AUTOINCREMENT,
-                                       name TEXT NOT NULL,
-                                       layout_data TEXT NOT NULL,
-                                       is_default INTEGER DEFAULT 0,
-                                       created_at TEXT DEFAULT CURRENT_TIMESTAMP,
-                                       updated_at TEXT DEFAULT CURRENT_TIMESTAMP)''')
-                conn.commit()
-                changes_made = True
-                continue
-            
-            # Hole aktuelle Spalten
-            current_columns = get_table_columns(conn, table_name)
-            
-            # Prüfe fehlende Spalten
-            for column_name, column_type in expected_columns.items():
-                if column_name not in current_columns:
-                    print(f"Fehlende Spalte erkannt: {table_name}.{column_name}")
-                    
-                    # Extrahiere DEFAULT-Wert wenn vorhanden
-                    default_value = None
-                    if 'DEFAULT' in column_type:
-                        parts = column_type.split('DEFAULT')
-                        column_type = parts[0].strip()
-                        default_value = parts[1].strip().strip("'\"")
-                        if default_value.upper() != 'CURRENT_TIMESTAMP':
-                            default_value = f"'{default_value}'"
-                    
-                    if add_missing_column(conn, table_name, column_name, column_type, default_value):
-                        changes_made = True
-        
-        if changes_made:
-            print(f"Migration für {lager_id} abgeschlossen")
-        else:
-            print(f"Keine Änderungen für {lager_id} erforderlich")
-        
-        return True
-        
-    except Exception as e:
-        print(f"Fehler bei der Migration: {e}")
-        return False
+        problems = verify_query_plans(conn)
     finally:
         conn.close()
+    for problem in problems:
+        print(f"Abfrageplan-Warnung ({lager_id}): {problem}")
+    return problems
 
 def check_and_migrate_users_db():
     """Check and migrate the users database"""
-    db_path = 'users.db'
-    
-    if not os.path.exists(db_path):
+    if not os.path.exists('users.db'):
         print("users.db existiert nicht - wird initialisiert")
         init_user_db()
         return
-    
-    backup_database(db_path, "migration")
-    
-    conn = sqlite3.connect(db_path)
-    
-    try:
-        # Erwartete Spalten für users.db
-        expected_schema = {
-            'users': {
-                'id': 'TEXT PRIMARY KEY',
-                'name': 'TEXT NOT NULL'
-            },
-            'lager': {
-                'id': 'TEXT PRIMARY KEY',
-                'name': 'TEXT NOT NULL',
-                'created_by': 'TEXT',
-                'access_users': 'TEXT',
-                'system_type': 'TEXT DEFAULT "personal"'
-            }
-        }
-        
-        changes_made = False
-        
-        for table_name, expected_columns in expected_schema.items():
-            cursor = conn.cursor()
-            cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name=?", (table_name,))
-            
-            if not cursor.fetchone():
-                print(f"Tabelle {table_name} in users.db existiert nicht - wird erstellt")
-                if table_name == 'users':
-                    cursor.execute('''CREATE TABLE IF NOT EXISTS users
-                                     (id TEXT PRIMARY KEY, name TEXT NOT NULL)''')
-                elif table_name == 'lager':
-                    cursor.execute('''CREATE TABLE IF NOT EXISTS lager
-                                     (id TEXT PRIMARY KEY, name TEXT NOT NULL, created_by TEXT,
-                                       access_users TEXT, system_type TEXT DEFAULT 'personal')''')
-                conn.commit()
-                changes_made = True
-                continue
-            
-            current_columns = get_table_columns(conn, table_name)
-            
-            for column_name, column_type in expected_columns.items():
-                if column_name not in current_columns:
-                    print(f"Fehlende Spalte in users.db erkannt: {table_name}.{column_name}")
-                    
-                    default_value = None
-                    if 'DEFAULT' in column_type:
-                        parts = column_type.split('DEFAULT')
-                        column_type = parts[0].strip()
-                        default_value = parts[1].strip().strip("'\"")
-                        default_value = f"'{default_value}'"
-                    
-                    if add_missing_column(conn, table_name, column_name, column_type, default_value):
-                        changes_made = True
-        
-        if changes_made:
-            print("Migration für users.db abgeschlossen")
-        else:
-            print("Keine Änderungen für users.db erforderlich")
-            
-    except Exception as e:
-        print(f"Fehler bei der users.db Migration: {e}")
-    finally:
-        conn.close()
+
+    apply_migrations('users.db', USERS_MIGRATIONS)
 
 def auto_migrate_all_databases():
     """Automatically check and migrate all databases"""
@@ -633,10 +926,10 @@ def auto_migrate_all_databases():
     for file in os.listdir('.'):
         if file.endswith('.db') and file != 'users.db':
             lager_id = file[:-3]  # Entferne .db
-            print(f"\nPrüfe Lager-Datenbank: {lager_id}")
-            check_and_migrate_warehouse_db(lager_id)
+            if check_and_migrate_warehouse_db(lager_id):
+                check_warehouse_query_plans(lager_id)
     
-    print("\n=== Migration abgeschlossen ===")
+    print("=== Migration abgeschlossen ===")
 
 def migrate_warehouse_db(lager_id):
        check_and_migrate_warehouse_db(lager_id)
@@ -644,22 +937,609 @@ def migrate_warehouse_db(lager_id):
 def generate_random_id(length=6):
     return ''.join(random.choices(string.digits, k=length))
 
+#------------------------ID Allocator--------------------------------------
+
+# Sequenzname -> Stellenzahl der IDs. Ist ein Stellenbereich aufgebraucht,
+# geht es mit einer Stelle mehr weiter; kürzere und längere IDs können nie gleich sein.
+ID_SEQUENCE_DIGITS = {
+    'barcode': 6,      # Lager-Datenbank
+    'ausleih_id': 4,   # Lager-Datenbank
+    'lager_id': 8,     # users.db
+}
+
+# Sequenzname -> (Tabelle, Spalte) mit den bereits vergebenen IDs
+ID_SEQUENCE_COLUMNS = {
+    'barcode': ('geraete', 'barcode'),
+    'ausleih_id': ('ausleihen', 'ausleih_id'),
+    'lager_id': ('lager', 'id'),
+}
+
+ID_SEQUENCES_TABLE = """CREATE TABLE IF NOT EXISTS id_sequences
+     (name TEXT PRIMARY KEY,
+       next_value INTEGER NOT NULL,
+       seed INTEGER NOT NULL)"""
+
+def _create_id_sequences(conn, names):
+    """Create the sequences in a database, starting in the standard digit tier"""
+    conn.execute(ID_SEQUENCES_TABLE)
+    for name in names:
+        conn.execute("INSERT OR IGNORE INTO id_sequences (name, next_value, seed) VALUES (?, 0, ?)",
+                     (name, secrets.randbits(62)))
+
+def _feistel(value, half_bits, seed):
+    """Balanced Feistel network: a keyed permutation of [0, 2 ** (2 * half_bits))"""
+    mask = (1 << half_bits) - 1
+    key = seed.to_bytes(8, 'big')
+    left, right = value >> half_bits, value & mask
+    for round_index in range(4):
+        digest = hashlib.blake2b(f"{round_index}:{right}".encode(), digest_size=8, key=key).digest()
+        left, right = right, left ^ (int.from_bytes(digest, 'big') & mask)
+    return (left << half_bits) | right
+
+def scramble_id(value, digits, seed):
+    """Map a sequence value to a unique, non-sequential ID string.
+
+    Each digit tier [0, 10 ** digits) is permuted by the Feistel network with
+    cycle walking, so distinct values always give distinct IDs.
+    """
+    while value >= 10 ** digits:
+        value -= 10 ** digits
+        digits += 1
+    domain = 10 ** digits
+    half_bits = ((domain - 1).bit_length() + 1) // 2
+    value = _feistel(value, half_bits, seed)
+    while value >= domain:
+        value = _feistel(value, half_bits, seed)
+    return str(value).zfill(digits)
+
+def allocate_ids(conn, name, count=1):
+    """Reserve a block of sequence values and return count unused IDs.
+
+    Runs in the caller's transaction: the UPDATE takes the write lock, so
+    concurrent workers get disjoint blocks. IDs that are already taken are
+    skipped with one lookup per block.
+    """
+    # Daten von vor den Sequenzen enthalten zufällige IDs mit derselben Stellenzahl
+    table, column = ID_SEQUENCE_COLUMNS[name]
+    digits = ID_SEQUENCE_DIGITS[name]
+    ids = []
+    while len(ids) < count:
+        needed = count - len(ids)
+        next_value, seed = conn.execute("UPDATE id_sequences SET next_value = next_value + ? WHERE name = ? RETURNING next_value, seed",
+                                        (needed, name)).fetchone()
+        candidates = [scramble_id(value, digits, seed) for value in range(next_value - needed, next_value)]
+        taken = {row[0] for row in conn.execute(f"SELECT {column} FROM {table} WHERE {column} IN (SELECT value FROM json_each(?))",
+                                                (json.dumps(candidates),))}
+        ids.extend(candidate for candidate in candidates if candidate not in taken)
+    return ids
+
+def allocate_id(conn, name):
+    return allocate_ids(conn, name)[0]
+
+#------------------------ID Allocator end----------------------------------
+
+#------------------------Connection Pool-----------------------------------
+
+# Einstellungen, die jede gepoolte Verbindung genau einmal beim Öffnen bekommt
+DB_PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA mmap_size=268435456",
+    "PRAGMA cache_size=-16384",
+    "PRAGMA busy_timeout=5000",
+)
+DB_POOL_MAX_IDLE = 8        # freie Verbindungen pro Datenbankdatei
+DB_IDLE_TIMEOUT = 300       # Sekunden, bis eine freie Verbindung geschlossen wird
+
+_db_pool = {}               # db_path -> [(connection, zuletzt_benutzt), ...]
+_db_pool_lock = threading.Lock()
+_retired_db_paths = set()   # gelöschte Datenbanken: keine neuen Verbindungen, zurückgegebene werden geschlossen
+_db_reaper_started = False
+
+
+class PooledConnection(sqlite3.Connection):
+    """SQLite connection from the pool.
+
+    close() returns the connection to the pool instead of closing it. Within
+    a request all callers share one connection, which goes back to the pool
+    when the request ends.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.db_path = None
+        self.refs = 0
+        self.request_scoped = False
+
+    def close(self):
+        self.refs = max(0, self.refs - 1)
+        if self.refs:
+            return
+        # Nicht committete Änderungen verwerfen, wie es ein echtes close() täte
+        if self.in_transaction:
+            self.rollback()
+        if not self.request_scoped:
+            release_db_connection(self)
+
+
+def _open_db_connection(db_path):
+    conn = sqlite3.connect(db_path, factory=PooledConnection, check_same_thread=False, timeout=5)
+    for pragma in DB_PRAGMAS:
+        conn.execute(pragma)
+    conn.db_path = db_path
+    return conn
+
+def _checkout_db_connection(db_path):
+    conn = None
+    with _db_pool_lock:
+        if db_path in _retired_db_paths:
+            raise sqlite3.OperationalError(f"Datenbank {db_path} wurde gelöscht")
+        idle = _db_pool.get(db_path)
+        if idle:
+            conn = idle.pop()[0]
+    if conn is None:
+        conn = _open_db_connection(db_path)
+    _start_db_reaper()
+    return conn
+
+def release_db_connection(conn):
+    """Give a connection back to the pool, or close it if the pool is full"""
+    if conn.in_transaction:
+        conn.rollback()
+    conn.refs = 0
+    conn.request_scoped = False
+    with _db_pool_lock:
+        idle = _db_pool.setdefault(conn.db_path, [])
+        if len(idle) < DB_POOL_MAX_IDLE and conn.db_path not in _retired_db_paths:
+            idle.append((conn, time.monotonic()))
+            return
+    sqlite3.Connection.close(conn)
+
+def close_idle_db_connections(max_idle=DB_IDLE_TIMEOUT, db_path=None):
+    """Close pooled connections that were idle for at least max_idle seconds"""
+    now = time.monotonic()
+    expired = []
+    with _db_pool_lock:
+        for path, idle in _db_pool.items():
+            if db_path is not None and path != db_path:
+                continue
+            expired.extend(conn for conn, last_used in idle if now - last_used >= max_idle)
+            idle[:] = [(conn, last_used) for conn, last_used in idle if now - last_used < max_idle]
+    for conn in expired:
+        sqlite3.Connection.close(conn)
+        forget_warehouse_fts(conn.db_path)
+
+def retire_db_path(db_path):
+    """Stop pooling a database that is about to be deleted.
+
+    Idle connections are closed now, connections still checked out are
+    closed when they are returned, and new checkouts fail.
+    """
+    with _db_pool_lock:
+        _retired_db_paths.add(db_path)
+        idle = _db_pool.pop(db_path, [])
+    for conn, last_used in idle:
+        sqlite3.Connection.close(conn)
+    forget_warehouse_fts(db_path)
+
+def reopen_db_path(db_path):
+    """Allow connections to a database path again (a new database was created there)"""
+    with _db_pool_lock:
+        _retired_db_paths.discard(db_path)
+    forget_warehouse_fts(db_path)
+
+def _db_reaper_loop():
+    while True:
+        time.sleep(max(1, DB_IDLE_TIMEOUT // 2))
+        close_idle_db_connections()
+
+def _start_db_reaper():
+    global _db_reaper_started
+    if _db_reaper_started:
+        return
+    with _db_pool_lock:
+        if _db_reaper_started:
+            return
+        _db_reaper_started = True
+    threading.Thread(target=_db_reaper_loop, name='db-pool-reaper', daemon=True).start()
+
+def _get_pooled_connection(db_path):
+    if not has_app_context():
+        conn = _checkout_db_connection(db_path)
+        conn.refs = 1
+        return conn
+
+    connections = g.setdefault('_db_connections', {})
+    conn = connections.get(db_path)
+    if conn is None:
+        conn = _checkout_db_connection(db_path)
+        conn.request_scoped = True
+        connections[db_path] = conn
+    conn.refs += 1
+    return conn
+
+@app.teardown_appcontext
+def release_request_db_connections(exc):
+    for conn in g.pop('_db_connections', {}).values():
+        release_db_connection(conn)
+
 def get_db_connection(lager_id):
-    return sqlite3.connect(f'{lager_id}.db')
+    return _get_pooled_connection(f'{lager_id}.db')
 
-def generate_qr_code(data):
-    qr = qrcode.QRCode(version=1, box_size=10, border=5)
-    qr.add_data(data)
-    qr.make(fit=True)
-    img = qr.make_image(fill_color="black", back_color="white")
-    buffer = io.BytesIO()
-    img.save(buffer, format='PNG')
-    buffer.seek(0)
-    img_str = base64.b64encode(buffer.getvalue()).decode()
-    return f"data:image/png;base64,{img_str}"
+def get_users_db_connection():
+    return _get_pooled_connection('users.db')
+
+def copy_database(src_path, dest_path):
+    """Consistent copy of a (WAL) database via the SQLite online backup API"""
+    src = _get_pooled_connection(src_path)
+    dest = sqlite3.connect(dest_path)
+    try:
+        src.backup(dest)
+    finally:
+        dest.close()
+        src.close()
+
+#------------------------Connection Pool end-------------------------------
+
+_fts_available = {}  # db_path -> bool
+
+def warehouse_has_fts(conn):
+    if conn.db_path not in _fts_available:
+        _fts_available[conn.db_path] = conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'geraete_fts'").fetchone() is not None
+    return _fts_available[conn.db_path]
+
+def forget_warehouse_fts(db_path):
+    """Drop the cached FTS check, e.g. when the database file may have been replaced or migrated"""
+    _fts_available.pop(db_path, None)
+
+
+#------------------------Device List---------------------------------------
+
+DEVICE_PAGE_SIZE = int(os.getenv('DMS_DEVICE_PAGE_SIZE', 200))
+
+# sort_by -> Spalte; innerhalb gleicher Werte wird immer nach Name und ID sortiert
+DEVICE_SORT_COLUMNS = {
+    'name': 'g.name',
+    'model': 'g.modell',
+    'instrumentenart': 'g.instrumentenart',
+    'lagerplatz': 'g.lagerplatz',
+    'status': 'g.status',
+}
+
+# group_by -> Gruppenname als SQL-Ausdruck
+DEVICE_GROUP_EXPRESSIONS = {
+    'model': "COALESCE(NULLIF(g.modell, ''), 'Unbekanntes Modell')",
+    'series': "COALESCE(NULLIF(g.inventarnummer, ''), 'Unbekanntes Instrument')",
+    'serial': "COALESCE(UPPER(SUBSTR(NULLIF(g.seriennummer, ''), 1, 1)), 'Unbekannt')",
+    'instrument': "COALESCE(NULLIF(g.instrumentenart, ''), 'Unbekanntes Instrument')",
+    'status': "CASE WHEN g.status = 'verfügbar' THEN 'Verfügbar' ELSE 'Ausgeliehen' END",
+}
+
+# Suchmodus -> Bedingung. Trigramme brauchen mindestens drei Zeichen, kürzere
+# Suchbegriffe (oder Lager ohne FTS5) suchen mit LIKE über dieselben Felder.
+DEVICE_SEARCH_CONDITIONS = {
+    'fts': "g.id IN (SELECT rowid FROM geraete_fts WHERE geraete_fts MATCH ?)",
+    'like': ("(g.name LIKE ? OR g.barcode LIKE ? OR g.lagerplatz LIKE ? OR g.seriennummer LIKE ? OR g.modell LIKE ? "
+             "OR g.instrumentenart LIKE ? OR a.mitarbeiter_name LIKE ? OR a.klasse LIKE ?)"),
+}
+
+DEVICE_STATUS_CONDITIONS = {
+    'verfügbar': "g.status = 'verfügbar'",
+    'ausgeliehen': "g.status LIKE 'ausgeliehen%'",
+}
+
+# Feldname -> Spalte, in der Reihenfolge von geraete (entspricht g.*)
+DEVICE_FIELDS = {
+    'id': 'g.id', 'name': 'g.name', 'barcode': 'g.barcode', 'lagerplatz': 'g.lagerplatz', 'status': 'g.status',
+    'beschreibung': 'g.beschreibung', 'seriennummer': 'g.seriennummer', 'modell': 'g.modell',
+    'instrumentenart': 'g.instrumentenart', 'inventarnummer': 'g.inventarnummer', 'kaufdatum': 'g.kaufdatum',
+    'preis': 'g.preis', 'quantity': 'g.quantity', 'hersteller': 'g.hersteller',
+}
+INVENTORY_FIELDS = dict(DEVICE_FIELDS, mitarbeiter_name='a.mitarbeiter_name', zielort='a.zielort',
+                        datum='a.datum', email='a.email', klasse='a.klasse')
+
+DeviceListView = namedtuple('DeviceListView', 'fields from_sql tiebreak template')
+DEVICE_LIST_VIEWS = {
+    'devices': DeviceListView(DEVICE_FIELDS, "geraete g", None, 'devices_list.html'),
+    'inventory': DeviceListView(INVENTORY_FIELDS,
+                                """geraete g
+                                   LEFT JOIN ausleih_details ad ON g.id = ad.geraet_id
+                                   LEFT JOIN ausleihen a ON ad.ausleih_id = a.ausleih_id AND a.status = 'ausgeliehen'""",
+                                "COALESCE(ad.id, 0)", 'inventory_list.html'),
+}
+
+DeviceGroup = namedtuple('DeviceGroup', 'name total available continued devices')
+
+# Kanonische Form eines Filters: alles, was das SQL verändert, aber keine Parameterwerte
+DeviceQueryKey = namedtuple('DeviceQueryKey', 'view fields search_mode status art klasse sort_by group_by')
+
+CompiledDeviceQuery = namedtuple('CompiledDeviceQuery',
+                                 'key row_type param_layout group_expr key_exprs rows_sql rows_after_sql totals_sql')
+
+_device_row_types = {}
+
+def device_row_type(fields):
+    """Row class for a field list. Rows stay tuples, so index access keeps working."""
+    if fields not in _device_row_types:
+        _device_row_types[fields] = namedtuple('DeviceRow', fields)
+    return _device_row_types[fields]
+
+def device_query_key(conn, view, filters, fields=None):
+    """Normalize a filter set (see device_list_filters) to its DeviceQueryKey"""
+    spec = DEVICE_LIST_VIEWS[view]
+    search = filters['search']
+    if not search:
+        search_mode = None
+    elif len(search) >= 3 and warehouse_has_fts(conn):
+        search_mode = 'fts'
+    else:
+        search_mode = 'like'
+    return DeviceQueryKey(
+        view=view,
+        fields=tuple(name for name in fields if name in spec.fields) if fields else tuple(spec.fields),
+        search_mode=search_mode,
+        status=tuple(status for status in DEVICE_STATUS_CONDITIONS if status in filters['status_filters']),
+        art=bool(filters['art_filters']),
+        klasse=bool(filters['klasse_filters']),
+        sort_by=filters['sort_by'] if filters['sort_by'] in DEVICE_SORT_COLUMNS else 'name',
+        group_by=filters['group_by'] if filters['group_by'] in DEVICE_GROUP_EXPRESSIONS else 'none',
+    )
+
+@lru_cache(maxsize=256)
+def compile_device_query(key):
+    """Build the SQL for a DeviceQueryKey once.
+
+    The statements only depend on the key. Filter values are bound as
+    parameters in the order of param_layout, list filters as one JSON array,
+    so the same key always yields the same SQL text and sqlite3 can reuse its
+    prepared statements.
+    """
+    spec = DEVICE_LIST_VIEWS[key.view]
+    conditions = []
+    param_layout = []
+
+    if key.search_mode:
+        conditions.append(DEVICE_SEARCH_CONDITIONS[key.search_mode])
+        param_layout.append(key.search_mode)
+    if key.status:
+        conditions.append(f"({' OR '.join(DEVICE_STATUS_CONDITIONS[status] for status in key.status)})")
+    if key.art:
+        conditions.append("g.instrumentenart IN (SELECT value FROM json_each(?))")
+        param_layout.append('art')
+    if key.klasse:
+        conditions.append("a.klasse IN (SELECT value FROM json_each(?))")
+        param_layout.append('klasse')
+
+    if key.view == 'devices' and (key.search_mode == 'like' or key.klasse):
+        # Über die ID filtern statt DISTINCT, damit jedes Gerät nur einmal kommt
+        conditions = [f"""g.id IN (SELECT g.id FROM {DEVICE_LIST_VIEWS['inventory'].from_sql}
+                                   WHERE {' AND '.join(conditions)})"""]
+    where_sql = ' AND '.join(conditions) or '1=1'
+
+    group_expr = DEVICE_GROUP_EXPRESSIONS.get(key.group_by)
+    key_exprs = [group_expr] if group_expr else []
+    sort_column = DEVICE_SORT_COLUMNS[key.sort_by]
+    if sort_column != 'g.name':
+        key_exprs.append(f"COALESCE({sort_column}, '')")
+    key_exprs += ["COALESCE(g.name, '')", "g.id"]
+    if spec.tiebreak:
+        key_exprs.append(spec.tiebreak)
+
+    select_sql = ', '.join([spec.fields[name] for name in key.fields] + key_exprs)
+    order_sql = ', '.join(key_exprs)
+    # Die einzelne Schranke auf der ersten Spalte lässt SQLite im Index springen;
+    # der Zeilenvergleich allein würde den Index von vorne durchlaufen
+    after_sql = f"{key_exprs[0]} >= ? AND ({order_sql}) > ({', '.join('?' for _ in key_exprs)})"
+
+    return CompiledDeviceQuery(
+        key=key,
+        row_type=device_row_type(key.fields),
+        param_layout=tuple(param_layout),
+        group_expr=group_expr,
+        key_exprs=tuple(key_exprs),
+        rows_sql=f"SELECT {select_sql} FROM {spec.from_sql} WHERE {where_sql} ORDER BY {order_sql} LIMIT ?",
+        rows_after_sql=f"SELECT {select_sql} FROM {spec.from_sql} WHERE {where_sql} AND {after_sql} ORDER BY {order_sql} LIMIT ?",
+        totals_sql=(f"SELECT {group_expr}, COUNT(*), SUM(g.status = 'verfügbar') FROM {spec.from_sql} "
+                    f"WHERE {where_sql} GROUP BY 1") if group_expr else None,
+    )
+
+def device_query_params(query, filters):
+    """Parameter values for a compiled query, in the order of its param_layout"""
+    params = []
+    for slot in query.param_layout:
+        if slot == 'fts':
+            params.append('"' + filters['search'].replace('"', '""') + '"')
+        elif slot == 'like':
+            params.extend([f"%{filters['search']}%"] * 8)
+        elif slot == 'art':
+            params.append(json.dumps(filters['art_filters']))
+        elif slot == 'klasse':
+            params.append(json.dumps(filters['klasse_filters']))
+    return params
+
+def device_rows(conn, query, params, after=None, limit=-1):
+    """Yield (row, sort key) for a compiled query, optionally starting after a sort key"""
+    if after:
+        c = conn.execute(query.rows_after_sql, params + [after[0]] + list(after) + [limit])
+    else:
+        c = conn.execute(query.rows_sql, params + [limit])
+    row_type = query.row_type
+    key_length = len(query.key_exprs)
+    try:
+        while True:
+            rows = c.fetchmany(100)
+            if not rows:
+                break
+            for row in rows:
+                yield row_type._make(row[:-key_length]), row[-key_length:]
+    finally:
+        c.close()
+
+
+class DeviceListPage:
+    """One page of the device list, read lazily while the template streams.
+
+    Rows are ordered by the query's sort key (group, sort column, name, id
+    and for the inventory the borrow detail) and a page starts right after
+    the key of the previous page's last row (keyset pagination), so no page
+    has to read the rows before it. Group totals come from one aggregate over
+    the whole filter, so group headers stay correct across page boundaries.
+    """
+
+    def __init__(self, conn, query, params, cursor=None, page_size=None):
+        self.conn = conn
+        self.query = query
+        self.params = list(params)
+        self.page_size = page_size or DEVICE_PAGE_SIZE
+        self.group_expr = query.group_expr
+        self.signature = f"{query.key.sort_by}/{query.key.group_by}"
+        self.cursor = self.decode_cursor(cursor)
+        self.next_cursor = None
+        self.endpoint = None    # Seite, auf die Weiter/Zum Anfang verlinken (Standard: aktueller Endpoint)
+
+    def decode_cursor(self, cursor):
+        if not cursor:
+            return None
+        try:
+            data = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+        except ValueError:
+            return None
+        if not isinstance(data, dict) or data.get('s') != self.signature:
+            return None
+        key = data.get('k')
+        if not isinstance(key, list) or len(key) != len(self.query.key_exprs):
+            return None
+        return key
+
+    def encode_cursor(self, key):
+        data = json.dumps({'s': self.signature, 'k': list(key)}, separators=(',', ':'))
+        return base64.urlsafe_b64encode(data.encode()).decode().rstrip('=')
+
+    def _rows(self):
+        """Yield (device, key) for this page and remember where the next one starts"""
+        count = 0
+        for device, key in device_rows(self.conn, self.query, self.params, self.cursor, self.page_size + 1):
+            count += 1
+            if count > self.page_size:
+                self.next_cursor = self.encode_cursor(last_key)
+                return
+            last_key = key
+            yield device, key
+
+    def __iter__(self):
+        for device, key in self._rows():
+            yield device
+
+    def group_totals(self):
+        """Group name -> (rows, available rows) over the whole filter"""
+        c = self.conn.execute(self.query.totals_sql, self.params)
+        return {name: (total, available or 0) for name, total, available in c.fetchall()}
+
+    def groups(self):
+        totals = self.group_totals()
+        continued_group = self.cursor[0] if self.cursor else None
+        for name, rows in groupby(self._rows(), key=lambda item: item[1][0]):
+            total, available = totals.get(name, (0, 0))
+            yield DeviceGroup(name, total, available, name == continued_group, (device for device, key in rows))
+
+    def _page_url(self, cursor):
+        args = request.args.to_dict(flat=False)
+        for name in ('cursor', 'view', 'format', 'fields'):
+            args.pop(name, None)
+        if cursor:
+            args['cursor'] = cursor
+        return url_for(self.endpoint or request.endpoint, **args)
+
+    @property
+    def next_url(self):
+        """Link to the next page; only known once this page has been read"""
+        return self._page_url(self.next_cursor) if self.next_cursor else None
+
+    @property
+    def first_url(self):
+        return self._page_url(None) if self.cursor else None
+
+def device_list_filters():
+    """Filter, sort and group parameters of the device list from the request"""
+    return {
+        'search': request.args.get('search', ''),
+        'status_filters': [f for f in request.args.getlist('status') if f],
+        'art_filters': [f for f in request.args.getlist('art') if f],
+        'klasse_filters': [f for f in request.args.getlist('klasse') if f],
+        'sort_by': request.args.get('sort_by', 'name'),
+        'group_by': request.args.get('group_by', 'none'),
+    }
+
+def device_query(conn, view, filters, fields=None):
+    """Compiled query and parameters for a filter set"""
+    query = compile_device_query(device_query_key(conn, view, filters, fields))
+    return query, device_query_params(query, filters)
+
+def device_list_page(conn, view, filters, fields=None):
+    """DeviceListPage for /devices, /inventory and /api/devices.
+
+    fields limits the selected columns (see DEVICE_FIELDS); by default all of
+    them are selected in table order, so templates can keep indexing rows.
+    """
+    query, params = device_query(conn, view, filters, fields)
+    page = DeviceListPage(conn, query, params, cursor=request.args.get('cursor'))
+    page.endpoint = view
+    return page
+
+# Filterwerte mit Anzahl pro Lager. Schreibzugriffe über warehouse_changed()
+# verwerfen den Eintrag; die TTL fängt Änderungen aus anderen Prozessen ab.
+FACET_CACHE_TTL = int(os.getenv('DMS_FACET_CACHE_TTL', 300))
+
+_facet_cache = {}   # lager_id -> (geladen_um, facets)
+_facet_generations = {}   # lager_id -> Zähler, erhöht bei jeder Invalidierung
+_facet_cache_lock = threading.Lock()
+
+def get_filter_facets(lager_id):
+    """Filter values with counts: {'instrumentenart': [(wert, anzahl), ...], 'klasse': [...]}
+
+    instrumentenart counts devices, klasse counts devices that are currently
+    borrowed by that class (which is what the klasse filter matches).
+    """
+    now = time.monotonic()
+    with _facet_cache_lock:
+        cached = _facet_cache.get(lager_id)
+        generation = _facet_generations.get(lager_id, 0)
+    if cached and now - cached[0] < FACET_CACHE_TTL:
+        return cached[1]
+
+    conn = get_db_connection(lager_id)
+    facets = {
+        'instrumentenart': conn.execute("""SELECT instrumentenart, COUNT(*) FROM geraete
+                                           WHERE instrumentenart IS NOT NULL
+                                           GROUP BY instrumentenart ORDER BY instrumentenart""").fetchall(),
+        'klasse': conn.execute("""SELECT a.klasse, COUNT(DISTINCT ad.geraet_id)
+                                  FROM ausleihen a JOIN ausleih_details ad ON ad.ausleih_id = a.ausleih_id
+                                  WHERE a.status = 'ausgeliehen' AND a.klasse IS NOT NULL
+                                  GROUP BY a.klasse ORDER BY a.klasse""").fetchall(),
+    }
+    conn.close()
+
+    with _facet_cache_lock:
+        # Wurde während der Abfrage invalidiert, kann das Ergebnis schon veraltet sein
+        if _facet_generations.get(lager_id, 0) == generation:
+            _facet_cache[lager_id] = (now, facets)
+    return facets
+
+def invalidate_filter_facets(lager_id):
+    with _facet_cache_lock:
+        _facet_cache.pop(lager_id, None)
+        _facet_generations[lager_id] = _facet_generations.get(lager_id, 0) + 1
+
+def warehouse_changed(lager_id, operation):
+    """Call after every committed write to a warehouse: drops cached data and schedules a backup"""
+    invalidate_filter_facets(lager_id)
+    backup_db(lager_id, operation)
+
+#------------------------Device List end-----------------------------------
 
 def get_lager_system_type(lager_id):
-    conn = sqlite3.connect('users.db')
+    conn = get_users_db_connection()
     c = conn.cursor()
     c.execute("SELECT system_type FROM lager WHERE id = ?", (lager_id,))
     result = c.fetchone()
@@ -667,10 +1547,117 @@ def get_lager_system_type(lager_id):
     return result[0] if result else 'personal'
 
 
+#------------------------Backups-------------------------------------------
+
+# Schreibzugriffe markieren ein Lager nur zum Backup. Ein Hintergrund-Thread
+# fasst Schreib-Bursts zu einem Snapshot zusammen und räumt alte Backups auf.
+BACKUP_DIR = 'backups'
+BACKUP_COALESCE_SECONDS = int(os.getenv('DMS_BACKUP_COALESCE_SECONDS', 30))    # Ruhezeit nach dem letzten Schreibzugriff
+BACKUP_MAX_DELAY_SECONDS = int(os.getenv('DMS_BACKUP_MAX_DELAY_SECONDS', 300)) # spätestens nach dieser Zeit sichern
+BACKUP_KEEP_RECENT = int(os.getenv('DMS_BACKUP_KEEP_RECENT', 10))   # die letzten n Snapshots
+BACKUP_KEEP_HOURLY = int(os.getenv('DMS_BACKUP_KEEP_HOURLY', 24))   # je ein Snapshot der letzten n Stunden
+BACKUP_KEEP_DAILY = int(os.getenv('DMS_BACKUP_KEEP_DAILY', 30))     # je ein Snapshot der letzten n Tage
+BACKUP_SNAPSHOT_TAG = 'auto'  # Kennzeichen im Dateinamen; nur diese Snapshots räumt prune_backups auf
+
+_pending_backups = {}   # lager_id -> {'first': ..., 'last': ..., 'operation': ...}
+_backup_condition = threading.Condition()
+_backup_worker_started = False
+
 def backup_db(lager_id, operation):
-    os.makedirs('backups', exist_ok=True)
+    """Mark a warehouse for backup. The snapshot is taken in the background."""
+    now = time.monotonic()
+    with _backup_condition:
+        pending = _pending_backups.setdefault(lager_id, {'first': now})
+        pending['last'] = now
+        pending['operation'] = operation
+        _backup_condition.notify()
+    _start_backup_worker()
+
+def snapshot_warehouse(lager_id, operation):
+    """Write a consistent snapshot of a warehouse and apply the retention policy"""
+    db_path = f'{lager_id}.db'
+    if not os.path.exists(db_path):
+        return None  # Lager wurde inzwischen gelöscht
+
+    os.makedirs(BACKUP_DIR, exist_ok=True)
     timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-    shutil.copy(f'{lager_id}.db', f'backups/{timestamp}_{operation}_{lager_id}.db')
+    backup_path = os.path.join(BACKUP_DIR, f'{timestamp}_{BACKUP_SNAPSHOT_TAG}_{operation}_{lager_id}.db')
+    copy_database(db_path, backup_path + '.tmp')
+    os.replace(backup_path + '.tmp', backup_path)
+    prune_backups(lager_id)
+    return backup_path
+
+def prune_backups(lager_id):
+    """Keep the newest snapshots plus one per hour and one per day, delete the rest.
+
+    Only snapshots written by snapshot_warehouse are considered; migration
+    backups and older before_/after_ backups are never deleted automatically.
+    """
+    snapshots = []
+    for name in os.listdir(BACKUP_DIR):
+        if not (name.endswith(f'_{lager_id}.db') and name[15:].startswith(f'_{BACKUP_SNAPSHOT_TAG}_')):
+            continue
+        try:
+            snapshots.append((datetime.strptime(name[:15], '%Y%m%d_%H%M%S'), name))
+        except ValueError:
+            continue
+    snapshots.sort(reverse=True)
+
+    keep = {name for _, name in snapshots[:BACKUP_KEEP_RECENT]}
+    hours, days = set(), set()
+    for timestamp, name in snapshots:
+        hour, day = timestamp.strftime('%Y%m%d%H'), timestamp.strftime('%Y%m%d')
+        if hour not in hours and len(hours) < BACKUP_KEEP_HOURLY:
+            hours.add(hour)
+            keep.add(name)
+        if day not in days and len(days) < BACKUP_KEEP_DAILY:
+            days.add(day)
+            keep.add(name)
+
+    for _, name in snapshots:
+        if name not in keep:
+            os.remove(os.path.join(BACKUP_DIR, name))
+
+def _run_backup_jobs(jobs):
+    for lager_id, operation in jobs:
+        try:
+            snapshot_warehouse(lager_id, operation)
+        except Exception as e:
+            print(f"Fehler beim Backup von {lager_id}: {e}")
+
+def _backup_worker_loop():
+    while True:
+        with _backup_condition:
+            while True:
+                now = time.monotonic()
+                deadlines = {lager_id: min(p['last'] + BACKUP_COALESCE_SECONDS, p['first'] + BACKUP_MAX_DELAY_SECONDS)
+                             for lager_id, p in _pending_backups.items()}
+                due = [lager_id for lager_id, deadline in deadlines.items() if deadline <= now]
+                if due:
+                    break
+                _backup_condition.wait(min(deadlines.values()) - now if deadlines else None)
+            jobs = [(lager_id, _pending_backups.pop(lager_id)['operation']) for lager_id in due]
+        _run_backup_jobs(jobs)
+
+def _start_backup_worker():
+    global _backup_worker_started
+    if _backup_worker_started:
+        return
+    with _backup_condition:
+        if _backup_worker_started:
+            return
+        _backup_worker_started = True
+    threading.Thread(target=_backup_worker_loop, name='backup-worker', daemon=True).start()
+
+@atexit.register
+def flush_backups():
+    """Take all pending snapshots right away (called on shutdown)"""
+    with _backup_condition:
+        jobs = [(lager_id, p['operation']) for lager_id, p in _pending_backups.items()]
+        _pending_backups.clear()
+    _run_backup_jobs(jobs)
+
+#------------------------Backups end---------------------------------------
 
 @app.route('/')
 def login():
@@ -681,7 +1668,7 @@ def login():
 @app.route('/login', methods=['POST'])
 def do_login():
     user_id = request.form['user_id']
-    conn = sqlite3.connect('users.db')
+    conn = get_users_db_connection()
     c = conn.cursor()
     c.execute("SELECT name FROM users WHERE id = ?", (user_id,))
     user = c.fetchone()
@@ -697,7 +1684,7 @@ def do_login():
 def dashboard():
     if 'user_id' not in session:
         return redirect(url_for('login'))
-    conn = sqlite3.connect('users.db')
+    conn = get_users_db_connection()
     c = conn.cursor()
     c.execute("SELECT id, name FROM lager WHERE created_by = ? OR access_users LIKE ?",
               (session['user_id'], f"%{session['user_id']}%"))
@@ -713,18 +1700,19 @@ def create_lager():
         name = request.form['name']
         access_users = request.form.getlist('access_users')
         system_type = request.form.get('system_type', 'personal')
-        lager_id = generate_random_id(8)
-        while os.path.exists(f'{lager_id}.db'):
-            lager_id = generate_random_id(8)
-        conn = sqlite3.connect('users.db')
+        conn = get_users_db_connection()
         c = conn.cursor()
+        lager_id = allocate_id(conn, 'lager_id')
+        # nur von Hand angelegte Datenbankdateien können noch im Weg sein
+        while os.path.exists(f'{lager_id}.db'):
+            lager_id = allocate_id(conn, 'lager_id')
         c.execute("INSERT INTO lager VALUES (?, ?, ?, ?, ?)", 
                   (lager_id, name, session['user_id'], ','.join(access_users), system_type))
         conn.commit()
         conn.close()
         create_warehouse_db(lager_id)
         return redirect(url_for('warehouse', lager_id=lager_id))
-    conn = sqlite3.connect('users.db')
+    conn = get_users_db_connection()
     c = conn.cursor()
     c.execute("SELECT id, name FROM users WHERE id != ?", (session['user_id'],))
     users = c.fetchall()
@@ -740,7 +1728,7 @@ def warehouse(lager_id):
 
     migrate_warehouse_db(lager_id)
 
-    conn = sqlite3.connect('users.db')
+    conn = get_users_db_connection()
     c = conn.cursor()
     c.execute("SELECT id FROM lager WHERE id = ? AND (created_by = ? OR access_users LIKE ?)",
               (lager_id, session['user_id'], f"%{session['user_id']}%"))
@@ -758,105 +1746,17 @@ def devices():
     if 'current_lager' not in session:
         return redirect(url_for('dashboard'))
     
-    search = request.args.get('search', '')
-    status_filters = [f for f in request.args.getlist('status') if f]
-    art_filters = [f for f in request.args.getlist('art') if f]
-    klasse_filters = [f for f in request.args.getlist('klasse') if f]
-    sort_by = request.args.get('sort_by', 'name')
-    group_by = request.args.get('group_by', 'none')  
-    
-    conn = get_db_connection(session['current_lager'])
-    c = conn.cursor()
-    
-    query = """SELECT DISTINCT g.* FROM geraete g
-               LEFT JOIN ausleih_details ad ON g.id = ad.geraet_id
-               LEFT JOIN ausleihen a ON ad.ausleih_id = a.ausleih_id AND a.status = 'ausgeliehen'
-               WHERE 1=1"""
-    params = []
-    
-    if search:
-        query += " AND (g.name LIKE ? OR g.barcode LIKE ? OR g.lagerplatz LIKE ? OR g.seriennummer LIKE ? OR g.modell LIKE ? OR g.instrumentenart LIKE ? OR a.mitarbeiter_name LIKE ? OR a.klasse LIKE ?)"
-        params.extend([f'%{search}%'] * 8)
-    
-    if status_filters:
-        status_conditions = []
-        if "verfügbar" in status_filters:
-            status_conditions.append("g.status = 'verfügbar'")
-        if "ausgeliehen" in status_filters:
-            status_conditions.append("g.status LIKE 'ausgeliehen%'")
-        if status_conditions:
-            query += f" AND ({' OR '.join(status_conditions)})"
-    
-    if art_filters:
-        placeholders = ','.join('?' for _ in art_filters)
-        query += f" AND g.instrumentenart IN ({placeholders})"
-        params.extend(art_filters)
-    
-    if klasse_filters:
-        placeholders = ','.join('?' for _ in klasse_filters)
-        query += f" AND a.klasse IN ({placeholders})"
-        params.extend(klasse_filters)
-    
-
-    if sort_by == 'instrumentenart':
-        query += " ORDER BY g.instrumentenart, g.name"
-    elif sort_by == 'lagerplatz':
-        query += " ORDER BY g.lagerplatz, g.name"
-    elif sort_by == 'status':
-        query += " ORDER BY g.status, g.name"
-    elif sort_by == 'model':
-        query += " ORDER BY g.modell, g.name"
-    else:
-        query += " ORDER BY g.name"
+    filters = device_list_filters()
     
-    c.execute(query, params)
-    devices_list = c.fetchall()
+    facets = get_filter_facets(session['current_lager'])
     
-    grouped_devices = {}
-    if group_by == 'model':
-        for device in devices_list:
-            model = device[7] or 'Unbekanntes Modell'
-            if model not in grouped_devices:
-                grouped_devices[model] = []
-            grouped_devices[model].append(device)
-    elif group_by == 'series':
-        for device in devices_list:
-            instrument = device[9] or 'Unbekanntes Instrument'
-            if instrument not in grouped_devices:
-                grouped_devices[instrument] = []
-            grouped_devices[instrument].append(device)
-    elif group_by == 'serial':
-        for device in devices_list:
-            serial = device[6] or ''  
-            first_letter = serial[0].upper() if serial else 'Unbekannt'
-            if first_letter not in grouped_devices:
-                grouped_devices[first_letter] = []
-            grouped_devices[first_letter].append(device)
-    elif group_by == 'instrument':
-        for device in devices_list:
-            instrument = device[8] or 'Unbekanntes Instrument'  
-            if instrument not in grouped_devices:
-                grouped_devices[instrument] = []
-            grouped_devices[instrument].append(device)
-    elif group_by == 'status':
-        for device in devices_list:
-            status = 'Verfügbar' if device[4] == 'verfügbar' else 'Ausgeliehen'
-            if status not in grouped_devices:
-                grouped_devices[status] = []
-            grouped_devices[status].append(device)
-    else:
-        grouped_devices['Alle Geräte'] = devices_list
-    
-    c.execute("SELECT DISTINCT instrumentenart FROM geraete WHERE instrumentenart IS NOT NULL")
-    instrumentenarten = [row[0] for row in c.fetchall()]
-    c.execute("SELECT DISTINCT klasse FROM ausleihen WHERE klasse IS NOT NULL")
-    klassen = [row[0] for row in c.fetchall()]
+    conn = get_db_connection(session['current_lager'])
+    page = device_list_page(conn, 'devices', filters)
+    # Die Verbindung bleibt bis zum Ende des Requests offen; die Seite liest beim Streamen
     conn.close()
     
-    return render_template('devices.html', title="Geräte", devices=devices_list, grouped_devices=grouped_devices,
-                         search=search, status_filters=status_filters,
-                         art_filters=art_filters, klasse_filters=klasse_filters,
-                         sort_by=sort_by, group_by=group_by, instrumentenarten=instrumentenarten, klassen=klassen)
+    return stream_template('devices.html', title="Geräte", page=page,
+                         instrumentenarten=facets['instrumentenart'], klassen=facets['klasse'], **filters)
 
 @app.route('/add_device', methods=['GET', 'POST'])
 def add_device():
@@ -880,27 +1780,223 @@ def add_device():
         c = conn.cursor()
 
         while True:
-            barcode = generate_random_id(6)
-            c.execute("SELECT id FROM geraete WHERE barcode = ?", (barcode,))
-            if not c.fetchone():
+            barcode = allocate_id(conn, 'barcode')
+            try:
+                c.execute("INSERT INTO geraete (name, barcode, lagerplatz, beschreibung, seriennummer, modell, instrumentenart, inventarnummer, kaufdatum, preis, quantity, hersteller) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                          (name, barcode, lagerplatz, beschreibung, seriennummer, modell, instrumentenart, inventarnummer, kaufdatum, preis, quantity, hersteller))
                 break
-
-        backup_db(session['current_lager'], 'before_add_device')
-        c.execute("INSERT INTO geraete (name, barcode, lagerplatz, beschreibung, seriennummer, modell, instrumentenart, inventarnummer, kaufdatum, preis, quantity, hersteller) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
-                  (name, barcode, lagerplatz, beschreibung, seriennummer, modell, instrumentenart, inventarnummer, kaufdatum, preis, quantity, hersteller))
+            except sqlite3.IntegrityError as e:
+                # Barcode wurde von Hand vergeben (edit_device); nächste ID nehmen
+                if 'barcode' not in str(e):
+                    raise
         conn.commit()
-        backup_db(session['current_lager'], 'after_add_device')
+        warehouse_changed(session['current_lager'], 'add_device')
         conn.close()
         return redirect(url_for('devices'))
     
-    conn = get_db_connection(session['current_lager'])
-    c = conn.cursor()
-    c.execute("SELECT DISTINCT instrumentenart FROM geraete WHERE instrumentenart IS NOT NULL")
-    instrumentenarten = [row[0] for row in c.fetchall()]
-    conn.close()
+    instrumentenarten = [art for art, count in get_filter_facets(session['current_lager'])['instrumentenart']]
     
     return render_template('add_device.html', title="Gerät hinzufügen", instrumentenarten=instrumentenarten)
 
+#------------------------Bulk Import---------------------------------------
+
+# Spaltenüberschrift (klein geschrieben) -> Spalte in geraete. Die Überschriften
+# des CSV-Exports werden erkannt, damit ein Export wieder eingelesen werden kann;
+# unbekannte Spalten (Ausgeliehen an, Email, Klasse) werden ignoriert.
+IMPORT_COLUMNS = {
+    'name': 'name', 'barcode': 'barcode', 'lagerplatz': 'lagerplatz', 'status': 'status',
+    'beschreibung': 'beschreibung', 'seriennummer': 'seriennummer', 'modell': 'modell',
+    'hersteller': 'hersteller', 'instrumentenart': 'instrumentenart', 'instrument': 'instrumentenart',
+    'inventarnummer': 'inventarnummer', 'inventar-nummer': 'inventarnummer',
+    'kaufdatum': 'kaufdatum', 'preis': 'preis', 'quantity': 'quantity', 'menge': 'quantity',
+}
+IMPORT_INSERT_SQL = """INSERT INTO geraete (name, barcode, lagerplatz, status, beschreibung, seriennummer, modell,
+                                            instrumentenart, inventarnummer, kaufdatum, preis, quantity, hersteller)
+                       VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)"""
+IMPORT_EXISTING_BARCODES_SQL = "SELECT barcode FROM geraete WHERE barcode IN (SELECT value FROM json_each(?))"
+IMPORT_MAX_ERRORS = 200   # weitere Fehler werden nur noch gezählt
+IMPORT_MAX_PRICE = 10_000_000
+
+def import_records(stream):
+    """Yield (line number, {header: value}) from an uploaded CSV, JSON array or JSON Lines file.
+
+    CSV (comma, semicolon or tab separated) and JSON Lines are read line by
+    line; a JSON array is parsed as a whole.
+    """
+    text = io.TextIOWrapper(stream, encoding='utf-8-sig', newline='')
+    first_line = text.readline()
+    if first_line.lstrip().startswith('['):
+        for number, record in enumerate(json.loads(first_line + text.read()), 1):
+            yield number, record
+    elif first_line.lstrip().startswith('{'):
+        for number, line in enumerate(chain([first_line], text), 1):
+            if line.strip():
+                yield number, json.loads(line)
+    else:
+        delimiter = max(',;\t', key=first_line.count)
+        reader = csv.DictReader(chain([first_line], text), delimiter=delimiter)
+        for record in reader:
+            yield reader.line_num, record
+
+def _import_price(value):
+    # 1.234,50 / 1234,50 / 1234.50 €
+    value = value.replace('€', '').replace(' ', '')
+    if ',' in value:
+        value = value.replace('.', '').replace(',', '.')
+    price = float(value)
+    # float() nimmt auch nan, inf und 1e308
+    if not math.isfinite(price) or not 0 <= price <= IMPORT_MAX_PRICE:
+        raise ValueError(value)
+    return price
+
+def _import_date(value):
+    # Das Formular speichert ISO-Daten; deutsche Schreibweise wird umgewandelt
+    for date_format in ('%Y-%m-%d', '%d.%m.%Y'):
+        try:
+            return datetime.strptime(value, date_format).strftime('%Y-%m-%d')
+        except ValueError:
+            pass
+    raise ValueError(value)
+
+def validate_import_record(record):
+    """Return (device dict, error messages) for one import record. Empty records give (None, [])."""
+    if not isinstance(record, dict):
+        return None, ["Eintrag ist kein Objekt"]
+    device = {column: '' for column in set(IMPORT_COLUMNS.values())}
+    for key, value in record.items():
+        column = IMPORT_COLUMNS.get(str(key).strip().lower())
+        if isinstance(value, float) and value.is_integer():
+            # JSON-Zahlen wie 2.0 wie "2" behandeln
+            value = int(value)
+        if column:
+            device[column] = '' if value is None else str(value).strip()
+    if not any(device.values()):
+        return None, []
+
+    errors = []
+    if not device['name']:
+        errors.append("Name fehlt")
+    if not device['lagerplatz']:
+        errors.append("Lagerplatz fehlt")
+    # Ausleihen werden nicht importiert. Im Export steht bei ausgeliehenen Geräten
+    # "Name (Menge), ..." als Status; nur defekt wird übernommen.
+    device['status'] = 'defekt' if device['status'].lower() == 'defekt' else 'verfügbar'
+    try:
+        device['preis'] = _import_price(device['preis']) if device['preis'] else None
+    except ValueError:
+        errors.append(f"Ungültiger Preis '{device['preis']}'")
+    try:
+        device['quantity'] = int(device['quantity'] or 1)
+        if device['quantity'] < 1:
+            raise ValueError
+    except ValueError:
+        errors.append(f"Ungültige Menge '{device['quantity']}'")
+    try:
+        device['kaufdatum'] = _import_date(device['kaufdatum']) if device['kaufdatum'] else ''
+    except ValueError:
+        errors.append(f"Ungültiges Kaufdatum '{device['kaufdatum']}' (erwartet JJJJ-MM-TT oder TT.MM.JJJJ)")
+    return device, errors
+
+def import_devices(conn, records, dry_run=False):
+    """Validate records and insert them as devices in one transaction.
+
+    All or nothing: if any row has an error, nothing is imported. Barcodes
+    for rows without one are reserved as a single block. A barcode repeated
+    with identical values counts once, since the CSV export lists a device
+    once per borrow. With dry_run everything is checked and the transaction
+    is rolled back.
+    """
+    # Alles oder nichts, damit die korrigierte Datei einfach noch einmal
+    # hochgeladen werden kann, ohne doppelte Geräte anzulegen
+    result = {'dry_run': dry_run, 'imported': 0, 'errors': [], 'error_count': 0, 'success': False}
+
+    def add_error(line, message):
+        result['error_count'] += 1
+        if len(result['errors']) < IMPORT_MAX_ERRORS:
+            result['errors'].append((line, message))
+
+    devices = []
+    barcode_lines = {}
+    barcode_devices = {}
+    line = 0
+    try:
+        for line, record in records:
+            device, errors = validate_import_record(record)
+            for message in errors:
+                add_error(line, message)
+            if device is None or errors:
+                continue
+            if device['barcode']:
+                if device['barcode'] in barcode_lines:
+                    # Der Export listet ein Gerät einmal pro Ausleihe; gleiche Zeilen sind dasselbe Gerät
+                    if device != barcode_devices[device['barcode']]:
+                        add_error(line, f"Barcode {device['barcode']} kommt schon in Zeile {barcode_lines[device['barcode']]} vor")
+                    continue
+                barcode_lines[device['barcode']] = line
+                barcode_devices[device['barcode']] = device
+            devices.append(device)
+    except (ValueError, csv.Error) as e:
+        # Kaputtes JSON, falsche Kodierung, ...
+        add_error(line + 1, f"Datei konnte nicht gelesen werden: {e}")
+
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        for (barcode,) in conn.execute(IMPORT_EXISTING_BARCODES_SQL, (json.dumps(list(barcode_lines)),)):
+            add_error(barcode_lines[barcode], f"Barcode {barcode} ist bereits vergeben")
+
+        if not result['error_count']:
+            missing = [device for device in devices if not device['barcode']]
+            while missing:
+                # allocate_ids überspringt vergebene Barcodes, aber nicht die aus der Datei
+                barcodes = allocate_ids(conn, 'barcode', len(missing))
+                taken = set(barcode_lines)
+                for device, barcode in zip(missing, barcodes):
+                    if barcode not in taken:
+                        device['barcode'] = barcode
+                missing = [device for device in missing if not device['barcode']]
+            conn.executemany(IMPORT_INSERT_SQL, ((d['name'], d['barcode'], d['lagerplatz'], d['status'], d['beschreibung'],
+                                                  d['seriennummer'], d['modell'], d['instrumentenart'], d['inventarnummer'],
+                                                  d['kaufdatum'], d['preis'], d['quantity'], d['hersteller']) for d in devices))
+            result['imported'] = len(devices)
+
+        if dry_run or result['error_count']:
+            conn.rollback()
+        else:
+            conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+
+    result['success'] = not result['error_count']
+    if result['error_count']:
+        result['imported'] = 0
+    return result
+
+#------------------------Bulk Import end-----------------------------------
+
+@app.route('/import_devices', methods=['GET', 'POST'])
+def import_devices_route():
+    if 'current_lager' not in session:
+        return redirect(url_for('dashboard'))
+
+    result = None
+    if request.method == 'POST':
+        upload = request.files.get('file')
+        if not upload or not upload.filename:
+            flash("Bitte eine CSV- oder JSON-Datei auswählen.", "error")
+            return redirect(url_for('import_devices_route'))
+
+        conn = get_db_connection(session['current_lager'])
+        try:
+            result = import_devices(conn, import_records(upload.stream), dry_run='dry_run' in request.form)
+        finally:
+            conn.close()
+        if result['success'] and not result['dry_run']:
+            warehouse_changed(session['current_lager'], 'bulk_import')
+        result['file_name'] = upload.filename
+
+    return render_template('import_devices.html', title="Geräte importieren", result=result)
+
 @app.route('/edit_device/<int:device_id>', methods=['GET', 'POST'])
 def edit_device(device_id):
     if 'current_lager' not in session:
@@ -944,7 +2040,6 @@ def edit_device(device_id):
         else:
             beschreibung = current_beschreibung
 
-        backup_db(session['current_lager'], 'before_edit_device')
         if defekt:
             status = 'defekt'
         else:
@@ -952,7 +2047,7 @@ def edit_device(device_id):
         c.execute("UPDATE geraete SET name = ?, barcode = ?, lagerplatz = ?, beschreibung = ?, seriennummer = ?, modell = ?, instrumentenart = ?, inventarnummer = ?, kaufdatum = ?, preis = ?, quantity = ?, hersteller = ?, status = ? WHERE id = ?",
                   (name, barcode, lagerplatz, beschreibung, seriennummer, modell, instrumentenart, inventarnummer, kaufdatum, preis, quantity, hersteller, status, device_id))
         conn.commit()
-        backup_db(session['current_lager'], 'after_edit_device')
+        warehouse_changed(session['current_lager'], 'edit_device')
         if not defekt:
             update_device_status(session['current_lager'], device_id)
         conn.close()
@@ -960,9 +2055,8 @@ def edit_device(device_id):
     
     c.execute("SELECT * FROM geraete WHERE id = ?", (device_id,))
     device = c.fetchone()
-    c.execute("SELECT DISTINCT instrumentenart FROM geraete WHERE instrumentenart IS NOT NULL")
-    instrumentenarten = [row[0] for row in c.fetchall()]
     conn.close()
+    instrumentenarten = [art for art, count in get_filter_facets(session['current_lager'])['instrumentenart']]
     
     beschreibung = device[5] or ''
     current_description = ''
@@ -983,10 +2077,9 @@ def delete_device(device_id):
     
     conn = get_db_connection(session['current_lager'])
     c = conn.cursor()
-    backup_db(session['current_lager'], 'before_delete_device')
     c.execute("DELETE FROM geraete WHERE id = ?", (device_id,))
     conn.commit()
-    backup_db(session['current_lager'], 'after_delete_device')
+    warehouse_changed(session['current_lager'], 'delete_device')
     conn.close()
     return redirect(url_for('devices'))
 
@@ -995,10 +2088,26 @@ def delete_device(device_id):
 def admin_regenerate_missing_slips():
     if 'current_lager' not in session:
         return redirect(url_for('dashboard'))
-    result = regenerate_missing_borrow_pdfs()
+    result = regenerate_missing_borrow_pdfs(session['current_lager'], background=True)
     flash(result['message'], 'success' if result['success'] else 'error')
     return redirect(url_for('borrow'))
 
+@app.route('/admin/db_check')
+def admin_db_check():
+    if 'current_lager' not in session:
+        return redirect(url_for('dashboard'))
+    problems = check_warehouse_query_plans(session['current_lager'])
+
+    conn = get_db_connection(session['current_lager'])
+    counter_problems = check_availability_counters(conn)
+    if counter_problems and request.args.get('repair') == '1':
+        rebuild_availability_counters(conn)
+        conn.commit()
+    conn.close()
+
+    problems.extend(counter_problems)
+    return jsonify({'success': not problems, 'problems': problems})
+
 @app.route('/admin/download_all_slips')
 def admin_download_all_slips():
     return get_all_borrows()
@@ -1045,8 +2154,7 @@ def borrow_success(ausleih_id):
     conn.close()
     
     return render_template('borrow_success.html', title="Ausleihe erfolgreich", 
-                         borrow=borrow, devices=devices, system_type=system_type, 
-                         generate_qr_code=generate_qr_code)
+                         borrow=borrow, devices=devices, system_type=system_type)
 
 
 @app.route('/regenerate_borrow_pdfs', methods=['POST'])
@@ -1056,14 +2164,113 @@ def regenerate_borrow_pdfs_route():
         return jsonify({'success': False, 'message': 'Kein Lager ausgewählt'})
 
     try:
-        result = regenerate_missing_borrow_pdfs()
+        result = regenerate_missing_borrow_pdfs(session['current_lager'], background=True)
         return jsonify(result)
     except Exception as e:
         return jsonify({'success': False, 'message': f'Fehler: {str(e)}'})
 
+@app.route('/regenerate_borrow_pdfs/status')
+def regenerate_borrow_pdfs_status():
+    """Progress of the running borrow slip regeneration"""
+    if 'current_lager' not in session:
+        return jsonify({'success': False, 'message': 'Kein Lager ausgewählt'})
+    return jsonify(borrow_slip_job_status(session['current_lager']))
+
+
+SLIP_ARCHIVE_CACHE = os.getenv('DMS_SLIP_ARCHIVE_CACHE', '1') != '0'
+SLIP_ARCHIVE_CHUNK_SIZE = 64 * 1024
+
+class _ZipStreamBuffer(io.RawIOBase):
+    """Sink for zipfile; the written bytes are taken out with drain().
+
+    zipfile may seek back into the part not drained yet. That way it completes
+    the local header of an entry (CRC and sizes) once the entry is written,
+    instead of marking it with a data descriptor, which streaming unzip tools
+    such as Java's ZipInputStream reject for ZIP_STORED entries.
+    """
+    def __init__(self):
+        self._buffer = bytearray()
+        self._start = 0  # Position von _buffer[0] im Archiv
+        self._pos = 0
+
+    def writable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._pos
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self._pos
+        elif whence == io.SEEK_END:
+            offset += self._start + len(self._buffer)
+        if offset < self._start:
+            raise OSError("Bereits ausgegebene Archivdaten können nicht mehr geändert werden")
+        self._pos = offset
+        return offset
+
+    def write(self, data):
+        index = self._pos - self._start
+        self._buffer[index:index + len(data)] = data
+        self._pos += len(data)
+        return len(data)
+
+    def drain(self):
+        data = bytes(self._buffer)
+        self._start += len(self._buffer)
+        self._buffer.clear()
+        return data
+
+def generate_slip_archive(pdf_files, cache_path=None, cache_key=None):
+    """Yield a ZIP (ZIP_STORED, PDFs are already compressed) of pdf_files entry by entry.
+
+    Each entry is held in memory until it is complete, so its local header
+    carries CRC and sizes. With cache_path the archive is also written to a file, which becomes the
+    cache (together with cache_key) once the archive is complete.
+    """
+    sink = _ZipStreamBuffer()
+    cache_file = tmp_path = None
+    if cache_path:
+        tmp_path = f"{cache_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        cache_file = open(tmp_path, 'wb')
+
+    def take():
+        data = sink.drain()
+        if cache_file and data:
+            cache_file.write(data)
+        return data
+
+    try:
+        with zipfile.ZipFile(sink, 'w', zipfile.ZIP_STORED) as zip_file:
+            for pdf_file in pdf_files:
+                stat = pdf_file.stat()
+                info = zipfile.ZipInfo(pdf_file.name, time.localtime(stat.st_mtime)[:6])
+                info.file_size = stat.st_size
+                with open(pdf_file, 'rb') as src, zip_file.open(info, 'w') as dest:
+                    while chunk := src.read(SLIP_ARCHIVE_CHUNK_SIZE):
+                        dest.write(chunk)
+                # Erst ausgeben, wenn zipfile den Kopf des Eintrags vervollständigt hat
+                if data := take():
+                    yield data
+        if data := take():
+            yield data
+
+        if cache_file:
+            cache_file.close()
+            os.replace(tmp_path, cache_path)
+            _write_atomic(Path(f"{cache_path}.key"), cache_key.encode('utf-8'))
+            tmp_path = None
+    finally:
+        if cache_file:
+            cache_file.close()
+        if tmp_path and os.path.exists(tmp_path):
+            os.remove(tmp_path)
 
 def get_all_borrows():
-    """Generate a ZIP file containing all borrow PDFs from the folder"""
+    """Stream a ZIP file containing all borrow PDFs from the folder"""
     if 'current_lager' not in session:
         return redirect(url_for('dashboard'))
 
@@ -1071,7 +2278,7 @@ def get_all_borrows():
     pdf_dir = ensure_borrow_pdfs_directory(lager_id)
 
     # Alle PDF-Dateien im Ordner finden
-    pdf_files = list(pdf_dir.glob("ausleihe_*.pdf"))
+    pdf_files = sorted(pdf_dir.glob("ausleihe_*.pdf"))
 
     if not pdf_files:
         return send_file(
@@ -1081,23 +2288,26 @@ def get_all_borrows():
             download_name='keine_pdfs.txt'
         )
 
-    # ZIP-Datei erstellen
-    zip_buffer = BytesIO()
-    with zipfile.ZipFile(zip_buffer, 'w', zipfile.ZIP_DEFLATED) as zip_file:
-        for pdf_file in pdf_files:
-            # Dateinamen bereinigen für bessere Lesbarkeit
-            clean_name = pdf_file.name
-            zip_file.write(pdf_file, clean_name)
-
-    zip_buffer.seek(0)
     timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-
-    return send_file(
-        zip_buffer,
-        mimetype='application/zip',
-        as_attachment=True,
-        download_name=f'alle_ausleihen_{lager_id}_{timestamp}.zip'
-    )
+    download_name = f'alle_ausleihen_{lager_id}_{timestamp}.zip'
+
+    cache_path = cache_key = None
+    if SLIP_ARCHIVE_CACHE:
+        # Das Archiv hängt nur von Namen, Größe und mtime der Scheine ab
+        state = [(pdf_file.name, stat.st_mtime_ns, stat.st_size) for pdf_file, stat in ((f, f.stat()) for f in pdf_files)]
+        cache_key = hashlib.sha256(json.dumps(state).encode('utf-8')).hexdigest()
+        cache_path = pdf_dir / 'alle_ausleihen.zip'
+        try:
+            if Path(f"{cache_path}.key").read_text() == cache_key and cache_path.exists():
+                return send_file(cache_path.resolve(), mimetype='application/zip', as_attachment=True,
+                                 download_name=download_name, etag=cache_key, conditional=True)
+        except OSError:
+            pass
+
+    response = Response(stream_with_context(generate_slip_archive(pdf_files, cache_path, cache_key)),
+                        mimetype='application/zip')
+    response.headers['Content-Disposition'] = f'attachment; filename={download_name}'
+    return response
 
 
 def _generate_borrow_pdf(self, borrow_info, devices):
@@ -1306,11 +2516,7 @@ def generate_borrow_pdf(borrow_info, devices):
         grouped_devices[base_name]['total_price'] += (preis or 0) * quantity
         
         if not grouped_devices[base_name]['image_path']:
-            for ext in ['.jpg', '.png', '.jpeg']:
-                img_path = f'images/{device_id}{ext}'
-                if os.path.exists(img_path):
-                    grouped_devices[base_name]['image_path'] = img_path
-                    break
+            grouped_devices[base_name]['image_path'] = device_thumbnail(device_id)
     
     buffer = BytesIO()
     doc = SimpleDocTemplate(buffer, pagesize=A4, topMargin=2*cm, bottomMargin=2*cm)
@@ -1409,213 +2615,303 @@ def generate_borrow_pdf(borrow_info, devices):
     
     return buffer
 
-def regenerate_missing_borrow_pdfs():
-    if 'current_lager' not in session:
-        return {'success': False, 'message': 'Kein Lager ausgewählt'}
-    
-    lager_id = session['current_lager']
-    pdf_dir = ensure_borrow_pdfs_directory(lager_id)
-    
-    conn = get_db_connection(lager_id)
-    c = conn.cursor()
-    
-    # Get all borrow IDs
-    c.execute("SELECT ausleih_id FROM ausleihen")
-    borrow_ids = [row[0] for row in c.fetchall()]
-    
-    generated = 0
-    for ausleih_id in borrow_ids:
-        pdf_path = pdf_dir / f"ausleihe_{ausleih_id}.pdf"
-        
-        # Generate PDF
-        c.execute("""SELECT a.ausleih_id, a.mitarbeiter_name, a.datum, a.email, a.klasse
-                     FROM ausleihen a
-                     WHERE a.ausleih_id = ?""", (ausleih_id,))
-        borrow_info = c.fetchone()
-        
-        c.execute("""SELECT g.id, g.name, g.barcode, g.modell, g.preis, ad.quantity
-                     FROM ausleih_details ad
-                     JOIN geraete g ON ad.geraet_id = g.id
-                     WHERE ad.ausleih_id = ?
-                     ORDER BY g.name""", (ausleih_id,))
-        devices = c.fetchall()
-        
-        buffer = generate_borrow_pdf(borrow_info, devices)
-        
-        with open(pdf_path, 'wb') as f:
-            f.write(buffer.getvalue())
-        
-        generated += 1
-    
-    conn.close()
-    
-    return {'success': True, 'message': f'{generated} PDFs regeneriert'}
-
-app._generate_borrow_pdf = lambda borrow_info, devices: _generate_borrow_pdf(None, borrow_info, devices)
-
-@app.route('/borrow_pdf/<ausleih_id>')
-def borrow_pdf(ausleih_id):
-    if 'current_lager' not in session:
-        return redirect(url_for('dashboard'))
-    
-    conn = get_db_connection(session['current_lager'])
-    c = conn.cursor()
-    
-    c.execute("""SELECT a.ausleih_id, a.mitarbeiter_name, a.datum, a.email, a.klasse
-                 FROM ausleihen a
-                 WHERE a.ausleih_id = ?""", (ausleih_id,))
-    borrow_info = c.fetchone()
-    
-    if not borrow_info:
-        conn.close()
-        return redirect(url_for('dashboard'))
-    
-    c.execute("""SELECT g.id, g.name, g.barcode, g.modell, g.preis, ad.quantity
-                 FROM ausleih_details ad
-                 JOIN geraete g ON ad.geraet_id = g.id
-                 WHERE ad.ausleih_id = ?
-                 ORDER BY g.name""", (ausleih_id,))
-    devices = c.fetchall()
-    conn.close()
-    
-    def get_base_name(name):
-        """Extract base name without trailing numbers"""
-        match = re.match(r'^(.*?)\s*\d*$', name.strip())
-        if match:
-            base = match.group(1).strip()
-            return base if base else name
-        return name
-    
-    grouped_devices = {}
-    for device in devices:
-        device_id, name, barcode, modell, preis, quantity = device
-        base_name = get_base_name(name)
+#------------------------Device Images-------------------------------------
 
-        if base_name not in grouped_devices:
-            grouped_devices[base_name] = {
-                'name': base_name,
-                'items': [],
-                'count': 0,
-                'total_price': 0,
-                'model': modell or '',
-                'image_path': None
-            }
+DEVICE_IMAGE_DIR = 'images'
+DEVICE_IMAGE_EXTENSIONS = ('.jpg', '.png', '.jpeg')  # Reihenfolge = Vorrang bei mehreren Dateien
+DEVICE_IMAGE_INDEX_MAX_AGE = 60  # Sekunden; fängt Bilder ab, die ohne Änderung am Ordner ersetzt wurden
+THUMBNAIL_DIR = 'image_thumbnails'
+THUMBNAIL_SIZE_PX = 236  # 2 cm bei 300 dpi, so groß wie das Bild im Ausleihschein
 
-        grouped_devices[base_name]['items'].append({
-            'id': device_id,
-            'full_name': name,
-            'barcode': barcode,
-            'price': preis or 0,
-            'quantity': quantity
-        })
-        grouped_devices[base_name]['count'] += quantity
-        grouped_devices[base_name]['total_price'] += (preis or 0) * quantity
+_device_image_index = {'dir_mtime': None, 'scanned': 0, 'files': {}}
+_device_image_index_lock = threading.Lock()
 
-        if not grouped_devices[base_name]['image_path']:
-            for ext in ['.jpg', '.png', '.jpeg']:
-                img_path = f'images/{device_id}{ext}'
-                if os.path.exists(img_path):
-                    grouped_devices[base_name]['image_path'] = img_path
-                    break
-    
-    buffer = BytesIO()
-    doc = SimpleDocTemplate(buffer, pagesize=A4, topMargin=2*cm, bottomMargin=2*cm)
-    
-    styles = getSampleStyleSheet()
-    title_style = ParagraphStyle(
-        'CustomTitle',
-        parent=styles['Heading1'],
-        fontSize=24,
-        textColor=colors.HexColor('#1a1a1a'),
-        spaceAfter=20,
-        alignment=TA_LEFT
-    )
-    
-    header_style = ParagraphStyle(
-        'Header',
-        parent=styles['Normal'],
-        fontSize=10,
-        textColor=colors.HexColor('#666666'),
-        spaceAfter=10
-    )
-    
-    elements = []
-    
-    elements.append(Paragraph(f"Ausleihe-Übersicht", title_style))
-    elements.append(Spacer(1, 0.5*cm))
-    
+def device_image_index():
+    """{device_id: ((file name, mtime_ns, size), ...)} for the images/ folder.
 
-    info_text = f"""
-    <b>Ausleihe-ID:</b> {borrow_info[0]}<br/>
-    <b>Ausgeliehen an:</b> {borrow_info[1]}<br/>
-    <b>Datum:</b> {borrow_info[2]}<br/>
+    The folder is listed once and again only when its mtime changes or the
+    index is older than DEVICE_IMAGE_INDEX_MAX_AGE.
     """
-    if borrow_info[3]:
-        info_text += f"<b>E-Mail:</b> {borrow_info[3]}<br/>"
-    if borrow_info[4]:
-        info_text += f"<b>Klasse:</b> {borrow_info[4]}<br/>"
-    
-    elements.append(Paragraph(info_text, header_style))
-    elements.append(Spacer(1, 1*cm))
-    
-    table_data = [['', 'Artikel', 'Menge', 'Preis/St.', 'Gesamt']]
-    
-    total_sum = 0
-    for group_name, group_data in sorted(grouped_devices.items()):
-        row = []
-        
-        if group_data['image_path']:
+    try:
+        dir_mtime = os.stat(DEVICE_IMAGE_DIR).st_mtime_ns
+    except OSError:
+        return {}
+
+    with _device_image_index_lock:
+        if (_device_image_index['dir_mtime'] == dir_mtime
+                and time.monotonic() - _device_image_index['scanned'] < DEVICE_IMAGE_INDEX_MAX_AGE):
+            return _device_image_index['files']
+
+        files = {}
+        for entry in os.scandir(DEVICE_IMAGE_DIR):
+            stem, ext = os.path.splitext(entry.name)
+            if ext in DEVICE_IMAGE_EXTENSIONS and stem.isdigit():
+                stat = entry.stat()
+                files.setdefault(int(stem), []).append((entry.name, stat.st_mtime_ns, stat.st_size))
+        files = {device_id: tuple(sorted(entries, key=lambda e: DEVICE_IMAGE_EXTENSIONS.index(os.path.splitext(e[0])[1])))
+                 for device_id, entries in files.items()}
+        changed = files != _device_image_index['files'] or _device_image_index['dir_mtime'] is None
+        _device_image_index.update(dir_mtime=dir_mtime, scanned=time.monotonic(), files=files)
+
+    if changed:
+        prune_thumbnails(files)
+    return files
+
+def thumbnail_name(file_name, mtime_ns, size):
+    # Der Name ändert sich mit jeder Version des Bildes
+    return f"{os.path.splitext(file_name)[0]}_{mtime_ns}_{size}_{THUMBNAIL_SIZE_PX}.jpg"
+
+def prune_thumbnails(files):
+    """Delete thumbnails of images that were replaced or removed from the images/ folder"""
+    current = {thumbnail_name(*entry) for entries in files.values() for entry in entries}
+    try:
+        names = os.listdir(THUMBNAIL_DIR)
+    except OSError:
+        return
+    for name in names:
+        if name.endswith('.jpg') and name not in current:
             try:
-                img = RLImage(group_data['image_path'], width=2*cm, height=2*cm)
-                row.append(img)
-            except:
-                row.append('')
+                os.remove(os.path.join(THUMBNAIL_DIR, name))
+            except OSError:
+                pass
+
+def device_thumbnail(device_id):
+    """Path of the print-size thumbnail for a device image, or None without (readable) image"""
+    entries = device_image_index().get(device_id)
+    if not entries:
+        return None
+    return _device_thumbnail(*entries[0])
+
+@lru_cache(maxsize=4096)
+def _device_thumbnail(file_name, mtime_ns, size):
+    """Create the thumbnail once per image version; the file name changes with the image"""
+    thumb_path = os.path.join(THUMBNAIL_DIR, thumbnail_name(file_name, mtime_ns, size))
+    if os.path.exists(thumb_path):
+        return thumb_path
+
+    try:
+        with PILImage.open(os.path.join(DEVICE_IMAGE_DIR, file_name)) as img:
+            img.draft('RGB', (THUMBNAIL_SIZE_PX, THUMBNAIL_SIZE_PX))
+            img = img.convert('RGBA')
+            # wie bisher quadratisch auf 2x2 cm; Transparenz auf Weiß
+            thumb = PILImage.new('RGB', img.size, 'white')
+            thumb.paste(img, mask=img.getchannel('A'))
+            thumb = thumb.resize((THUMBNAIL_SIZE_PX, THUMBNAIL_SIZE_PX), PILImage.LANCZOS)
+
+        os.makedirs(THUMBNAIL_DIR, exist_ok=True)
+        tmp_path = f"{thumb_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        thumb.save(tmp_path, format='JPEG', quality=85, optimize=True)
+        os.replace(tmp_path, thumb_path)
+        return thumb_path
+    except Exception as e:
+        print(f"Vorschaubild für {file_name} konnte nicht erstellt werden: {e}")
+        return None
+
+#------------------------Device Images end---------------------------------
+
+#------------------------Borrow Slips--------------------------------------
+
+BORROW_SLIP_VERSION = 2  # erhöhen, wenn sich das Layout von generate_borrow_pdf ändert
+SLIP_WORKERS = int(os.getenv('DMS_SLIP_WORKERS', os.cpu_count() or 1))
+
+def borrow_slip_sources(conn, ausleih_ids=None):
+    """Yield (ausleih_id, borrow_info, devices) for all borrows (or the given ones) with two queries"""
+    header_filter = detail_filter = ''
+    params = ()
+    if ausleih_ids is not None:
+        header_filter = "WHERE ausleih_id IN (SELECT value FROM json_each(?))"
+        detail_filter = "WHERE ad.ausleih_id IN (SELECT value FROM json_each(?))"
+        params = (json.dumps(list(ausleih_ids)),)
+    headers = conn.execute(f"""SELECT ausleih_id, mitarbeiter_name, datum, email, klasse
+                               FROM ausleihen {header_filter} ORDER BY ausleih_id""", params).fetchall()
+    details = conn.execute(f"""SELECT ad.ausleih_id, g.id, g.name, g.barcode, g.modell, g.preis, ad.quantity
+                               FROM ausleih_details ad
+                               JOIN geraete g ON ad.geraet_id = g.id
+                               {detail_filter}
+                               ORDER BY ad.ausleih_id, g.name""", params)
+    devices_by_borrow = {ausleih_id: [tuple(row[1:]) for row in rows]
+                         for ausleih_id, rows in groupby(details, key=lambda row: row[0])}
+    for borrow_info in headers:
+        yield borrow_info[0], tuple(borrow_info), devices_by_borrow.get(borrow_info[0], [])
+
+def borrow_slip_hash(borrow_info, devices, image_stats):
+    """Content hash of a borrow slip: header, device rows and the images it may show"""
+    images = [image_stats.get(device[0], ()) for device in devices]
+    payload = json.dumps([BORROW_SLIP_VERSION, borrow_info, devices, images], default=str)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+def borrow_slip_paths(pdf_dir, ausleih_id):
+    return pdf_dir / f"ausleihe_{ausleih_id}.pdf", pdf_dir / f"ausleihe_{ausleih_id}.hash"
+
+def borrow_slip_is_current(pdf_dir, ausleih_id, digest):
+    pdf_path, hash_path = borrow_slip_paths(pdf_dir, ausleih_id)
+    try:
+        return pdf_path.exists() and hash_path.read_text() == digest
+    except OSError:
+        return False
+
+def _write_atomic(path, data):
+    tmp_path = path.with_name(f"{path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+def write_borrow_slip(pdf_dir, ausleih_id, borrow_info, devices, digest):
+    """Render one borrow slip and store it with its hash (also the process pool entry point)"""
+    pdf_path, hash_path = borrow_slip_paths(Path(pdf_dir), ausleih_id)
+    _write_atomic(pdf_path, generate_borrow_pdf(borrow_info, devices).getvalue())
+    _write_atomic(hash_path, digest.encode('utf-8'))
+    return ausleih_id
+
+_slip_jobs = {}  # lager_id -> Fortschritt der letzten Neugenerierung
+_slip_jobs_lock = threading.Lock()
+
+def borrow_slip_job_status(lager_id):
+    with _slip_jobs_lock:
+        job = dict(_slip_jobs.get(lager_id) or {'running': False, 'total': 0, 'stale': 0, 'done': 0, 'failed': 0})
+    job['success'] = not job['failed']
+    if job['running']:
+        job['message'] = f"{job['done']} von {job['stale']} Scheinen neu erzeugt"
+    else:
+        job['message'] = f"{job['done']} PDFs regeneriert, {job['total'] - job['stale']} waren aktuell"
+        if job['failed']:
+            job['message'] += f", {job['failed']} fehlgeschlagen"
+    return job
+
+def _update_slip_job(lager_id, **changes):
+    with _slip_jobs_lock:
+        _slip_jobs[lager_id].update(changes)
+
+def _run_slip_job(lager_id, pdf_dir, stale):
+    """Render stale slips, in the slip process pool if there is more than one worker"""
+    done = failed = 0
+    try:
+        if SLIP_WORKERS > 1 and len(stale) > 1:
+            pool = get_process_pool('slips', SLIP_WORKERS)
+            futures = [pool.submit(write_borrow_slip, str(pdf_dir.resolve()), *job) for job in stale]
+            renders = (future.result for future in as_completed(futures))
         else:
-            row.append('')
-        
-        name_text = f"<b>{group_data['name']}</b>"
-        if group_data['model']:
-            name_text += f"<br/><font size=8 color='#666666'>{group_data['model']}</font>"
-        row.append(Paragraph(name_text, styles['Normal']))
-        
-        row.append(str(group_data['count']))
-        
-        avg_price = group_data['total_price'] / group_data['count'] if group_data['count'] > 0 else 0
-        row.append(f"{avg_price:.2f} €")
+            renders = (partial(write_borrow_slip, pdf_dir, *job) for job in stale)
+
+        for render in renders:
+            try:
+                render()
+                done += 1
+            except Exception as e:
+                failed += 1
+                print(f"Ausleihschein konnte nicht erzeugt werden: {e}")
+            _update_slip_job(lager_id, done=done, failed=failed)
+    finally:
+        _update_slip_job(lager_id, running=False, done=done, failed=failed)
+
+def regenerate_missing_borrow_pdfs(lager_id, background=False):
+    """Re-render the borrow slips of a warehouse whose content hash changed or whose PDF is missing.
+
+    With background the rendering runs in a background thread; progress is
+    reported by borrow_slip_job_status.
+    """
+    with _slip_jobs_lock:
+        if (_slip_jobs.get(lager_id) or {}).get('running'):
+            return borrow_slip_job_status(lager_id)
+
+    pdf_dir = ensure_borrow_pdfs_directory(lager_id)
+    image_stats = device_image_index()
+    conn = get_db_connection(lager_id)
+    try:
+        stale, total = [], 0
+        for ausleih_id, borrow_info, devices in borrow_slip_sources(conn):
+            total += 1
+            digest = borrow_slip_hash(borrow_info, devices, image_stats)
+            if not borrow_slip_is_current(pdf_dir, ausleih_id, digest):
+                stale.append((ausleih_id, borrow_info, devices, digest))
+    finally:
+        conn.close()
 
-        row.append(f"{group_data['total_price']:.2f} €")
-        
-        table_data.append(row)
-        total_sum += group_data['total_price']
+    with _slip_jobs_lock:
+        if (_slip_jobs.get(lager_id) or {}).get('running'):
+            return borrow_slip_job_status(lager_id)
+        _slip_jobs[lager_id] = {'running': bool(stale), 'total': total, 'stale': len(stale), 'done': 0, 'failed': 0}
 
-    table_data.append(['', Paragraph('<b>Summe</b>', styles['Normal']), '', '', f"{total_sum:.2f} €"])
+    if stale:
+        if background:
+            threading.Thread(target=_run_slip_job, args=(lager_id, pdf_dir, stale),
+                             name=f'borrow-slips-{lager_id}', daemon=True).start()
+        else:
+            _run_slip_job(lager_id, pdf_dir, stale)
+    return borrow_slip_job_status(lager_id)
 
-    table = Table(table_data, colWidths=[3*cm, 8*cm, 2*cm, 3*cm, 3*cm])
-    table.setStyle(TableStyle([
-        ('BACKGROUND', (0, 0), (-1, 0), colors.HexColor('#f0f0f0')),
-        ('TEXTCOLOR', (0, 0), (-1, 0), colors.HexColor('#333333')),
-        ('ALIGN', (0, 0), (-1, -1), 'LEFT'),
-        ('ALIGN', (2, 0), (2, -1), 'CENTER'),
-        ('ALIGN', (3, 0), (-1, -1), 'RIGHT'),
-        ('FONTNAME', (0, 0), (-1, 0), 'Helvetica-Bold'),
-        ('FONTSIZE', (0, 0), (-1, 0), 10),
-        ('BOTTOMPADDING', (0, 0), (-1, 0), 12),
-        ('TOPPADDING', (0, 0), (-1, 0), 12),
-        ('GRID', (0, 0), (-1, -2), 0.5, colors.HexColor('#e0e0e0')),
-        ('LINEABOVE', (0, -1), (-1, -1), 2, colors.HexColor('#333333')),
-        ('FONTNAME', (0, -1), (-1, -1), 'Helvetica-Bold'),
-        ('TOPPADDING', (0, 1), (-1, -1), 8),
-        ('BOTTOMPADDING', (0, 1), (-1, -1), 8),
-        ('VALIGN', (0, 0), (-1, -1), 'MIDDLE'),
-    ]))
-    
-    elements.append(table)
-    
-    doc.build(elements)
-    buffer.seek(0)
-    
-    return send_file(buffer, mimetype='application/pdf', 
-                    as_attachment=True, download_name=f'ausleihe_{ausleih_id}.pdf')
+_slip_render_locks = {}  # (lager_id, ausleih_id) -> Lock, damit ein Schein nur einmal gleichzeitig erzeugt wird
+_slip_render_locks_lock = threading.Lock()
+_slip_prerender_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='slip-prerender')
+
+def ensure_borrow_slip(lager_id, ausleih_id):
+    """Path and content hash of the cached slip PDF, rendered on a cache miss (None for unknown borrows)"""
+    conn = get_db_connection(lager_id)
+    try:
+        sources = list(borrow_slip_sources(conn, [ausleih_id]))
+    finally:
+        conn.close()
+    if not sources:
+        return None
+
+    _, borrow_info, devices = sources[0]
+    pdf_dir = ensure_borrow_pdfs_directory(lager_id)
+    digest = borrow_slip_hash(borrow_info, devices, device_image_index())
+
+    if not borrow_slip_is_current(pdf_dir, ausleih_id, digest):
+        key = (lager_id, ausleih_id)
+        with _slip_render_locks_lock:
+            lock = _slip_render_locks.setdefault(key, threading.Lock())
+        with lock:
+            # wer gewartet hat, findet den Schein meist schon fertig vor
+            if not borrow_slip_is_current(pdf_dir, ausleih_id, digest):
+                write_borrow_slip(pdf_dir, ausleih_id, borrow_info, devices, digest)
+        with _slip_render_locks_lock:
+            if _slip_render_locks.get(key) is lock:
+                del _slip_render_locks[key]
+
+    return borrow_slip_paths(pdf_dir, ausleih_id)[0], digest
+
+def prerender_borrow_slip(lager_id, ausleih_id):
+    """Render a new borrow's slip in the background so the first download is a cache hit"""
+    def run():
+        try:
+            ensure_borrow_slip(lager_id, ausleih_id)
+        except Exception as e:
+            print(f"Ausleihschein {ausleih_id} konnte nicht vorab erzeugt werden: {e}")
+    _slip_prerender_executor.submit(run)
+
+#------------------------Borrow Slips end----------------------------------
+
+app._generate_borrow_pdf = lambda borrow_info, devices: _generate_borrow_pdf(None, borrow_info, devices)
+
+@app.route('/borrow_pdf/<ausleih_id>')
+def borrow_pdf(ausleih_id):
+    if 'current_lager' not in session:
+        return redirect(url_for('dashboard'))
+
+    slip = ensure_borrow_slip(session['current_lager'], ausleih_id)
+    if not slip:
+        return redirect(url_for('dashboard'))
+
+    pdf_path, digest = slip
+    return send_file(pdf_path.resolve(), mimetype='application/pdf', as_attachment=True,
+                     download_name=f'ausleihe_{ausleih_id}.pdf', etag=digest, conditional=True)
+
+DEVICE_STATUS_REFRESH_SQL = """UPDATE geraete SET status = COALESCE(
+                                    (SELECT group_concat(mitarbeiter_name || ' (' || quantity || ')', ', ')
+                                     FROM (SELECT mitarbeiter_name, quantity FROM geraete_ausleiher
+                                           WHERE geraet_id = geraete.id ORDER BY mitarbeiter_name)),
+                                    'verfügbar')
+                                WHERE id IN (SELECT value FROM json_each(?))"""
+
+def refresh_device_status(conn, device_ids):
+    """Set the status of all given devices from their current borrowers in one statement.
+
+    The status becomes "name (quantity), ..." or 'verfügbar'. Runs inside the
+    caller's transaction.
+    """
+    conn.execute(DEVICE_STATUS_REFRESH_SQL, (json.dumps(sorted({int(device_id) for device_id in device_ids})),))
 
 def update_device_status(lager_id, device_id, conn=None):
     """
@@ -1628,33 +2924,7 @@ def update_device_status(lager_id, device_id, conn=None):
         should_close = True
     
     try:
-        c = conn.cursor()
-
-        # Get device info
-        c.execute("SELECT name, quantity FROM geraete WHERE id = ?", (device_id,))
-        device = c.fetchone()
-        if not device:
-            return
-
-        device_name, max_quantity = device
-
-        # Calculate total borrowed per borrower
-        c.execute("""SELECT a.mitarbeiter_name, SUM(ad.quantity) as total_quantity
-                     FROM ausleih_details ad
-                     JOIN ausleihen a ON ad.ausleih_id = a.ausleih_id
-                     WHERE ad.geraet_id = ? AND a.status = 'ausgeliehen'
-                     GROUP BY a.mitarbeiter_name
-                     ORDER BY a.mitarbeiter_name""", (device_id,))
-        borrowers = c.fetchall()
-
-        # Update status
-        if not borrowers:
-            status = 'verfügbar'
-        else:
-            borrower_strings = [f"{name} ({qty})" for name, qty in borrowers]
-            status = ", ".join(borrower_strings)
-
-        c.execute("UPDATE geraete SET status = ? WHERE id = ?", (status, device_id))
+        refresh_device_status(conn, [device_id])
         
         if should_close:
             conn.commit()
@@ -1663,6 +2933,105 @@ def update_device_status(lager_id, device_id, conn=None):
         if should_close and conn:
             conn.close()
 
+#------------------------Borrow Cart---------------------------------------
+
+BORROW_CART_TTL = int(os.getenv('DMS_BORROW_CART_TTL', 7 * 24 * 3600))  # Sekunden ohne Änderung, bis eine Ausleihliste verfällt
+
+def borrow_cart_id(lager_id):
+    """Cart id of the current browser session, created on first use.
+
+    After a cookie reset a logged-in user gets back their most recently used
+    cart in this warehouse.
+    """
+    if 'cart_id' not in session:
+        cart_id = None
+        if 'user_id' in session:
+            conn = get_users_db_connection()
+            try:
+                row = conn.execute(
+                    """SELECT cart_id FROM borrow_carts WHERE user_id = ? AND lager_id = ? AND updated_at >= ?
+                       ORDER BY updated_at DESC LIMIT 1""",
+                    (session['user_id'], lager_id, time.time() - BORROW_CART_TTL)).fetchone()
+            finally:
+                conn.close()
+            cart_id = row[0] if row else None
+        session['cart_id'] = cart_id or secrets.token_urlsafe(18)
+    return session['cart_id']
+
+def load_borrow_cart(lager_id):
+    """Borrow list of the current session as dicts (id, name, barcode, quantity, max_quantity)"""
+    # Ausleihlisten aus älteren Session-Cookies einmalig übernehmen
+    if 'borrow_list' in session:
+        save_borrow_cart(lager_id, session.pop('borrow_list'))
+
+    cart_id = borrow_cart_id(lager_id)
+    conn = get_users_db_connection()
+    try:
+        rows = conn.execute(
+            """SELECT i.geraet_id, i.name, i.barcode, i.quantity, i.max_quantity
+               FROM borrow_carts c JOIN borrow_cart_items i ON i.cart_id = c.cart_id AND i.lager_id = c.lager_id
+               WHERE c.cart_id = ? AND c.lager_id = ? AND c.updated_at >= ?
+               ORDER BY i.position""",
+            (cart_id, lager_id, time.time() - BORROW_CART_TTL)).fetchall()
+    finally:
+        conn.close()
+    return [{'id': device_id, 'name': name, 'barcode': barcode, 'quantity': quantity, 'max_quantity': max_quantity}
+            for device_id, name, barcode, quantity, max_quantity in rows]
+
+def save_borrow_cart(lager_id, borrow_list):
+    """Replace the session's borrow list; an empty list removes the cart. Also drops expired carts.
+
+    If the request already has a write open on users.db, the cart is saved as
+    part of that transaction and the caller commits.
+    """
+    cart_id = borrow_cart_id(lager_id)
+    now = time.time()
+    conn = get_users_db_connection()
+    # Eine offene Transaktion des Aufrufers nicht vorzeitig committen
+    own_transaction = not conn.in_transaction
+    if own_transaction:
+        conn.execute("BEGIN IMMEDIATE")
+    try:
+        conn.execute("DELETE FROM borrow_cart_items WHERE cart_id = ? AND lager_id = ?", (cart_id, lager_id))
+        if borrow_list:
+            conn.execute("""INSERT INTO borrow_carts (cart_id, lager_id, user_id, updated_at) VALUES (?, ?, ?, ?)
+                            ON CONFLICT (cart_id, lager_id) DO UPDATE SET user_id = excluded.user_id, updated_at = excluded.updated_at""",
+                         (cart_id, lager_id, session.get('user_id'), now))
+            conn.executemany("""INSERT INTO borrow_cart_items (cart_id, lager_id, geraet_id, position, name, barcode, quantity, max_quantity)
+                                VALUES (?, ?, ?, ?, ?, ?, ?, ?)""",
+                             [(cart_id, lager_id, device['id'], position, device['name'], device['barcode'],
+                               device['quantity'], device['max_quantity'])
+                              for position, device in enumerate(borrow_list)])
+        else:
+            conn.execute("DELETE FROM borrow_carts WHERE cart_id = ? AND lager_id = ?", (cart_id, lager_id))
+
+        expired = now - BORROW_CART_TTL
+        conn.execute("""DELETE FROM borrow_cart_items WHERE (cart_id, lager_id) IN
+                        (SELECT cart_id, lager_id FROM borrow_carts WHERE updated_at < ?)""", (expired,))
+        conn.execute("DELETE FROM borrow_carts WHERE updated_at < ?", (expired,))
+        if own_transaction:
+            conn.commit()
+    except Exception:
+        if own_transaction:
+            conn.rollback()
+        raise
+    finally:
+        conn.close()
+
+#------------------------Borrow Cart end-----------------------------------
+
+BORROW_BARCODES_SQL = """SELECT g.id, g.name, g.barcode, g.quantity, COALESCE(geraete_bestand.borrowed_quantity, 0)
+                         FROM json_each(?) scanned
+                         JOIN geraete g ON g.barcode = scanned.value
+                         LEFT JOIN geraete_bestand ON geraete_bestand.geraet_id = g.id"""
+
+def resolve_borrow_barcodes(conn, barcode_inputs):
+    """{barcode: (id, name, barcode, quantity, borrowed quantity)} for scanned lines, in one query"""
+    barcodes = sorted({line.strip() for line in barcode_inputs if line.strip()})
+    if not barcodes:
+        return {}
+    return {row[2]: row for row in conn.execute(BORROW_BARCODES_SQL, (json.dumps(barcodes),))}
+
 @app.route('/borrow', methods=['GET', 'POST'])
 def borrow():
     if 'current_lager' not in session:
@@ -1674,11 +3043,11 @@ def borrow():
         if 'add_device' in request.form:
             barcode_inputs = request.form['barcode'].strip().split('\n')
 
-            if 'borrow_list' not in session:
-                session['borrow_list'] = []
+            borrow_list = load_borrow_cart(session['current_lager'])
 
             conn = get_db_connection(session['current_lager'])
-            c = conn.cursor()
+            devices_by_barcode = resolve_borrow_barcodes(conn, barcode_inputs)
+            borrow_list_by_id = {d['id']: d for d in borrow_list}
 
             added_count = 0
             error_messages = []
@@ -1688,35 +3057,30 @@ def borrow():
                 if not barcode:
                     continue
 
-                c.execute("SELECT id, name, barcode, quantity FROM geraete WHERE barcode = ?", (barcode,))
-                device = c.fetchone()
+                device = devices_by_barcode.get(barcode)
 
                 if device:
-                    device_id, name, barcode_val, max_quantity = device
-                    # Check how many are already borrowed
-                    c.execute("SELECT SUM(ad.quantity) FROM ausleih_details ad JOIN ausleihen a ON ad.ausleih_id = a.ausleih_id WHERE ad.geraet_id = ? AND a.status = 'ausgeliehen'", (device_id,))
-                    already_borrowed = c.fetchone()[0] or 0
+                    device_id, name, barcode_val, max_quantity, already_borrowed = device
                     available = max_quantity - already_borrowed
 
                     if available <= 0:
                         error_messages.append(f"Gerät '{name}' ist nicht mehr verfügbar (alle {max_quantity} Exemplare ausgeliehen).")
                         continue
 
-                    existing = next((d for d in session['borrow_list'] if d['id'] == device_id), None)
+                    existing = borrow_list_by_id.get(device_id)
                     if existing:
                         if existing['quantity'] >= available:
                             error_messages.append(f"Maximale Anzahl für '{name}' bereits ausgewählt ({available}).")
                         else:
                             existing['quantity'] += 1
-                            session.modified = True
                             added_count += 1
                     else:
-                        session['borrow_list'].append({
+                        borrow_list_by_id[device_id] = {
                             'id': device_id, 'name': name, 'barcode': barcode_val,
                             'quantity': 1,
                             'max_quantity': available
-                        })
-                        session.modified = True
+                        }
+                        borrow_list.append(borrow_list_by_id[device_id])
                         added_count += 1
                 else:
                     error_messages.append(f"Gerät mit Barcode '{barcode}' nicht gefunden.")
@@ -1724,6 +3088,7 @@ def borrow():
             conn.close()
 
             if added_count > 0:
+                save_borrow_cart(session['current_lager'], borrow_list)
                 flash(f"{added_count} Gerät(e) erfolgreich zur Ausleihliste hinzugefügt.", "success")
             if error_messages:
                 for msg in error_messages:
@@ -1741,35 +3106,33 @@ def borrow():
                 email = request.form.get('email')
                 klasse = request.form.get('klasse')
             
-            if session.get('borrow_list'):
-                ausleih_id = generate_random_id(4)
-                
-                # BACKUP VOR dem Öffnen der Connection
-                backup_db(session['current_lager'], 'before_borrow')
-                
+            borrow_list = load_borrow_cart(session['current_lager'])
+            if borrow_list:
                 conn = get_db_connection(session['current_lager'])
-                c = conn.cursor()
-                
-                c.execute("INSERT INTO ausleihen (ausleih_id, mitarbeiter_id, mitarbeiter_name, zielort, datum, rueckgabe_qr, email, klasse) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
-                          (ausleih_id, borrower_id, borrower_name, 'N/A',
-                           datetime.now().strftime('%Y-%m-%d %H:%M:%S'), ausleih_id, email, klasse))
-                
-                for device in session['borrow_list']:
-                    c.execute("INSERT INTO ausleih_details (ausleih_id, geraet_id, geraet_barcode, quantity) VALUES (?, ?, ?, ?)",
-                              (ausleih_id, device['id'], device['barcode'], device['quantity']))
-                    update_device_status(session['current_lager'], device['id'], conn)
+                conn.execute("BEGIN IMMEDIATE")
+                try:
+                    ausleih_id = allocate_id(conn, 'ausleih_id')
+                    conn.execute("INSERT INTO ausleihen (ausleih_id, mitarbeiter_id, mitarbeiter_name, zielort, datum, rueckgabe_qr, email, klasse) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                                 (ausleih_id, borrower_id, borrower_name, 'N/A',
+                                  datetime.now().strftime('%Y-%m-%d %H:%M:%S'), ausleih_id, email, klasse))
+                    conn.executemany("INSERT INTO ausleih_details (ausleih_id, geraet_id, geraet_barcode, quantity) VALUES (?, ?, ?, ?)",
+                                     [(ausleih_id, device['id'], device['barcode'], device['quantity'])
+                                      for device in borrow_list])
+                    refresh_device_status(conn, [device['id'] for device in borrow_list])
+                    conn.commit()
+                except Exception:
+                    conn.rollback()
+                    raise
+                finally:
+                    conn.close()
                 
-                conn.commit()
-                conn.close()
+                warehouse_changed(session['current_lager'], 'borrow')
+                prerender_borrow_slip(session['current_lager'], ausleih_id)
                 
-                # BACKUP NACH dem Schließen der Connection
-                backup_db(session['current_lager'], 'after_borrow')
-                
-                session['borrow_list'] = []
-                session.modified = True
+                save_borrow_cart(session['current_lager'], [])
                 return redirect(url_for('borrow_success', ausleih_id=ausleih_id))
     
-    borrow_list = session.get('borrow_list', [])
+    borrow_list = load_borrow_cart(session['current_lager'])
     return render_template('borrow.html', title="Ausleihen", borrow_list=borrow_list, system_type=system_type)
 
 @app.route('/return', methods=['GET', 'POST'])
@@ -1785,28 +3148,28 @@ def return_devices():
             return redirect(url_for('return_devices', qr=qr_code))
         elif 'complete_return' in request.form:
             ausleih_id = request.form['ausleih_id']
-            device_ids = request.form.getlist('return_devices')
-            
-            # BACKUP VOR dem Öffnen der Connection
-            backup_db(session['current_lager'], 'before_return')
+            try:
+                device_ids = [int(device_id) for device_id in request.form.getlist('return_devices')]
+            except ValueError:
+                return "Ungültige Geräte-ID", 400
             
             conn = get_db_connection(session['current_lager'])
-            c = conn.cursor()
-            
-            for device_id in device_ids:
-                c.execute("DELETE FROM ausleih_details WHERE ausleih_id = ? AND geraet_id = ?", (ausleih_id, device_id))
-                update_device_status(session['current_lager'], device_id, conn)
-            
-            c.execute("SELECT COUNT(*) FROM ausleih_details WHERE ausleih_id = ?", (ausleih_id,))
-            remaining = c.fetchone()[0]
-            if remaining == 0:
-                c.execute("UPDATE ausleihen SET status = 'zurückgegeben' WHERE ausleih_id = ?", (ausleih_id,))
-            
-            conn.commit()
-            conn.close()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                conn.executemany("DELETE FROM ausleih_details WHERE ausleih_id = ? AND geraet_id = ?",
+                                 [(ausleih_id, device_id) for device_id in device_ids])
+                refresh_device_status(conn, device_ids)
+                conn.execute("""UPDATE ausleihen SET status = 'zurückgegeben'
+                                WHERE ausleih_id = ? AND NOT EXISTS (SELECT 1 FROM ausleih_details WHERE ausleih_id = ?)""",
+                             (ausleih_id, ausleih_id))
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+            finally:
+                conn.close()
             
-            # BACKUP NACH dem Schließen der Connection
-            backup_db(session['current_lager'], 'after_return')
+            warehouse_changed(session['current_lager'], 'return')
             
             return redirect(url_for('return_devices'))
     
@@ -1856,111 +3219,60 @@ def inventory():
     if 'current_lager' not in session:
         return redirect(url_for('dashboard'))
     
-    search = request.args.get('search', '')
-    status_filters = [f for f in request.args.getlist('status') if f]
-    art_filters = [f for f in request.args.getlist('art') if f]
-    klasse_filters = [f for f in request.args.getlist('klasse') if f]
-    sort_by = request.args.get('sort_by', 'name')
-    group_by = request.args.get('group_by', 'none') 
+    filters = device_list_filters()
+    
+    facets = get_filter_facets(session['current_lager'])
     
     conn = get_db_connection(session['current_lager'])
-    c = conn.cursor()
+    page = device_list_page(conn, 'inventory', filters)
+    conn.close()
+    
+    return stream_template('inventory.html', title="Inventar", page=page,
+                         instrumentenarten=facets['instrumentenart'], klassen=facets['klasse'], **filters)
 
-    query = """SELECT g.*, a.mitarbeiter_name, a.zielort, a.datum, a.email, a.klasse
-               FROM geraete g
-               LEFT JOIN ausleih_details ad ON g.id = ad.geraet_id
-               LEFT JOIN ausleihen a ON ad.ausleih_id = a.ausleih_id AND a.status = 'ausgeliehen'
-               WHERE 1=1"""
-    params = []
+@app.route('/api/devices')
+def api_devices():
+    """Device list without the page layout, for the live search.
+
+    Takes the same filters as /devices and /inventory. view=devices|inventory
+    selects the list; format=html returns only the list fragment, otherwise
+    JSON with the fields requested in fields (comma-separated).
+    """
+    if 'current_lager' not in session:
+        return jsonify({'success': False, 'message': 'Kein Lager ausgewählt'}), 400
     
-    if search:
-        query += " AND (g.name LIKE ? OR g.barcode LIKE ? OR g.lagerplatz LIKE ? OR g.seriennummer LIKE ? OR g.modell LIKE ? OR g.instrumentenart LIKE ? OR a.mitarbeiter_name LIKE ? OR a.klasse LIKE ?)"
-        params.extend([f'%{search}%'] * 8)
-    
-    if status_filters:
-        status_conditions = []
-        if "verfügbar" in status_filters:
-            status_conditions.append("g.status = 'verfügbar'")
-        if "ausgeliehen" in status_filters:
-            status_conditions.append("g.status LIKE 'ausgeliehen%'")
-        if status_conditions:
-            query += f" AND ({' OR '.join(status_conditions)})"
-    
-    if art_filters:
-        placeholders = ','.join('?' for _ in art_filters)
-        query += f" AND g.instrumentenart IN ({placeholders})"
-        params.extend(art_filters)
-    
-    if klasse_filters:
-        placeholders = ','.join('?' for _ in klasse_filters)
-        query += f" AND a.klasse IN ({placeholders})"
-        params.extend(klasse_filters)
-
-    if sort_by == 'instrumentenart':
-        query += " ORDER BY g.instrumentenart, g.name"
-    elif sort_by == 'lagerplatz':
-        query += " ORDER BY g.lagerplatz, g.name"
-    elif sort_by == 'status':
-        query += " ORDER BY g.status, g.name"
-    elif sort_by == 'model':
-        query += " ORDER BY g.modell, g.name"
-    else:
-        query += " ORDER BY g.name"
+    view = request.args.get('view', 'devices')
+    if view not in DEVICE_LIST_VIEWS:
+        return jsonify({'success': False, 'message': f'Unbekannte Ansicht: {view}'}), 400
+    spec = DEVICE_LIST_VIEWS[view]
+    filters = device_list_filters()
     
-    c.execute(query, params)
-    devices_list = c.fetchall()
+    conn = get_db_connection(session['current_lager'])
     
-    grouped_devices = {}
-    if group_by == 'model':
-        for device in devices_list:
-            model = device[7] or 'Unbekanntes Modell'
-            if model not in grouped_devices:
-                grouped_devices[model] = []
-            grouped_devices[model].append(device)
-    elif group_by == 'series':
-        for device in devices_list:
-            instrument = device[9] or 'Unbekanntes Instrument'
-            if instrument not in grouped_devices:
-                grouped_devices[instrument] = []
-            grouped_devices[instrument].append(device)
-    elif group_by == 'serial':
-        for device in devices_list:
-            serial = device[6] or ''
-            first_letter = serial[0].upper() if serial else 'Unbekannt'
-            if first_letter not in grouped_devices:
-                grouped_devices[first_letter] = []
-            grouped_devices[first_letter].append(device)
-    elif group_by == 'instrument':
-        for device in devices_list:
-            instrument = device[8] or 'Unbekanntes Instrument'
-            if instrument not in grouped_devices:
-                grouped_devices[instrument] = []
-            grouped_devices[instrument].append(device)
-    elif group_by == 'status':
-        for device in devices_list:
-            status = 'Verfügbar' if device[4] == 'verfügbar' else 'Ausgeliehen'
-            if status not in grouped_devices:
-                grouped_devices[status] = []
-            grouped_devices[status].append(device)
+    if request.args.get('format') == 'html':
+        page = device_list_page(conn, view, filters)
+        conn.close()
+        return stream_template(spec.template, page=page, **filters)
+    
+    fields = [name for name in request.args.get('fields', '').split(',') if name in spec.fields] or list(spec.fields)
+    page = device_list_page(conn, view, filters, fields)
+    if page.group_expr:
+        result = {'groups': [{'name': group.name, 'total': group.total, 'available': group.available,
+                              'continued': group.continued,
+                              'devices': [dict(zip(fields, device)) for device in group.devices]}
+                             for group in page.groups()]}
     else:
-        grouped_devices['Alle Geräte'] = devices_list
-
-    c.execute("SELECT DISTINCT instrumentenart FROM geraete WHERE instrumentenart IS NOT NULL")
-    instrumentenarten = [row[0] for row in c.fetchall()]
-    c.execute("SELECT DISTINCT klasse FROM ausleihen WHERE klasse IS NOT NULL")
-    klassen = [row[0] for row in c.fetchall()]
+        result = {'devices': [dict(zip(fields, device)) for device in page]}
     conn.close()
     
-    return render_template('inventory.html', title="Inventar", devices=devices_list, grouped_devices=grouped_devices,
-                         search=search, status_filters=status_filters,
-                         art_filters=art_filters, klasse_filters=klasse_filters,
-                         sort_by=sort_by, group_by=group_by, instrumentenarten=instrumentenarten, klassen=klassen)
+    result.update(success=True, fields=fields, next_cursor=page.next_cursor)
+    return jsonify(result)
 
 @app.route('/remove_from_borrow/<int:device_id>')
 def remove_from_borrow(device_id):
-    if 'borrow_list' in session:
-        session['borrow_list'] = [d for d in session['borrow_list'] if d['id'] != device_id]
-        session.modified = True
+    if 'current_lager' in session:
+        borrow_list = load_borrow_cart(session['current_lager'])
+        save_borrow_cart(session['current_lager'], [d for d in borrow_list if d['id'] != device_id])
     return redirect(url_for('borrow'))
 
 @app.route('/manage_lager')
@@ -1968,7 +3280,7 @@ def manage_lager():
     if 'user_id' not in session:
         return redirect(url_for('login'))
     
-    conn = sqlite3.connect('users.db')
+    conn = get_users_db_connection()
     c = conn.cursor()
     c.execute("SELECT id, name, created_by, access_users, system_type FROM lager WHERE created_by = ?", (session['user_id'],))
     lagers = c.fetchall()
@@ -1981,7 +3293,7 @@ def edit_lager(lager_id):
     if 'user_id' not in session:
         return redirect(url_for('login'))
     
-    conn = sqlite3.connect('users.db')
+    conn = get_users_db_connection()
     c = conn.cursor()
     
     if request.method == 'POST':
@@ -2011,17 +3323,539 @@ def delete_lager(lager_id):
     if 'user_id' not in session:
         return redirect(url_for('login'))
     
-    conn = sqlite3.connect('users.db')
+    conn = get_users_db_connection()
     c = conn.cursor()
     c.execute("DELETE FROM lager WHERE id = ? AND created_by = ?", (lager_id, session['user_id']))
     conn.commit()
     conn.close()
     
-    if os.path.exists(f'{lager_id}.db'):
-        os.remove(f'{lager_id}.db')
+    invalidate_filter_facets(lager_id)
+    retire_db_path(f'{lager_id}.db')
+    for suffix in ('.db', '.db-wal', '.db-shm'):
+        if os.path.exists(f'{lager_id}{suffix}'):
+            os.remove(f'{lager_id}{suffix}')
     
     return redirect(url_for('manage_lager'))
 
+#------------------------Process Pools-------------------------------------
+
+_process_pools = {}
+_process_pools_lock = threading.Lock()
+
+def process_pool_context():
+    """Start method for the rendering pools: forkserver where available, otherwise spawn"""
+    # Kein fork: der Server hat Threads (Reaper, Backups, Ausleihscheine), Locks und offene
+    # SQLite-Verbindungen; ein geforktes Kind würde sie in beliebigem Zustand erben.
+    # Die Worker importieren main.py neu und starten mit leeren Caches.
+    methods = multiprocessing.get_all_start_methods()
+    return multiprocessing.get_context('forkserver' if 'forkserver' in methods else 'spawn')
+
+def get_process_pool(name, workers):
+    """Named process pool for CPU-bound rendering, started on first use"""
+    with _process_pools_lock:
+        if name not in _process_pools:
+            _process_pools[name] = ProcessPoolExecutor(max_workers=workers, mp_context=process_pool_context())
+        return _process_pools[name]
+
+def shutdown_process_pool(name):
+    with _process_pools_lock:
+        pool = _process_pools.pop(name, None)
+    if pool is not None:
+        pool.shutdown(wait=False, cancel_futures=True)
+
+@atexit.register
+def shutdown_process_pools():
+    for name in list(_process_pools):
+        shutdown_process_pool(name)
+
+#------------------------Process Pools end---------------------------------
+
+#------------------------Labels--------------------------------------------
+
+# Optionaler Plattencache für QR-Matrizen (z.B. DMS_QR_CACHE_DIR=qr_cache)
+QR_CACHE_DIR = os.getenv('DMS_QR_CACHE_DIR')
+
+def build_qr_matrix(data, border=1, error_correction=qrcode.constants.ERROR_CORRECT_L):
+    """QR module matrix for data (tuple of rows, True = dark), including the quiet zone. Not cached."""
+    qr = qrcode.QRCode(version=1, error_correction=error_correction, box_size=10, border=border)
+    qr.add_data(str(data))
+    qr.make(fit=True)
+    return tuple(tuple(bool(cell) for cell in row) for row in qr.get_matrix())
+
+@lru_cache(maxsize=8192)
+def qr_matrix(data, border=1, error_correction=qrcode.constants.ERROR_CORRECT_L):
+    """build_qr_matrix, cached in memory and optionally on disk"""
+    cache_path = None
+    if QR_CACHE_DIR:
+        key = hashlib.sha1(f"{border}:{error_correction}:{data}".encode('utf-8')).hexdigest()
+        cache_path = os.path.join(QR_CACHE_DIR, key[:2], f"{key}.txt")
+        try:
+            with open(cache_path) as f:
+                return tuple(tuple(char == '1' for char in line) for line in f.read().split())
+        except OSError:
+            pass
+
+    matrix = build_qr_matrix(data, border, error_correction)
+
+    if cache_path:
+        try:
+            os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+            tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+            with open(tmp_path, 'w') as f:
+                f.write('\n'.join(''.join('1' if cell else '0' for cell in row) for row in matrix))
+            os.replace(tmp_path, cache_path)
+        except OSError as e:
+            print(f"QR-Cache nicht beschreibbar: {e}")
+    return matrix
+
+def qr_matrix_runs(matrix):
+    """Size of a QR matrix and its dark modules as horizontal runs (row, first column, length)"""
+    runs = []
+    for row_index, row in enumerate(matrix):
+        start = None
+        for col_index, dark in enumerate(row + (False,)):
+            if dark and start is None:
+                start = col_index
+            elif not dark and start is not None:
+                runs.append((row_index, start, col_index - start))
+                start = None
+    return len(matrix), tuple(runs)
+
+@lru_cache(maxsize=8192)
+def qr_dark_runs(data, border=1, error_correction=qrcode.constants.ERROR_CORRECT_L):
+    """qr_matrix_runs of the cached QR matrix for data"""
+    return qr_matrix_runs(qr_matrix(data, border, error_correction))
+
+def draw_qr_code(canvas, data, x, y, width, height):
+    """Draw a QR code as vector rectangles filling the box (x, y, width, height)"""
+    size, runs = qr_dark_runs(str(data))
+
+    canvas.saveState()
+    canvas.setFillColor(colors.white)
+    canvas.rect(x, y, width, height, stroke=0, fill=1)
+    # In Modul-Einheiten zeichnen: ganzzahlige Koordinaten halten den PDF-Inhalt klein
+    canvas.translate(x, y + height)
+    canvas.scale(width / size, -height / size)
+    path = canvas.beginPath()
+    for row, col, length in runs:
+        path.rect(col, row, length, 1)
+    canvas.setFillColor(colors.black)
+    canvas.drawPath(path, stroke=0, fill=1)
+    canvas.restoreState()
+
+LabelSheet = namedtuple('LabelSheet', 'label_width label_height margin page_height labels_per_row labels_per_page')
+
+def label_sheet(layout_data):
+    """Page geometry (A4) of a label layout"""
+    mm_to_pt = 2.834645669
+    label_width = float(layout_data.get('labelWidth', 50)) * mm_to_pt
+    label_height = float(layout_data.get('labelHeight', 30)) * mm_to_pt
+
+    page_width, page_height = A4
+    margin = 0.5 * cm
+
+    labels_per_row = max(1, int((page_width - 2 * margin) / label_width))
+    labels_per_col = max(1, int((page_height - 2 * margin) / label_height))
+    return LabelSheet(label_width, label_height, margin, page_height, labels_per_row, labels_per_row * labels_per_col)
+
+LABEL_FIELD_VALUES = {
+    'name': lambda device: device.name,
+    'barcode': lambda device: device.barcode,
+    'location': lambda device: device.lagerplatz,
+    'status': lambda device: device.status,
+    'beschreibung': lambda device: device.beschreibung or '',
+    'seriennummer': lambda device: device.seriennummer or '',
+    'modell': lambda device: device.modell or '',
+    'instrumentenart': lambda device: device.instrumentenart or '',
+    'inventarnummer': lambda device: device.inventarnummer or '',
+    'kaufdatum': lambda device: device.kaufdatum or '',
+    'preis': lambda device: f"{device.preis or 0} €",
+    'borrower_name': lambda device: device.mitarbeiter_name or '',
+    'destination': lambda device: device.zielort or '',
+    'borrow_date': lambda device: device.datum or '',
+    'email': lambda device: device.email or '',
+    'class': lambda device: device.klasse or '',
+}
+
+LABEL_MIN_FONT_SIZE = 6
+LABEL_MAX_FONT_SIZE = 24
+
+def label_field_value(device, field_type):
+    """Value of a label field for an inventory row (DeviceRow)"""
+    value_of = LABEL_FIELD_VALUES.get(field_type)
+    return value_of(device) if value_of else ''
+
+@lru_cache(maxsize=65536)
+def fit_font_size(text, max_width_pt, font_name, initial_font_size):
+    """Largest font size <= initial_font_size at which text fits into max_width_pt (binary search)"""
+    available = max_width_pt - 4
+    low, high = LABEL_MIN_FONT_SIZE, initial_font_size
+    if stringWidth(text, font_name, low) > available:
+        return LABEL_MIN_FONT_SIZE
+    while low < high:
+        middle = (low + high + 1) // 2
+        if stringWidth(text, font_name, middle) <= available:
+            low = middle
+        else:
+            high = middle - 1
+    return low
+
+LabelField = namedtuple('LabelField', 'value_of x y width height font_name initial_font_size align')
+LabelPlan = namedtuple('LabelPlan', 'sheet qr_fields text_fields static_fields')
+
+def _label_font_size(font_size_raw):
+    initial_font_size = 12
+    if isinstance(font_size_raw, str):
+        match = re.search(r'(\d+)', font_size_raw)
+        if match:
+            initial_font_size = int(match.group(1))
+    elif isinstance(font_size_raw, (int, float)):
+        initial_font_size = int(font_size_raw)
+    return max(LABEL_MIN_FONT_SIZE, min(initial_font_size, LABEL_MAX_FONT_SIZE))
+
+def compile_label_plan(layout_data):
+    """Compile a label layout (layout_data from label_layouts) into a LabelPlan.
+
+    Field coordinates are relative to the label's lower left corner and
+    already converted to points. Static texts go into static_fields and are
+    drawn only once, into the label template.
+    """
+    sheet = label_sheet(layout_data)
+    px_to_pt = 0.75
+    qr_fields, text_fields, static_fields = [], [], []
+
+    for field in layout_data.get('fields', []):
+        field_type = field.get('type', 'text')
+        width = field.get('width', 100) * px_to_pt
+        height = field.get('height', 20) * px_to_pt
+        x = field.get('x', 0) * px_to_pt
+        y = sheet.label_height - field.get('y', 0) * px_to_pt - height
+
+        if field_type == 'qr':
+            qr_fields.append(LabelField(LABEL_FIELD_VALUES['barcode'], x, y, width, height, None, None, None))
+            continue
+
+        font_name = 'Helvetica-Bold' if field.get('fontWeight', 'normal') == 'bold' else 'Helvetica'
+        compiled = LabelField(None, x, y, width, height, font_name, _label_font_size(field.get('fontSize', '12px')),
+                              field.get('textAlign', 'left'))
+        if field_type == 'text':
+            text = field.get('text', 'Text')
+            if text:
+                static_fields.append((compiled, str(text)))
+        elif field_type in LABEL_FIELD_VALUES:
+            text_fields.append(compiled._replace(value_of=LABEL_FIELD_VALUES[field_type]))
+
+    return LabelPlan(sheet, tuple(qr_fields), tuple(text_fields), tuple(static_fields))
+
+def draw_label_text(canvas, field, text, x, y):
+    """Draw text fitted into a compiled text field of the label at x, y"""
+    font_size = fit_font_size(text, field.width, field.font_name, field.initial_font_size)
+    canvas.setFont(field.font_name, font_size)
+
+    text_x = x + field.x + 2
+    if field.align == 'center':
+        text_x = x + field.x + field.width / 2
+    elif field.align == 'right':
+        text_x = x + field.x + field.width - 2
+    text_y = y + field.y + (field.height / 2) - (font_size / 3)
+
+    try:
+        if field.align == 'center':
+            canvas.drawCentredString(text_x, text_y, text)
+        elif field.align == 'right':
+            canvas.drawRightString(text_x, text_y, text)
+        else:
+            canvas.drawString(text_x, text_y, text)
+    except Exception as e:
+        print(f"[v0] Error drawing text: {e}")
+
+LABEL_TEMPLATE_FORM = 'label_template'
+LABEL_PAGE_FORM = 'label_page'
+
+def label_positions(sheet, count):
+    """Lower left corners of the first count labels on a page"""
+    for label_index in range(count):
+        row = label_index // sheet.labels_per_row
+        col = label_index % sheet.labels_per_row
+        yield sheet.margin + (col * sheet.label_width), sheet.page_height - sheet.margin - ((row + 1) * sheet.label_height)
+
+def define_label_forms(canvas, plan):
+    """Static label content (frame, fixed texts) as form XObjects: one label and one full page"""
+    canvas.beginForm(LABEL_TEMPLATE_FORM)
+    canvas.setStrokeColor(colors.black)
+    canvas.setLineWidth(0.5)
+    canvas.rect(0, 0, plan.sheet.label_width, plan.sheet.label_height)
+    canvas.setFillColor(colors.black)
+    for field, text in plan.static_fields:
+        draw_label_text(canvas, field, text, 0, 0)
+    canvas.endForm()
+
+    canvas.beginForm(LABEL_PAGE_FORM)
+    for x, y in label_positions(plan.sheet, plan.sheet.labels_per_page):
+        canvas.saveState()
+        canvas.translate(x, y)
+        canvas.doForm(LABEL_TEMPLATE_FORM)
+        canvas.restoreState()
+    canvas.endForm()
+
+def draw_label_page(canvas, devices, plan):
+    """Draw one page of labels: the static template, then QR codes and device texts"""
+    if len(devices) == plan.sheet.labels_per_page:
+        canvas.doForm(LABEL_PAGE_FORM)
+    else:
+        for x, y in label_positions(plan.sheet, len(devices)):
+            canvas.saveState()
+            canvas.translate(x, y)
+            canvas.doForm(LABEL_TEMPLATE_FORM)
+            canvas.restoreState()
+
+    canvas.setFillColor(colors.black)
+    for device, (x, y) in zip(devices, label_positions(plan.sheet, len(devices))):
+        for field in plan.qr_fields:
+            try:
+                draw_qr_code(canvas, field.value_of(device), x + field.x, y + field.y, field.width, field.height)
+            except Exception as e:
+                print(f"[v0] Error generating QR code: {e}")
+        for field in plan.text_fields:
+            text = field.value_of(device)
+            if text:
+                draw_label_text(canvas, field, str(text), x, y)
+
+LABEL_WORKERS = int(os.getenv('DMS_LABEL_WORKERS', os.cpu_count() or 1))
+LABEL_PAGES_PER_CHUNK = 25  # kleinere Teilaufträge verteilen sich gleichmäßiger auf die Prozesse
+
+def write_label_pdf(devices, layout_data):
+    """Label sheets (A4) for a list of inventory rows as a BytesIO.
+
+    With pypdf and more than one label worker (DMS_LABEL_WORKERS) the pages
+    are rendered in chunks in parallel and merged.
+    """
+    sheet = label_sheet(layout_data)
+    page_count = -(-len(devices) // sheet.labels_per_page)
+    chunk_size = sheet.labels_per_page * LABEL_PAGES_PER_CHUNK
+
+    if PdfWriter is not None and LABEL_WORKERS > 1 and page_count > LABEL_PAGES_PER_CHUNK:
+        try:
+            return BytesIO(render_label_chunks(devices, layout_data, chunk_size))
+        except BrokenProcessPool as e:
+            print(f"Label-Prozesse abgebrochen, erzeuge Etiketten ohne Parallelisierung: {e}")
+            shutdown_process_pool('labels')
+
+    return BytesIO(render_label_pages(devices, layout_data))
+
+def render_label_pages(devices, layout_data):
+    """Render label pages for devices and return the PDF bytes"""
+    plan = compile_label_plan(layout_data)
+    per_page = plan.sheet.labels_per_page
+    buffer = BytesIO()
+    pdf_canvas = pdfcanvas.Canvas(buffer, pagesize=A4)
+    define_label_forms(pdf_canvas, plan)
+
+    for start in range(0, len(devices), per_page):
+        if start:
+            pdf_canvas.showPage()
+        draw_label_page(pdf_canvas, devices[start:start + per_page], plan)
+
+    pdf_canvas.save()
+    return buffer.getvalue()
+
+def _render_label_chunk(fields, rows, layout_data):
+    """Process pool entry point: rows travel as plain tuples, the row class is rebuilt here"""
+    row_type = device_row_type(fields)
+    return render_label_pages([row_type._make(row) for row in rows], layout_data)
+
+def render_label_chunks(devices, layout_data, chunk_size):
+    """Render whole-page device ranges in the label pool and merge them in order"""
+    fields = devices[0]._fields
+    pool = get_process_pool('labels', LABEL_WORKERS)
+    futures = [
+        pool.submit(_render_label_chunk, fields, [tuple(device) for device in devices[start:start + chunk_size]], layout_data)
+        for start in range(0, len(devices), chunk_size)
+    ]
+
+    writer = PdfWriter()
+    for future in futures:
+        writer.append(PdfReader(BytesIO(future.result())))
+    buffer = BytesIO()
+    writer.write(buffer)
+    return buffer.getvalue()
+
+#------------------------Labels end----------------------------------------
+
+#------------------------QR Images-----------------------------------------
+
+QR_IMAGE_FORMATS = {'svg': 'image/svg+xml', 'png': 'image/png'}
+QR_IMAGE_BORDER = 5
+# Wie früher generate_qr_code (qrcode-Standard M); Etiketten nutzen L
+QR_IMAGE_ERROR_CORRECTION = qrcode.constants.ERROR_CORRECT_M
+QR_IMAGE_BOX_SIZES = range(1, 21)  # Pixel pro Modul, ?size=
+QR_IMAGE_MAX_PAYLOAD = 256         # Zeichen; Barcodes und Ausleih-IDs sind viel kürzer
+QR_KNOWN_PAYLOAD_SQL = """SELECT 1 FROM geraete WHERE barcode = ?
+                          UNION ALL SELECT 1 FROM ausleihen WHERE ausleih_id = ? LIMIT 1"""
+
+def qr_image_bytes(size, runs, image_format, box_size):
+    """Encode QR runs as SVG or PNG. Returns (bytes, etag)."""
+    if image_format == 'svg':
+        path = ''.join(f"M{col},{row}h{length}v1h-{length}z" for row, col, length in runs)
+        data = (f'<svg xmlns="http://www.w3.org/2000/svg" viewBox="0 0 {size} {size}" '
+                f'width="{size * box_size}" height="{size * box_size}" shape-rendering="crispEdges">'
+                f'<rect width="{size}" height="{size}" fill="#fff"/><path d="{path}" fill="#000"/></svg>').encode('utf-8')
+    else:
+        img = PILImage.new('1', (size, size), 1)
+        for row, col, length in runs:
+            img.paste(0, (col, row, col + length, row + 1))
+        buffer = io.BytesIO()
+        img.resize((size * box_size, size * box_size), PILImage.NEAREST).save(buffer, format='PNG', optimize=True)
+        data = buffer.getvalue()
+    return data, hashlib.sha1(data).hexdigest()
+
+@lru_cache(maxsize=1024)
+def render_qr_image(payload, image_format, box_size=10):
+    """QR code image for payload as (bytes, etag), cached per payload, format and size"""
+    return qr_image_bytes(*qr_dark_runs(payload, QR_IMAGE_BORDER, QR_IMAGE_ERROR_CORRECTION), image_format, box_size)
+
+def is_known_qr_payload(lager_id, payload):
+    """Whether payload is a barcode or ausleih_id of the warehouse, i.e. generated by the app.
+
+    A stale current_lager (deleted or missing warehouse) counts as unknown.
+    """
+    # Nicht über get_db_connection eine leere <id>.db anlegen
+    if not lager_id or not os.path.exists(f'{lager_id}.db'):
+        return False
+    try:
+        conn = get_db_connection(lager_id)
+        try:
+            return conn.execute(QR_KNOWN_PAYLOAD_SQL, (payload, payload)).fetchone() is not None
+        finally:
+            conn.close()
+    except sqlite3.Error as e:
+        print(f"QR-Prüfung für Lager {lager_id} fehlgeschlagen: {e}")
+        return False
+
+@app.route('/qr/<path:payload>.<any(svg, png):image_format>')
+def qr_image(payload, image_format):
+    """QR code as SVG or PNG. The URL fully determines the image, so it may be cached forever."""
+    if 'user_id' not in session:
+        return redirect(url_for('login'))
+
+    box_size = request.args.get('size', 10, type=int)
+    if box_size not in QR_IMAGE_BOX_SIZES:
+        return "Ungültige Größe", 400
+    if len(payload) > QR_IMAGE_MAX_PAYLOAD:
+        return "Inhalt zu lang", 400
+
+    try:
+        if is_known_qr_payload(session.get('current_lager'), payload):
+            data, etag = render_qr_image(payload, image_format, box_size)
+        else:
+            # Beliebige Inhalte nicht in Speicher- und Plattencache aufnehmen
+            data, etag = qr_image_bytes(*qr_matrix_runs(build_qr_matrix(payload, QR_IMAGE_BORDER, QR_IMAGE_ERROR_CORRECTION)), image_format, box_size)
+    except (ValueError, qrcode.exceptions.DataOverflowError):
+        return "Inhalt passt nicht in einen QR-Code", 400
+
+    response = Response(data, mimetype=QR_IMAGE_FORMATS[image_format])
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'private, max-age=31536000, immutable'
+    return response.make_conditional(request)
+
+#------------------------QR Images end-------------------------------------
+
+CSV_EXPORT_HEADER = ['Name', 'Barcode', 'Lagerplatz', 'Status', 'Beschreibung', 'Seriennummer', 'Modell', 'Hersteller', 'Instrumentenart', 'Inventar-Nummer', 'Kaufdatum', 'Preis', 'Ausgeliehen an', 'Email', 'Klasse', 'Menge']
+CSV_EXPORT_CHUNK_ROWS = 500
+
+def generate_csv_export(conn, query, params, compress=False):
+    """Yield the CSV export in chunks of CSV_EXPORT_CHUNK_ROWS rows.
+
+    With compress the chunks are one continuous gzip stream. The connection
+    is closed when the generator finishes.
+    """
+    output = io.StringIO()
+    writer = csv.writer(output)
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31) if compress else None
+
+    def take_chunk():
+        data = output.getvalue().encode('utf-8')
+        output.seek(0)
+        output.truncate()
+        return compressor.compress(data) if compressor else data
+
+    try:
+        writer.writerow(CSV_EXPORT_HEADER)
+        for count, (device, key) in enumerate(device_rows(conn, query, params), 1):
+            writer.writerow([device.name, device.barcode, device.lagerplatz, device.status, device.beschreibung, device.seriennummer, device.modell, device.hersteller or '', device.instrumentenart, device.inventarnummer or '', device.kaufdatum or '', device.preis or '', device.mitarbeiter_name or '', device.email or '', device.klasse or '', device.quantity or 1])
+            if count % CSV_EXPORT_CHUNK_ROWS == 0:
+                chunk = take_chunk()
+                if chunk:
+                    yield chunk
+        chunk = take_chunk()
+        if chunk:
+            yield chunk
+        if compressor:
+            yield compressor.flush()
+    finally:
+        conn.close()
+
+WORD_EXPORT_HEADER = ['Name', 'Barcode', 'Lagerplatz', 'Status', 'Beschreibung', 'Seriennummer', 'Modell', 'Instrumentenart', 'Inventar-Nummer', 'Kaufdatum', 'Preis', 'Ausgeliehen an', 'Email', 'Klasse']
+WORD_EXPORT_BATCH_ROWS = 1000
+WORD_NAMESPACE = nsmap['w']
+
+# Zeichen, die in XML 1.0 nicht vorkommen dürfen
+_XML_INVALID_CHARS = re.compile('[\x00-\x08\x0b\x0c\x0e-\x1f\ufffe\uffff]')
+
+def _docx_cell_xml(text, width):
+    """<w:tc> for a table cell, the same XML python-docx writes for cell.text = text"""
+    runs = []
+    for piece in re.split(r'([\t\n\r])', _XML_INVALID_CHARS.sub('', text)):
+        if piece == '\t':
+            runs.append('<w:tab/>')
+        elif piece in ('\n', '\r'):
+            runs.append('<w:br/>')
+        elif piece:
+            space = ' xml:space="preserve"' if piece != piece.strip() else ''
+            runs.append(f'<w:t{space}>{xml_escape(piece)}</w:t>')
+    run = f"<w:r>{''.join(runs)}</w:r>" if runs else '<w:r/>'
+    return f'<w:tc><w:tcPr><w:tcW w:type="dxa" w:w="{width}"/></w:tcPr><w:p>{run}</w:p></w:tc>'
+
+def write_word_export(devices):
+    """Word export of inventory rows (DeviceRow) as a BytesIO.
+
+    The document is the one python-docx builds with add_row() and cell.text,
+    but the rows are written as XML and parsed in batches of
+    WORD_EXPORT_BATCH_ROWS instead of going through the cell objects.
+    """
+    doc = Document()
+    doc.add_heading('Geräte Export', 0)
+    
+    table = doc.add_table(rows=1, cols=len(WORD_EXPORT_HEADER))
+    for cell, header in zip(table.rows[0].cells, WORD_EXPORT_HEADER):
+        cell.text = header
+    
+    tbl = table._tbl
+    widths = [grid_col.w.twips if grid_col.w is not None else 0 for grid_col in tbl.tblGrid.gridCol_lst]
+    
+    def append_rows(rows_xml):
+        parsed = parse_xml(f'<w:tbl xmlns:w="{WORD_NAMESPACE}">{"".join(rows_xml)}</w:tbl>')
+        for row in list(parsed):
+            tbl.append(row)
+    
+    rows_xml = []
+    for device in devices:
+        values = [device.name, device.barcode, device.lagerplatz, device.status, device.beschreibung,
+                  device.seriennummer, device.modell, device.instrumentenart, device.inventarnummer,
+                  device.kaufdatum, str(device.preis or '') + ' €', device.mitarbeiter_name, device.email, device.klasse]
+        cells = ''.join(_docx_cell_xml('' if value is None else str(value), width) for value, width in zip(values, widths))
+        rows_xml.append(f'<w:tr>{cells}</w:tr>')
+        if len(rows_xml) >= WORD_EXPORT_BATCH_ROWS:
+            append_rows(rows_xml)
+            rows_xml = []
+    if rows_xml:
+        append_rows(rows_xml)
+    
+    buffer = BytesIO()
+    doc.save(buffer)
+    buffer.seek(0)
+    return buffer
+
 @app.route('/export')
 def export():
     if 'current_lager' not in session:
@@ -2041,91 +3875,35 @@ def export():
         art_filters = [f for f in request.args.get('art', '').split(',') if f]
         klasse_filters = [f for f in request.args.get('klasse', '').split(',') if f]
     
-    conn = get_db_connection(session['current_lager'])
-    c = conn.cursor()
-    
-    query = """SELECT g.*, a.mitarbeiter_name, a.zielort, a.datum, a.email, a.klasse
-               FROM geraete g
-               LEFT JOIN ausleih_details ad ON g.id = ad.geraet_id
-               LEFT JOIN ausleihen a ON ad.ausleih_id = a.ausleih_id AND a.status = 'ausgeliehen'
-               WHERE 1=1"""
-    params = []
+    filters = {'search': search, 'status_filters': status_filters, 'art_filters': art_filters,
+               'klasse_filters': klasse_filters, 'sort_by': 'instrumentenart', 'group_by': 'none'}
     
-    if search:
-        query += " AND (g.name LIKE ? OR g.barcode LIKE ? OR g.lagerplatz LIKE ? OR g.seriennummer LIKE ? OR g.modell LIKE ? OR g.instrumentenart LIKE ? OR a.mitarbeiter_name LIKE ? OR a.klasse LIKE ?)"
-        params.extend([f'%{search}%'] * 8)
-    
-    if status_filters:
-        status_conditions = []
-        if "verfügbar" in status_filters:
-            status_conditions.append("g.status = 'verfügbar'")
-        if "ausgeliehen" in status_filters:
-            status_conditions.append("g.status LIKE 'ausgeliehen%'")
-        if status_conditions:
-            query += f" AND ({' OR '.join(status_conditions)})"
-    
-    if art_filters:
-        placeholders = ','.join('?' for _ in art_filters)
-        query += f" AND g.instrumentenart IN ({placeholders})"
-        params.extend(art_filters)
-    
-    if klasse_filters:
-        placeholders = ','.join('?' for _ in klasse_filters)
-        query += f" AND a.klasse IN ({placeholders})"
-        params.extend(klasse_filters)
-    
-    query += " ORDER BY g.instrumentenart, g.name"
-    c.execute(query, params)
-    devices_list = c.fetchall()
-    conn.close()
+    conn = get_db_connection(session['current_lager'])
+    query, params = device_query(conn, 'inventory', filters)
     
     if format_type == 'csv':
-        output = io.StringIO()
-        writer = csv.writer(output)
-        writer.writerow(['Name', 'Barcode', 'Lagerplatz', 'Status', 'Beschreibung', 'Seriennummer', 'Modell', 'Hersteller', 'Instrumentenart', 'Inventar-Nummer', 'Kaufdatum', 'Preis', 'Ausgeliehen an', 'Email', 'Klasse'])
-
-        for device in devices_list:
-            writer.writerow([device[1], device[2], device[3], device[4], device[5], device[6], device[7], device[13] or '', device[8], device[9] or '', device[10] or '', device[11] or '', device[12] or '', device[15] or '', device[16] or ''])
-        
-        output.seek(0)
-        return send_file(io.BytesIO(output.getvalue().encode('utf-8')), 
-                        mimetype='text/csv', as_attachment=True, download_name='export.csv')
-    
-    elif format_type == 'word':
-        doc = Document()
-        doc.add_heading('Geräte Export', 0)
-        
-        table = doc.add_table(rows=1, cols=14)
-        hdr_cells = table.rows[0].cells
-        headers = ['Name', 'Barcode', 'Lagerplatz', 'Status', 'Beschreibung', 'Seriennummer', 'Modell', 'Instrumentenart', 'Inventar-Nummer', 'Kaufdatum', 'Preis', 'Ausgeliehen an', 'Email', 'Klasse']
-        
-        for i, header in enumerate(headers):
-            hdr_cells[i].text = header
-        
-        for device in devices_list:
-            row_cells = table.add_row().cells
-            row_cells[0].text = device[1]
-            row_cells[1].text = device[2]
-            row_cells[2].text = device[3]
-            row_cells[3].text = device[4]
-            row_cells[4].text = device[5] or ''
-            row_cells[5].text = device[6] or ''
-            row_cells[6].text = device[7] or ''
-            row_cells[7].text = device[8] or ''
-            row_cells[8].text = device[9] or ''
-            row_cells[9].text = device[10] or ''
-            row_cells[10].text = str(device[11] or '') + ' €'
-            row_cells[11].text = device[12] or ''
-            row_cells[12].text = device[15] or ''
-            row_cells[13].text = device[16] or ''
-        
-        buffer = BytesIO()
-        doc.save(buffer)
-        buffer.seek(0)
+        # gzip=1: komprimiert übertragen, sofern der Browser gzip annimmt
+        compress = request.args.get('gzip') == '1' and 'gzip' in request.accept_encodings
+        response = Response(stream_with_context(generate_csv_export(conn, query, params, compress)), mimetype='text/csv')
+        response.headers['Content-Disposition'] = 'attachment; filename=export.csv'
+        response.headers['Vary'] = 'Accept-Encoding'
+        if compress:
+            response.headers['Content-Encoding'] = 'gzip'
+        return response
+    
+    if format_type == 'word':
+        # Zeilen direkt aus dem Cursor in das Dokument schreiben, ohne Zwischenliste
+        try:
+            buffer = write_word_export(device for device, key in device_rows(conn, query, params))
+        finally:
+            conn.close()
         return send_file(buffer, mimetype='application/vnd.openxmlformats-officedocument.wordprocessingml.document', 
                         as_attachment=True, download_name='export.docx')
     
-    elif format_type == 'pdf_labels':
+    devices_list = [device for device, key in device_rows(conn, query, params)]
+    conn.close()
+    
+    if format_type == 'pdf_labels':
         conn_layout = get_db_connection(session['current_lager'])
         c_layout = conn_layout.cursor()
         c_layout.execute("SELECT layout_data FROM label_layouts WHERE is_default = 1 LIMIT 1")
@@ -2142,203 +3920,8 @@ def export():
                         mimetype='text/plain', as_attachment=True, download_name='error.txt')
         
         layout_data = json.loads(layout_result[0])
-
-        label_width_mm = float(layout_data.get('labelWidth', 50))
-        label_height_mm = float(layout_data.get('labelHeight', 30))
-
-        mm_to_pt = 2.834645669
-        label_width_pt = label_width_mm * mm_to_pt
-        label_height_pt = label_height_mm * mm_to_pt
-
-        page_width, page_height = A4
-        margin = 0.5 * cm
-
-        usable_width = page_width - 2 * margin
-        usable_height = page_height - 2 * margin
-
-        labels_per_row = max(1, int(usable_width / label_width_pt))
-        labels_per_col = max(1, int(usable_height / label_height_pt))
-        labels_per_page = labels_per_row * labels_per_col
-        
-        buffer = BytesIO()
-        
-        def get_field_value(device, field_type):
-            """Get the actual value for a field type from device data"""
-            field_mapping = {
-                'name': device[1],
-                'barcode': device[2],
-                'location': device[3],
-                'status': device[4],
-                'beschreibung': device[5] or '',
-                'seriennummer': device[6] or '',
-                'modell': device[7] or '',
-                'instrumentenart': device[8] or '',
-                'inventarnummer': device[9] or '',
-                'kaufdatum': device[10] or '',
-                'preis': f"{device[11] or 0} €",
-                'borrower_name': device[12] or '',
-                'destination': device[13] or '',
-                'borrow_date': device[14] or '',
-                'email': device[15] or '',
-                'class': device[16] or '',
-                'borrower_id': '',
-                'text': ''
-            }
-            return field_mapping.get(field_type, '')
-        
-        def create_qr_code_image(data, width_pt, height_pt):
-            """
-            Generate QR code image and return as ReportLab Image object.
-            
-            Args:
-                data: The data to encode in the QR code (e.g., barcode)
-                width_pt: Width in points for the QR code image
-                height_pt: Height in points for the QR code image
-            
-            Returns:
-                ReportLab Image object ready to be drawn on canvas
-            """
-            import qrcode
-            from reportlab.platypus import Image as RLImage
-            from io import BytesIO
-            
-            qr = qrcode.QRCode(
-                version=1, 
-                error_correction=qrcode.constants.ERROR_CORRECT_L,
-                box_size=10,
-                border=1,
-            )
-            
-            qr.add_data(str(data))
-            qr.make(fit=True)
-            
-            pil_img = qr.make_image(fill_color="black", back_color="white")
-            
-            img_buffer = BytesIO()
-            pil_img.save(img_buffer, format='PNG')
-            img_buffer.seek(0)
-
-            return RLImage(img_buffer, width=width_pt, height=height_pt)
-        
-        def calculate_font_size(text, max_width_pt, max_height_pt, initial_font_size):
-            """Calculate appropriate font size to fit text in given dimensions"""
-            from reportlab.pdfbase.pdfmetrics import stringWidth
-            
-            font_size = initial_font_size
-            min_font_size = 6
-            
-            while font_size >= min_font_size:
-                text_width = stringWidth(str(text), 'Helvetica', font_size)
-                
-                if text_width <= (max_width_pt - 4):
-                    return font_size
-                
-                font_size -= 1
-            
-            return min_font_size
-        
-        def create_single_label(device, canvas, x, y, width, height):
-            """Draw a single label at the specified position"""
-            
-            canvas.setStrokeColor(colors.black)
-            canvas.setLineWidth(0.5)
-            canvas.rect(x, y, width, height)
-            
-            fields = layout_data.get('fields', [])
-            
-            px_to_pt = 0.75
-            
-            for field in fields:
-                field_type = field.get('type', 'text')
-                field_x_px = field.get('x', 0)
-                field_y_px = field.get('y', 0)
-                field_width_px = field.get('width', 100)
-                field_height_px = field.get('height', 20)
-                
-                field_x_pt = x + (field_x_px * px_to_pt)
-                field_y_pt = y + height - (field_y_px * px_to_pt) - (field_height_px * px_to_pt)
-                field_width_pt = field_width_px * px_to_pt
-                field_height_pt = field_height_px * px_to_pt
-                
-                if field_type == 'qr':
-                    try:
-                        qr_data = device[2]
-                        qr_img = create_qr_code_image(qr_data, field_width_pt, field_height_pt)
-                        qr_img.drawOn(canvas, field_x_pt, field_y_pt)
-                    except Exception as e:
-                        print(f"[v0] Error generating QR code: {e}")
-                    
-                else:
-                    field_value = get_field_value(device, field_type)
-                    
-                    if field_type == 'text':
-                        field_value = field.get('text', 'Text')
-                    
-                    if field_value:
-                        font_size_raw = field.get('fontSize', '12px')
-                        initial_font_size = 12
-                        
-                        if isinstance(font_size_raw, str):
-                            match = re.search(r'(\d+)', font_size_raw)
-                            if match:
-                                initial_font_size = int(match.group(1))
-                        elif isinstance(font_size_raw, (int, float)):
-                            initial_font_size = int(font_size_raw)
-                        
-                        initial_font_size = max(6, min(initial_font_size, 24))
-                        
-                        font_size = calculate_font_size(str(field_value), field_width_pt, field_height_pt, initial_font_size)
-                        
-                        font_weight = field.get('fontWeight', 'normal')
-                        font_name = 'Helvetica-Bold' if font_weight == 'bold' else 'Helvetica'
-                        canvas.setFont(font_name, font_size)
-                        
-
-                        canvas.setFillColor(colors.black)
-                        
-                        text_align = field.get('textAlign', 'left')
-                        
-                        text_x = field_x_pt + 2 
-                        if text_align == 'center':
-                            text_x = field_x_pt + field_width_pt / 2
-                        elif text_align == 'right':
-                            text_x = field_x_pt + field_width_pt - 2
-                        
-                        text_y = field_y_pt + (field_height_pt / 2) - (font_size / 3)
-                        
-                        try:
-                            if text_align == 'center':
-                                canvas.drawCentredString(text_x, text_y, str(field_value))
-                            elif text_align == 'right':
-                                canvas.drawRightString(text_x, text_y, str(field_value))
-                            else:
-                                canvas.drawString(text_x, text_y, str(field_value))
-                        except Exception as e:
-                            print(f"[v0] Error drawing text: {e}")
-        
-        from reportlab.pdfgen import canvas as pdfcanvas
-        
-        pdf_canvas = pdfcanvas.Canvas(buffer, pagesize=A4)
         
-        device_count = 0
-        for device in devices_list:
-            label_index = device_count % labels_per_page
-            
-            row = label_index // labels_per_row
-            col = label_index % labels_per_row
-            
-            label_x = margin + (col * label_width_pt)
-            label_y = page_height - margin - ((row + 1) * label_height_pt)
-            
-            create_single_label(device, pdf_canvas, label_x, label_y, label_width_pt, label_height_pt)
-            
-            device_count += 1
-
-            if device_count % labels_per_page == 0 and device_count < len(devices_list):
-                pdf_canvas.showPage()
-        
-        pdf_canvas.save()
-        buffer.seek(0)
+        buffer = write_label_pdf(devices_list, layout_data)
         
         return send_file(buffer, mimetype='application/pdf', 
                         as_attachment=True, download_name='etiketten.pdf')
@@ -2559,7 +4142,127 @@ def logout():
     session.clear()
     return redirect(url_for('login'))
 
+#------------------------Benchmarks----------------------------------------
+
+def _benchmark_warehouse(directory, device_count):
+    """Temporary warehouse database with device_count generated devices"""
+    db_path = os.path.join(directory, f'benchmark_{device_count}.db')
+    apply_migrations(db_path, WAREHOUSE_MIGRATIONS, backup=False)
+    conn = _get_pooled_connection(db_path)
+    conn.executemany("""INSERT INTO geraete (name, barcode, lagerplatz, beschreibung, seriennummer, modell, instrumentenart,
+                                            inventarnummer, kaufdatum, preis, quantity, hersteller)
+                        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, 1, ?)""",
+                     ((f'Gerät {i}', f'{i:08d}', f'Regal {i % 40}', f'[2024-01-01 08:00:00 - Benchmark] Eintrag {i}\n\nÄlterer Eintrag',
+                       f'SN{i:07d}', f'Modell {i % 25}', ('Geige', 'Bratsche', 'Cello', 'Kontrabass')[i % 4],
+                       f'INV-{i}', '2024-01-01', 100 + i % 900, 'Hersteller') for i in range(device_count)))
+    conn.commit()
+    return conn
+
+def benchmark_word_export(sizes=(1000, 10000, 50000)):
+    """Time the Word export (query and document) for several inventory sizes"""
+    filters = {'search': '', 'status_filters': [], 'art_filters': [], 'klasse_filters': [],
+               'sort_by': 'instrumentenart', 'group_by': 'none'}
+    with tempfile.TemporaryDirectory() as directory:
+        for size in sizes:
+            conn = _benchmark_warehouse(directory, size)
+            start = time.perf_counter()
+            query, params = device_query(conn, 'inventory', filters)
+            buffer = write_word_export(device for device, key in device_rows(conn, query, params))
+            elapsed = time.perf_counter() - start
+            print(f"word_export {size:>6} Geräte: {elapsed:7.2f} s, {len(buffer.getvalue()) / 1e6:6.1f} MB")
+            conn.close()
+            close_idle_db_connections(0, conn.db_path)
+
+BENCHMARK_LABEL_LAYOUT = {
+    'labelWidth': 50, 'labelHeight': 30,
+    'fields': [
+        {'type': 'qr', 'x': 4, 'y': 4, 'width': 96, 'height': 96},
+        {'type': 'name', 'x': 104, 'y': 8, 'width': 80, 'height': 20, 'fontSize': '14px', 'fontWeight': 'bold'},
+        {'type': 'barcode', 'x': 104, 'y': 36, 'width': 80, 'height': 16, 'fontSize': '12px'},
+        {'type': 'instrumentenart', 'x': 104, 'y': 60, 'width': 80, 'height': 16, 'fontSize': '10px'},
+    ],
+}
+
+def benchmark_label_pdf(sizes=(1000, 5000, 10000)):
+    """Time the label PDF export (query and PDF) for several inventory sizes"""
+    filters = {'search': '', 'status_filters': [], 'art_filters': [], 'klasse_filters': [],
+               'sort_by': 'instrumentenart', 'group_by': 'none'}
+    parallel = PdfWriter is not None and LABEL_WORKERS > 1
+    print(f"label_pdf mit {LABEL_WORKERS if parallel else 1} Prozess(en)")
+    with tempfile.TemporaryDirectory() as directory:
+        for size in sizes:
+            conn = _benchmark_warehouse(directory, size)
+            qr_matrix.cache_clear()
+            qr_dark_runs.cache_clear()
+            shutdown_process_pool('labels')
+            start = time.perf_counter()
+            query, params = device_query(conn, 'inventory', filters)
+            buffer = write_label_pdf([device for device, key in device_rows(conn, query, params)], BENCHMARK_LABEL_LAYOUT)
+            elapsed = time.perf_counter() - start
+            print(f"label_pdf {size:>6} Etiketten: {elapsed:7.2f} s, {len(buffer.getvalue()) / 1e6:6.1f} MB")
+            conn.close()
+            close_idle_db_connections(0, conn.db_path)
+
+def benchmark_bulk_import(sizes=(1000, 3000, 10000)):
+    """Time the bulk import (dry run and real import) of CSV files into a warehouse with as many existing devices.
+
+    Afterwards the warehouse is exported as CSV and the export is checked
+    against a fresh warehouse, so the export/import round trip stays intact.
+    """
+    filters = {'search': '', 'status_filters': [], 'art_filters': [], 'klasse_filters': [],
+               'sort_by': 'instrumentenart', 'group_by': 'none'}
+    with tempfile.TemporaryDirectory() as directory:
+        for size in sizes:
+            output = io.StringIO()
+            writer = csv.writer(output, delimiter=';')
+            writer.writerow(['Name', 'Lagerplatz', 'Seriennummer', 'Modell', 'Hersteller', 'Instrumentenart', 'Kaufdatum', 'Preis', 'Beschreibung'])
+            writer.writerows((f'Import {i}', f'Regal {i % 40}', f'IMP{i:07d}', f'Modell {i % 25}', 'Hersteller',
+                              ('Geige', 'Bratsche', 'Cello', 'Kontrabass')[i % 4], '01.09.2024', f'{100 + i % 900},50', '')
+                             for i in range(size))
+            data = output.getvalue().encode('utf-8')
+            conn = _benchmark_warehouse(directory, size)
+            for dry_run in (True, False):
+                start = time.perf_counter()
+                result = import_devices(conn, import_records(io.BytesIO(data)), dry_run=dry_run)
+                elapsed = time.perf_counter() - start
+                print(f"bulk_import {size:>6} Zeilen{' (Testlauf)' if dry_run else ''}: {elapsed:7.2f} s, "
+                      f"{size / elapsed:8.0f} Zeilen/s, {result['imported']} importiert, {result['error_count']} Fehler")
+            # Rundreise: CSV-Export (mit ausgeliehenen Geräten) muss sich fehlerfrei wieder importieren lassen
+            conn.execute("UPDATE geraete SET status = 'ausgeliehen' WHERE id % 10 = 0")
+            conn.commit()
+            query, params = device_query(conn, 'inventory', filters)
+            export = b''.join(generate_csv_export(_get_pooled_connection(conn.db_path), query, params))
+            target = _benchmark_warehouse(directory, 0)
+            result = import_devices(target, import_records(io.BytesIO(export)), dry_run=True)
+            print(f"bulk_import {size:>6} Rundreise: {result['imported']} von {conn.execute('SELECT COUNT(*) FROM geraete').fetchone()[0]} "
+                  f"Geräten importierbar, {result['error_count']} Fehler")
+            for line, message in result['errors'][:3]:
+                print(f"  Zeile {line}: {message}")
+            for connection in (conn, target):
+                connection.close()
+                close_idle_db_connections(0, connection.db_path)
+            os.remove(target.db_path)
+
+BENCHMARKS = {
+    'word_export': benchmark_word_export,
+    'label_pdf': benchmark_label_pdf,
+    'bulk_import': benchmark_bulk_import,
+}
+
+def run_benchmark(name):
+    if name not in BENCHMARKS:
+        print(f"Unbekannter Benchmark: {name} (verfügbar: {', '.join(BENCHMARKS)})")
+        return False
+    BENCHMARKS[name]()
+    return True
+
+#------------------------Benchmarks end------------------------------------
+
 if __name__ == '__main__':
+    # python main.py --benchmark <name> führt nur den Benchmark aus
+    if len(sys.argv) > 2 and sys.argv[1] == '--benchmark':
+        sys.exit(0 if run_benchmark(sys.argv[2]) else 1)
     init_user_db()
+    auto_migrate_all_databases()
     check_version()
     app.run(debug=True, host='0.0.0.0', port=5000)
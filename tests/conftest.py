@@ -0,0 +1,42 @@
+import sqlite3
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import main
+
+FIXTURES = Path(__file__).parent / 'fixtures'
+
+
+@pytest.fixture(autouse=True)
+def workdir(tmp_path, monkeypatch):
+    """Run each test in an empty directory; main.py keeps its databases in the working directory"""
+    monkeypatch.chdir(tmp_path)
+    yield tmp_path
+    # Gepoolte Verbindungen hängen am relativen Pfad und dürfen nicht in den nächsten Test wandern
+    main.close_idle_db_connections(0)
+
+
+def load_fixture_db(name, db_path):
+    """Create db_path from an SQL dump in tests/fixtures"""
+    conn = sqlite3.connect(db_path)
+    try:
+        conn.executescript((FIXTURES / name).read_text(encoding='utf-8'))
+    finally:
+        conn.close()
+    return db_path
+
+
+def table_schema(conn):
+    """Comparable schema of a database: columns of every table, SQL of every index, trigger and view"""
+    schema = {}
+    for object_type, name, sql in conn.execute("SELECT type, name, sql FROM sqlite_master WHERE name NOT LIKE 'sqlite_%' ORDER BY name"):
+        if object_type == 'table':
+            schema[name] = [tuple(row[1:]) for row in conn.execute(f"PRAGMA table_xinfo({name})")]
+        else:
+            schema[name] = ' '.join(sql.split()) if sql else None
+    schema['user_version'] = conn.execute("PRAGMA user_version").fetchone()[0]
+    return schema
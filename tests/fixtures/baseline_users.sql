@@ -0,0 +1,14 @@
+-- users.db im Schema von 50f2aab (init_user_db)
+BEGIN TRANSACTION;
+CREATE TABLE lager
+                 (id TEXT PRIMARY KEY, name TEXT NOT NULL, created_by TEXT,
+                   access_users TEXT, system_type DEFAULT 'personal');
+INSERT INTO "lager" VALUES('48151623','Musikraum','CKS.EXampleid','CKS.EXampleid,CKS-Example','institutional');
+CREATE TABLE users
+                 (id TEXT PRIMARY KEY, name TEXT NOT NULL);
+INSERT INTO "users" VALUES('CKS.EXampleid','Matti');
+INSERT INTO "users" VALUES('CKS-Example','Hubert');
+INSERT INTO "users" VALUES('CKS-Exampledsa','Admin');
+INSERT INTO "users" VALUES('CKS-7sdfuh-dfi','Christoffer Rentsch');
+INSERT INTO "users" VALUES('CKS-udzsfzewliuhd','Steffen Mascher');
+COMMIT;
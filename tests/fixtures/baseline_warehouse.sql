@@ -0,0 +1,61 @@
+-- Lager-Datenbank im Schema von 50f2aab (create_warehouse_db), mit Beispieldaten
+BEGIN TRANSACTION;
+CREATE TABLE ausleih_details
+                 (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                   ausleih_id TEXT NOT NULL,
+                   geraet_id INTEGER NOT NULL,
+                   geraet_barcode TEXT NOT NULL,
+                   quantity INTEGER DEFAULT 1,
+                   FOREIGN KEY(ausleih_id) REFERENCES ausleihen(ausleih_id),
+                   FOREIGN KEY(geraet_id) REFERENCES geraete(id));
+INSERT INTO "ausleih_details" VALUES(1,'7305',1,'482913',1);
+INSERT INTO "ausleih_details" VALUES(2,'7305',4,'305518',2);
+INSERT INTO "ausleih_details" VALUES(3,'0419',4,'305518',1);
+CREATE TABLE ausleihen
+                 (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                   ausleih_id TEXT NOT NULL,
+                   mitarbeiter_id TEXT NOT NULL,
+                   mitarbeiter_name TEXT NOT NULL,
+                   zielort TEXT NOT NULL,
+                   datum TEXT NOT NULL,
+                   rueckgabe_qr TEXT NOT NULL,
+                   status TEXT DEFAULT 'ausgeliehen',
+                   email TEXT,
+                   klasse TEXT);
+INSERT INTO "ausleihen" VALUES(1,'7305','S-1','Anna Beispiel','N/A','2024-03-01 10:00:00','7305','ausgeliehen',NULL,'5a');
+INSERT INTO "ausleihen" VALUES(2,'0419','S-2','Ben Muster','N/A','2024-03-01 10:00:00','0419','ausgeliehen',NULL,'6b');
+INSERT INTO "ausleihen" VALUES(3,'2288','S-3','Clara Test','N/A','2024-03-01 10:00:00','2288','zurückgegeben',NULL,'5a');
+CREATE TABLE geraete
+                 (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                   name TEXT NOT NULL,
+                   barcode TEXT UNIQUE NOT NULL,
+                   lagerplatz TEXT NOT NULL,
+                   status TEXT DEFAULT 'verfügbar',
+                   beschreibung TEXT,
+                   seriennummer TEXT,
+                   modell TEXT,
+                   instrumentenart TEXT,
+                   inventarnummer TEXT,
+                   kaufdatum TEXT,
+                   preis REAL,
+                   quantity INTEGER DEFAULT 1,
+                   hersteller TEXT);
+INSERT INTO "geraete" VALUES(1,'Geige 1','482913','Regal 1','Anna Beispiel (1)','','SN482913','M','Geige','','2023-09-01',450.0,1,'H');
+INSERT INTO "geraete" VALUES(2,'Geige 2','000731','Regal 1','verfügbar','','SN000731','M','Geige','','2023-09-01',450.0,1,'H');
+INSERT INTO "geraete" VALUES(3,'Cello 1','917364','Regal 2','verfügbar','','SN917364','M','Cello','','2023-09-01',1200.0,1,'H');
+INSERT INTO "geraete" VALUES(4,'Notenständer','305518','Kiste 3','Anna Beispiel (2), Ben Muster (1)','','SN305518','M','Zubehör','','2023-09-01',19.9,5,'H');
+INSERT INTO "geraete" VALUES(5,'Kontrabass 1','660042','Regal 4','verfügbar','','SN660042','M','Kontrabass','','2023-09-01',NULL,1,'H');
+CREATE TABLE label_layouts
+                 (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                   name TEXT NOT NULL,
+                   layout_data TEXT NOT NULL,
+                   is_default INTEGER DEFAULT 0,
+                   created_at TEXT DEFAULT CURRENT_TIMESTAMP,
+                   updated_at TEXT DEFAULT CURRENT_TIMESTAMP);
+INSERT INTO "label_layouts" VALUES(1,'Standard','{}',1,'2024-01-01 00:00:00','2024-01-01 00:00:00');
+DELETE FROM "sqlite_sequence";
+INSERT INTO "sqlite_sequence" VALUES('geraete',5);
+INSERT INTO "sqlite_sequence" VALUES('ausleihen',3);
+INSERT INTO "sqlite_sequence" VALUES('ausleih_details',3);
+INSERT INTO "sqlite_sequence" VALUES('label_layouts',1);
+COMMIT;
@@ -0,0 +1,130 @@
+import sqlite3
+
+import pytest
+
+import main
+from conftest import load_fixture_db
+
+SEEDS = [0, 1, 2 ** 62 - 1, 0x5DEECE66D]
+
+
+def warehouse():
+    main.create_warehouse_db('00000001')
+    return sqlite3.connect('00000001.db')
+
+
+def sequence(conn, name):
+    return conn.execute("SELECT next_value, seed FROM id_sequences WHERE name = ?", (name,)).fetchone()
+
+
+def add_device(conn, barcode):
+    conn.execute("INSERT INTO geraete (name, barcode, lagerplatz) VALUES ('Gerät', ?, 'A1')", (barcode,))
+
+
+def add_borrow(conn, ausleih_id):
+    conn.execute("""INSERT INTO ausleihen (ausleih_id, mitarbeiter_id, mitarbeiter_name, zielort, datum, rueckgabe_qr)
+                    VALUES (?, 'S-1', 'Anna', 'N/A', '2024-01-01 08:00:00', ?)""", (ausleih_id, ausleih_id))
+
+
+def add_lager(conn, lager_id):
+    conn.execute("INSERT INTO lager (id, name, created_by) VALUES (?, 'Lager', 'CKS.EXampleid')", (lager_id,))
+
+
+@pytest.mark.parametrize('seed', SEEDS)
+@pytest.mark.parametrize('digits', [1, 2, 3, 4])
+def test_scramble_id_is_a_bijection_within_a_tier(digits, seed):
+    ids = [main.scramble_id(value, digits, seed) for value in range(10 ** digits)]
+    assert sorted(ids) == [str(value).zfill(digits) for value in range(10 ** digits)]
+
+
+@pytest.mark.parametrize('seed', SEEDS)
+def test_scramble_id_continues_in_the_next_tier(seed):
+    # Nach 10 ** 2 Werten geht es dreistellig weiter, nach weiteren 10 ** 3 vierstellig
+    for value in range(0, 1200, 7):
+        if value < 100:
+            expected = main.scramble_id(value, 2, seed)
+        elif value < 1100:
+            expected = main.scramble_id(value - 100, 3, seed)
+        else:
+            expected = main.scramble_id(value - 1100, 4, seed)
+        assert main.scramble_id(value, 2, seed) == expected
+
+
+def test_scramble_id_is_not_sequential():
+    ids = [main.scramble_id(value, 6, 12345) for value in range(50)]
+    assert ids != sorted(ids)
+
+
+def test_allocate_ids_exhausts_a_tier_before_the_next(monkeypatch):
+    monkeypatch.setitem(main.ID_SEQUENCE_DIGITS, 'barcode', 2)
+    conn = warehouse()
+
+    ids = main.allocate_ids(conn, 'barcode', 60) + [main.allocate_id(conn, 'barcode') for _ in range(40)]
+    assert sorted(ids) == [f'{value:02d}' for value in range(100)]
+
+    ids = main.allocate_ids(conn, 'barcode', 120)
+    assert len(set(ids)) == 120
+    assert all(len(barcode) == 3 for barcode in ids)
+
+
+@pytest.mark.parametrize('name, add_row', [('barcode', add_device), ('ausleih_id', add_borrow)])
+def test_allocate_ids_skips_taken_warehouse_ids(name, add_row):
+    conn = warehouse()
+    next_value, seed = sequence(conn, name)
+    digits = main.ID_SEQUENCE_DIGITS[name]
+    taken = [main.scramble_id(next_value + offset, digits, seed) for offset in (0, 2)]
+    for value in taken:
+        add_row(conn, value)
+
+    ids = main.allocate_ids(conn, name, 3)
+    assert len(set(ids)) == 3
+    assert not set(ids) & set(taken)
+    assert ids == [main.scramble_id(next_value + offset, digits, seed) for offset in (1, 3, 4)]
+    assert sequence(conn, name)[0] == next_value + 5
+
+
+def test_allocate_ids_skips_taken_lager_ids():
+    main.init_user_db()
+    conn = sqlite3.connect('users.db')
+    next_value, seed = sequence(conn, 'lager_id')
+    taken = main.scramble_id(next_value, 8, seed)
+    add_lager(conn, taken)
+
+    lager_id = main.allocate_id(conn, 'lager_id')
+    assert lager_id != taken
+    assert lager_id == main.scramble_id(next_value + 1, 8, seed)
+
+
+def test_upgraded_warehouse_never_reuses_existing_ids(monkeypatch):
+    db_path = load_fixture_db('baseline_warehouse.sql', '48151623.db')
+    assert main.apply_migrations(db_path, main.WAREHOUSE_MIGRATIONS, backup=False)
+    conn = sqlite3.connect(db_path)
+    existing = {row[0] for row in conn.execute("SELECT ausleih_id FROM ausleihen")}
+    assert sequence(conn, 'ausleih_id')[0] == 0
+
+    # Alle vierstelligen Ausleih-IDs außer den vorhandenen, dann fünfstellig weiter
+    ids = main.allocate_ids(conn, 'ausleih_id', 10 ** 4 - len(existing))
+    assert sorted(ids) == sorted({f'{value:04d}' for value in range(10 ** 4)} - existing)
+    assert len(main.allocate_id(conn, 'ausleih_id')) == 5
+
+    monkeypatch.setitem(main.ID_SEQUENCE_DIGITS, 'barcode', 2)
+    existing = {f'{value:02d}' for value in range(0, 100, 3)}
+    for barcode in existing:
+        add_device(conn, barcode)
+    ids = main.allocate_ids(conn, 'barcode', 100 - len(existing))
+    assert sorted(ids) == sorted({f'{value:02d}' for value in range(100)} - existing)
+
+
+def test_upgraded_users_db_never_reuses_existing_lager_ids(monkeypatch):
+    db_path = load_fixture_db('baseline_users.sql', 'baseline_users.db')
+    assert main.apply_migrations(db_path, main.USERS_MIGRATIONS, backup=False)
+    conn = sqlite3.connect(db_path)
+    assert sequence(conn, 'lager_id')[0] == 0
+
+    monkeypatch.setitem(main.ID_SEQUENCE_DIGITS, 'lager_id', 2)
+    existing = {f'{value:02d}' for value in range(1, 100, 4)}
+    for lager_id in existing:
+        add_lager(conn, lager_id)
+    ids = main.allocate_ids(conn, 'lager_id', 100 - len(existing))
+    assert sorted(ids) == sorted({f'{value:02d}' for value in range(100)} - existing)
+    assert len(main.allocate_id(conn, 'lager_id')) == 3
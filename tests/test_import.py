@@ -0,0 +1,147 @@
+import io
+import json
+
+import pytest
+
+import main
+
+HEADER = 'Name;Lagerplatz;Barcode;Menge;Preis\n'
+
+
+def warehouse():
+    main.create_warehouse_db('00000001')
+    return main._get_pooled_connection('00000001.db')
+
+
+def run_import(conn, data, dry_run=False):
+    if isinstance(data, str):
+        data = data.encode('utf-8')
+    return main.import_devices(conn, main.import_records(io.BytesIO(data)), dry_run=dry_run)
+
+
+def snapshot(conn):
+    return (conn.execute("SELECT * FROM geraete ORDER BY id").fetchall(),
+            conn.execute("SELECT * FROM id_sequences ORDER BY name").fetchall())
+
+
+def test_dry_run_leaves_the_database_unchanged():
+    conn = warehouse()
+    before = snapshot(conn)
+
+    result = run_import(conn, HEADER + 'Geige;Regal 1;;1;450\nCello;Regal 2;;1;1.200,50\n', dry_run=True)
+    assert result['success'] and result['dry_run']
+    assert result['imported'] == 2
+    # auch die für Zeilen ohne Barcode reservierten Sequenzwerte werden zurückgerollt
+    assert snapshot(conn) == before
+
+
+def test_import_inserts_all_rows():
+    conn = warehouse()
+    result = run_import(conn, HEADER + 'Geige;Regal 1;;1;450\nCello;Regal 2;C-1;2;1.200,50\n')
+    assert result['success'] and result['imported'] == 2
+    rows = conn.execute("SELECT name, lagerplatz, barcode, quantity, preis, status FROM geraete ORDER BY id").fetchall()
+    assert rows[1] == ('Cello', 'Regal 2', 'C-1', 2, 1200.5, 'verfügbar')
+    assert len(rows[0][2]) == main.ID_SEQUENCE_DIGITS['barcode']
+
+
+def test_one_bad_row_rolls_back_everything():
+    conn = warehouse()
+    before = snapshot(conn)
+
+    result = run_import(conn, HEADER + 'Geige;Regal 1;;1;450\n;Regal 2;;1;10\nCello;Regal 3;;1;99\n')
+    assert not result['success']
+    assert result['imported'] == 0
+    assert result['errors'] == [(3, 'Name fehlt')]
+    assert snapshot(conn) == before
+
+
+def test_duplicate_barcodes_within_the_file():
+    conn = warehouse()
+    before = snapshot(conn)
+
+    result = run_import(conn, HEADER + 'Geige;Regal 1;B-1;1;\nCello;Regal 2;B-2;1;\nBratsche;Regal 3;B-1;1;\n')
+    assert not result['success']
+    assert result['errors'] == [(4, 'Barcode B-1 kommt schon in Zeile 2 vor')]
+    assert snapshot(conn) == before
+
+
+def test_duplicate_barcodes_against_the_database():
+    conn = warehouse()
+    assert run_import(conn, HEADER + 'Geige;Regal 1;B-1;1;\n')['success']
+    before = snapshot(conn)
+
+    result = run_import(conn, HEADER + 'Cello;Regal 2;B-2;1;\nBratsche;Regal 3;B-1;1;\n')
+    assert not result['success']
+    assert result['errors'] == [(3, 'Barcode B-1 ist bereits vergeben')]
+    assert snapshot(conn) == before
+
+
+def test_identical_rows_with_the_same_barcode_count_once():
+    conn = warehouse()
+    result = run_import(conn, HEADER + 'Geige;Regal 1;B-1;1;450\nCello;Regal 2;;1;\nGeige;Regal 1;B-1;1;450,00\n')
+    assert result['success'] and result['imported'] == 2
+    assert conn.execute("SELECT COUNT(*) FROM geraete WHERE barcode = 'B-1'").fetchone()[0] == 1
+
+
+def test_allocated_barcodes_avoid_barcodes_from_the_file(monkeypatch):
+    # Einstellige Barcodes: die Datei belegt die Hälfte des Bereichs
+    monkeypatch.setitem(main.ID_SEQUENCE_DIGITS, 'barcode', 1)
+    conn = warehouse()
+    rows = [f'Gerät {digit};Regal;{digit};1;' for digit in '02468'] + [f'Neu {i};Regal;;1;' for i in range(5)]
+
+    result = run_import(conn, HEADER + '\n'.join(rows) + '\n')
+    assert result['success'] and result['imported'] == 10
+    assert sorted(row[0] for row in conn.execute("SELECT barcode FROM geraete")) == list('0123456789')
+
+
+@pytest.mark.parametrize('quantity, expected', [(2, 2), (2.0, 2), ('2', 2), (None, 1)])
+def test_json_quantity(quantity, expected):
+    conn = warehouse()
+    record = {'name': 'Notenständer', 'lagerplatz': 'Kiste', 'menge': quantity, 'preis': 19.0}
+    result = run_import(conn, json.dumps([record]))
+    assert result['success']
+    assert conn.execute("SELECT quantity, preis FROM geraete").fetchone() == (expected, 19.0)
+
+
+@pytest.mark.parametrize('quantity', [2.5, 0, -1, 'viele'])
+def test_invalid_json_quantity(quantity):
+    conn = warehouse()
+    result = run_import(conn, json.dumps({'name': 'Notenständer', 'lagerplatz': 'Kiste', 'menge': quantity}) + '\n')
+    assert not result['success']
+    assert result['errors'][0][1].startswith('Ungültige Menge')
+
+
+@pytest.mark.parametrize('price', ['nan', 'inf', '1e308', '-5'])
+def test_invalid_price(price):
+    conn = warehouse()
+    result = run_import(conn, HEADER + f'Geige;Regal 1;;1;{price}\n')
+    assert result['errors'] == [(2, f"Ungültiger Preis '{price}'")]
+
+
+def test_csv_export_imports_again():
+    conn = warehouse()
+    assert run_import(conn, HEADER + 'Geige;Regal 1;G-1;1;450\nNotenständer;Kiste;N-1;5;19,90\nCello;Regal 2;C-1;1;\n')['success']
+    conn.execute("""INSERT INTO ausleihen (ausleih_id, mitarbeiter_id, mitarbeiter_name, zielort, datum, rueckgabe_qr, klasse)
+                    VALUES ('0001', 'S-1', 'Anna', 'N/A', '2024-01-01 08:00:00', '0001', '5a')""")
+    conn.execute("INSERT INTO ausleih_details (ausleih_id, geraet_id, geraet_barcode, quantity) VALUES ('0001', 2, 'N-1', 2)")
+    conn.execute("""INSERT INTO ausleihen (ausleih_id, mitarbeiter_id, mitarbeiter_name, zielort, datum, rueckgabe_qr, klasse)
+                    VALUES ('0002', 'S-2', 'Ben', 'N/A', '2024-01-01 09:00:00', '0002', '6b')""")
+    conn.execute("INSERT INTO ausleih_details (ausleih_id, geraet_id, geraet_barcode, quantity) VALUES ('0002', 2, 'N-1', 1)")
+    main.refresh_device_status(conn, [2])
+    conn.execute("UPDATE geraete SET status = 'defekt' WHERE barcode = 'C-1'")
+    conn.commit()
+
+    filters = {'search': '', 'status_filters': [], 'art_filters': [], 'klasse_filters': [],
+               'sort_by': 'instrumentenart', 'group_by': 'none'}
+    query, params = main.device_query(conn, 'inventory', filters)
+    export = b''.join(main.generate_csv_export(main._get_pooled_connection(conn.db_path), query, params))
+    # Ein Gerät pro Ausleihe, also zweimal N-1
+    assert export.count(b'N-1') == 2 and b'Anna (2), Ben (1)' in export
+
+    main.create_warehouse_db('00000002')
+    target = main._get_pooled_connection('00000002.db')
+    result = run_import(target, export)
+    assert result['success'] and result['imported'] == 3
+    # Ausleihen werden nicht übernommen, defekt bleibt defekt
+    assert target.execute("SELECT barcode, status, quantity FROM geraete ORDER BY barcode").fetchall() == \
+        [('C-1', 'defekt', 1), ('G-1', 'verfügbar', 1), ('N-1', 'verfügbar', 5)]
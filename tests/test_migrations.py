@@ -0,0 +1,97 @@
+import os
+import sqlite3
+
+import pytest
+
+import main
+from conftest import load_fixture_db, table_schema
+
+LAGER_ID = '48151623'
+
+
+def upgraded_warehouse():
+    db_path = load_fixture_db('baseline_warehouse.sql', f'{LAGER_ID}.db')
+    assert main.apply_migrations(db_path, main.WAREHOUSE_MIGRATIONS, backup=False)
+    return sqlite3.connect(db_path)
+
+
+def has_search_index(conn):
+    return conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'geraete_fts'").fetchone() is not None
+
+
+def test_baseline_warehouse_upgrades_to_fresh_schema():
+    upgraded = upgraded_warehouse()
+    main.create_warehouse_db('00000001')
+    fresh = sqlite3.connect('00000001.db')
+
+    assert table_schema(upgraded) == table_schema(fresh)
+    assert table_schema(upgraded)['user_version'] == main.WAREHOUSE_MIGRATIONS[-1][0]
+
+
+def test_baseline_users_db_upgrades_to_fresh_schema():
+    # init_user_db legt immer users.db an, die alte Datenbank liegt daneben
+    db_path = load_fixture_db('baseline_users.sql', 'baseline_users.db')
+    assert main.apply_migrations(db_path, main.USERS_MIGRATIONS, backup=False)
+    main.init_user_db()
+
+    upgraded = sqlite3.connect(db_path)
+    assert table_schema(upgraded) == table_schema(sqlite3.connect('users.db'))
+    assert upgraded.execute("SELECT COUNT(*) FROM lager").fetchone()[0] == 1
+
+
+def test_upgrade_builds_counters_search_index_and_sequences():
+    conn = upgraded_warehouse()
+
+    # Zähler aus den aktiven Ausleihen; die zurückgegebene Ausleihe zählt nicht mit
+    assert main.check_availability_counters(conn) == []
+    assert dict(conn.execute("SELECT geraet_id, borrowed_quantity FROM geraete_bestand WHERE borrowed_quantity > 0")) == {1: 1, 4: 3}
+    assert conn.execute("SELECT mitarbeiter_name, quantity FROM geraete_ausleiher WHERE geraet_id = 4 ORDER BY 1").fetchall() == \
+        [('Anna Beispiel', 2), ('Ben Muster', 1)]
+
+    if has_search_index(conn):
+        assert conn.execute("SELECT COUNT(*) FROM geraete_fts").fetchone()[0] == 5
+        assert conn.execute("SELECT rowid FROM geraete_fts WHERE geraete_fts MATCH ?", ('"Ben Muster"',)).fetchall() == [(4,)]
+
+    assert dict(conn.execute("SELECT name, next_value FROM id_sequences")) == {'barcode': 0, 'ausleih_id': 0}
+
+
+def test_migration_steps_are_idempotent():
+    conn = upgraded_warehouse()
+    before = table_schema(conn)
+    conn.execute("PRAGMA user_version = 0")
+    conn.close()
+
+    assert main.apply_migrations(f'{LAGER_ID}.db', main.WAREHOUSE_MIGRATIONS, backup=False)
+    conn = sqlite3.connect(f'{LAGER_ID}.db')
+    assert table_schema(conn) == before
+    assert main.check_availability_counters(conn) == []
+    if has_search_index(conn):
+        assert conn.execute("SELECT COUNT(*) FROM geraete_fts").fetchone()[0] == 5
+
+
+def test_backup_only_when_a_step_runs():
+    load_fixture_db('baseline_warehouse.sql', f'{LAGER_ID}.db')
+    assert main.check_and_migrate_warehouse_db(LAGER_ID)
+    backups = os.listdir('backups')
+    assert len(backups) == 1 and backups[0].endswith(f'_migration_{LAGER_ID}.db')
+
+    assert main.check_and_migrate_warehouse_db(LAGER_ID)
+    assert os.listdir('backups') == backups
+
+    # Das Backup ist die Datenbank vor der Migration
+    backup = sqlite3.connect(os.path.join('backups', backups[0]))
+    assert backup.execute("PRAGMA user_version").fetchone()[0] == 0
+    assert backup.execute("SELECT COUNT(*) FROM geraete").fetchone()[0] == 5
+
+
+@pytest.mark.parametrize('missing_column', ['hersteller', 'quantity'])
+def test_baseline_warehouse_without_later_columns(missing_column):
+    # Ältere Lager haben Spalten, die erst später dazugekommen sind, noch nicht
+    db_path = load_fixture_db('baseline_warehouse.sql', f'{LAGER_ID}.db')
+    conn = sqlite3.connect(db_path)
+    conn.execute(f"ALTER TABLE geraete DROP COLUMN {missing_column}")
+    conn.close()
+
+    assert main.apply_migrations(db_path, main.WAREHOUSE_MIGRATIONS, backup=False)
+    columns = main.get_table_columns(sqlite3.connect(db_path), 'geraete')
+    assert missing_column in columns